@@ -14,6 +14,7 @@ from .utils import (
     round_filters,
     round_repeats,
     drop_connect,
+    checkpoint_block,
     get_same_padding_conv2d,
     get_model_params,
     efficientnet_params,
@@ -249,6 +250,9 @@ class EfficientNetEncoder(nn.Module):
         # set activation to memory efficient swish by default
         self._swish = MemoryEfficientSwish()
 
+        # activation checkpointingを行うブロックのインデックス
+        self._checkpoint_blocks = set()
+
         self.isForCharacter = isForCharacter
         self.ver = ver
 
@@ -298,6 +302,20 @@ class EfficientNetEncoder(nn.Module):
         for block in self._blocks:
             block.set_swish(memory_efficient)
 
+    def set_checkpoint(self, enabled=True, blocks=None):
+        """Sets activation checkpointing for the MBConv blocks.
+
+        Args:
+            enabled (bool): Whether to checkpoint the blocks.
+            blocks (None or iterable of int): Indices of blocks to checkpoint. None means all blocks.
+        """
+        if not enabled:
+            self._checkpoint_blocks = set()
+        elif blocks is None:
+            self._checkpoint_blocks = set(range(len(self._blocks)))
+        else:
+            self._checkpoint_blocks = set(blocks)
+
     def extract_endpoints(self, inputs):
         """Use convolution layer to extract features
         from reduction levels i in [1, 2, 3, 4, 5].
@@ -367,7 +385,7 @@ class EfficientNetEncoder(nn.Module):
             drop_connect_rate = self._global_params.drop_connect_rate
             if drop_connect_rate:
                 drop_connect_rate *= float(idx) / len(self._blocks)  # scale drop connect_rate
-            x = block(x, drop_connect_rate=drop_connect_rate)
+            x = checkpoint_block(block, x, drop_connect_rate, enabled=idx in self._checkpoint_blocks)
             if (self.ver < 2 or not self.isForCharacter) and (idx in self.used_maps_indices):
                 used_maps.append(x) # 場合によってはclone()すべき？
         if self.ver <= 2 or self.isForCharacter:
@@ -705,6 +723,9 @@ class EfficientNetDiscriminator(nn.Module):
         # set activation to memory efficient swish by default
         self._swish = MemoryEfficientSwish()
 
+        # activation checkpointingを行うブロックのインデックス
+        self._checkpoint_blocks = set()
+
     def set_swish(self, memory_efficient=True):
         """Sets swish function as memory efficient (for training) or standard (for export).
 
@@ -715,6 +736,31 @@ class EfficientNetDiscriminator(nn.Module):
         for block in self._blocks:
             block.set_swish(memory_efficient)
 
+    def set_checkpoint(self, enabled=True, blocks=None):
+        """Sets activation checkpointing for the MBConv blocks.
+
+        Args:
+            enabled (bool): Whether to checkpoint the blocks.
+            blocks (None or iterable of int): Indices of blocks to checkpoint. None means all blocks.
+        """
+        if not enabled:
+            self._checkpoint_blocks = set()
+        elif blocks is None:
+            self._checkpoint_blocks = set(range(len(self._blocks)))
+        else:
+            self._checkpoint_blocks = set(blocks)
+
+    def set_dropout(self, p):
+        """Sets the drop probability of the Dropout2d layers after the MBConv blocks in place.
+
+        Parameters and optimizer states are left untouched.
+
+        Args:
+            p (float): New drop probability.
+        """
+        for dropout in self.dropouts:
+            dropout.p = p
+
     def extract_endpoints(self, inputs):
         """Use convolution layer to extract features
         from reduction levels i in [1, 2, 3, 4, 5].
@@ -782,7 +828,7 @@ class EfficientNetDiscriminator(nn.Module):
             drop_connect_rate = self._global_params.drop_connect_rate
             if drop_connect_rate:
                 drop_connect_rate *= float(idx) / len(self._blocks)  # scale drop connect_rate
-            x = block(x, drop_connect_rate=drop_connect_rate)
+            x = checkpoint_block(block, x, drop_connect_rate, enabled=idx in self._checkpoint_blocks)
             x = self.dropouts[idx](x)
 
         # Head
@@ -6,14 +6,18 @@
 # Github repo: https://github.com/lukemelas/EfficientNet-PyTorch
 # With adjustments and added comments by workingcoder (github username).
 
+import os
 import re
 import math
+import hashlib
+import contextlib
 import collections
 from functools import partial
 import torch
 from torch import nn
 from torch.nn import functional as F
-from torch.utils import model_zoo
+from torch.utils.checkpoint import checkpoint
+from torch.nn.utils.spectral_norm import SpectralNorm
 
 
 ################################################################################
@@ -26,6 +30,7 @@ from torch.utils import model_zoo
 #     Functions to calculate params for scaling model width and depth ! ! !
 # get_width_and_height_from_size and calculate_output_image_size
 # drop_connect: A structural design
+# checkpoint_block: Activation checkpointing for a single block
 # get_same_padding_conv2d:
 #     Conv2dDynamicSamePadding
 #     Conv2dStaticSamePadding
@@ -154,6 +159,174 @@ def drop_connect(inputs, p, training):
     return output
 
 
+def _spectral_norm_modules(block):
+    for module in block.modules():
+        for hook in module._forward_pre_hooks.values():
+            if isinstance(hook, SpectralNorm):
+                yield module, hook.name
+
+
+class _RecomputeState:
+    """Makes the recompute of a checkpointed block repeat the first forward without side effects.
+
+       After the first forward, the u and v of every spectral norm are stashed. While recomputing,
+       they are swapped in (as other tensors, not in place, so the saved graph stays valid) and
+       the power iteration is turned off, so the recomputed weight is the one of the first forward.
+       BatchNorm momentum is set to 0 so that the running statistics are not updated a second time.
+    """
+
+    def __init__(self, block):
+        self.block = block
+        self.spectral_norms = []
+
+    @contextlib.contextmanager
+    def forward(self):
+        yield
+        self.spectral_norms = [(module, name, getattr(module, name + '_u').clone(), getattr(module, name + '_v').clone())
+                               for module, name in _spectral_norm_modules(self.block)]
+
+    @contextlib.contextmanager
+    def recompute(self):
+        batch_norms = [(m, m.momentum, m.num_batches_tracked.clone()) for m in self.block.modules()
+                       if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats]
+        spectral_norms = []
+        for module, name, u, v in self.spectral_norms:
+            spectral_norms.append((module, name, module.training, module._buffers[name + '_u'], module._buffers[name + '_v']))
+            module._buffers[name + '_u'] = u
+            module._buffers[name + '_v'] = v
+            module.training = False  # do_power_iteration=False in the hook
+        for m, _, _ in batch_norms:
+            m.momentum = 0.0
+        try:
+            yield
+        finally:
+            for m, momentum, num_batches_tracked in batch_norms:
+                m.momentum = momentum
+                m.num_batches_tracked.copy_(num_batches_tracked)
+            for module, name, training, u, v in spectral_norms:
+                module._buffers[name + '_u'] = u
+                module._buffers[name + '_v'] = v
+                module.training = training
+
+
+def checkpoint_block(block, *inputs, enabled=True):
+    """Run a block with activation checkpointing.
+       The activations inside the block are not kept and are recomputed in backward.
+       The non-reentrant implementation is used so that double backward
+       (torch.autograd.grad with create_graph=True, as in the gradient penalty) still works.
+       The recompute does not update BatchNorm running statistics again and reuses the spectral norm
+       u and v of the first forward, so the gradient is taken at the weight that was used (_RecomputeState).
+
+    Args:
+        block (Module): Block to be run.
+        inputs: Inputs of the block (tensors or python values).
+        enabled (bool): Whether to checkpoint this block.
+
+    Returns:
+        output: Output of the block.
+    """
+    if not enabled or not torch.is_grad_enabled():
+        return block(*inputs)
+    state = _RecomputeState(block)
+    return checkpoint(block, *inputs, use_reentrant=False, context_fn=lambda: (state.forward(), state.recompute()))
+
+
+class AmortizedSpectralNorm(SpectralNorm):
+    """Spectral normalization whose power iteration is run once per optimizer step
+       (or every `interval` steps) instead of on every forward.
+       Forwards between two refreshes reuse the same u and v, so sigma = u^T W v costs
+       one matrix-vector product and its gradient is the same as in nn.utils.spectral_norm.
+       Without grad the normalized weight is cached until the weight or u changes,
+       which makes repeated evaluation (validation, inference) free of any normalization work.
+       The parameters and buffers are the ones of nn.utils.spectral_norm,
+       so state dicts and nn.utils.remove_spectral_norm are unchanged.
+
+    Args:
+        name (str): Name of the weight parameter.
+        n_power_iterations (int): Number of power iterations per refresh.
+        dim (int): Dimension corresponding to the number of outputs.
+        eps (float): Epsilon for numerical stability in normalization.
+        interval (int): Number of steps between two refreshes.
+    """
+
+    def __init__(self, name='weight', n_power_iterations=1, dim=0, eps=1e-12, interval=1):
+        super().__init__(name, n_power_iterations, dim, eps)
+        self.interval = interval
+        self.steps = 0
+        self.pending = True
+        self.cache = None
+
+    @classmethod
+    def from_hook(cls, hook, interval=1):
+        return cls(hook.name, hook.n_power_iterations, hook.dim, hook.eps, interval)
+
+    def step(self):
+        """Count an optimizer step and request a refresh every `interval` steps."""
+        self.steps += 1
+        if self.steps % self.interval == 0:
+            self.pending = True
+
+    def compute_weight(self, module, do_power_iteration):
+        weight = getattr(module, self.name + '_orig')
+        u = getattr(module, self.name + '_u')
+        v = getattr(module, self.name + '_v')
+        refresh = do_power_iteration and self.pending
+        if not refresh and not torch.is_grad_enabled():
+            if self.cache is not None and self.cache[0] == self._cache_key(weight, u):
+                return self.cache[1]
+        weight_mat = self.reshape_weight_to_matrix(weight)
+        if refresh:
+            self.pending = False
+            with torch.no_grad():
+                for _ in range(self.n_power_iterations):
+                    v = F.normalize(torch.mv(weight_mat.t(), u), dim=0, eps=self.eps, out=v)
+                    u = F.normalize(torch.mv(weight_mat, v), dim=0, eps=self.eps, out=u)
+        if torch.is_grad_enabled():
+            # Cloned so that a later in-place refresh does not invalidate this graph.
+            u = u.clone(memory_format=torch.contiguous_format)
+            v = v.clone(memory_format=torch.contiguous_format)
+            return weight / torch.dot(u, torch.mv(weight_mat, v))
+        normalized = weight / torch.dot(u, torch.mv(weight_mat, v))
+        self.cache = (self._cache_key(weight, u), normalized)
+        return normalized
+
+    @staticmethod
+    def _cache_key(weight, u):
+        # In-place updates (optimizer steps, load_state_dict, refreshes) bump _version.
+        return (weight.data_ptr(), weight._version, u.data_ptr(), u._version)
+
+
+def use_amortized_spectral_norm(model, optimizer=None, interval=1):
+    """Replace the nn.utils.spectral_norm hooks in a model by AmortizedSpectralNorm.
+
+    Args:
+        model (Module): Model whose spectral normalized layers are replaced (in place).
+        optimizer (Optimizer): Optimizer updating the model. A step post hook is registered on it
+            to refresh sigma after every `interval` steps. If None, sigma is refreshed
+            only once, which is enough for models that are not trained.
+        interval (int): Number of optimizer steps between two refreshes.
+
+    Returns:
+        hooks (list): The AmortizedSpectralNorm hooks of the model.
+    """
+    hooks = []
+    for module in model.modules():
+        for key, hook in list(module._forward_pre_hooks.items()):
+            if not isinstance(hook, SpectralNorm):
+                continue
+            if not isinstance(hook, AmortizedSpectralNorm):
+                hook = AmortizedSpectralNorm.from_hook(hook, interval)
+                module._forward_pre_hooks[key] = hook
+            hook.interval = interval
+            hooks.append(hook)
+    if optimizer is not None and len(hooks) > 0:
+        def refresh(optimizer, args, kwargs):
+            for hook in hooks:
+                hook.step()
+        optimizer.register_step_post_hook(refresh)
+    return hooks
+
+
 def get_width_and_height_from_size(x):
     """Obtain height and width from x.
 
@@ -248,6 +421,8 @@ class Conv2dDynamicSamePadding(nn.Conv2d):
 class Conv2dStaticSamePadding(nn.Conv2d):
     """2D Convolutions like TensorFlow's 'SAME' mode, with the given input image size.
        The padding mudule is calculated in construction function, then used in forward.
+       Inputs of another size (e.g. low resolution images in progressive training) are padded
+       with the padding calculated for their own size.
     """
 
     # With the same calculation as Conv2dDynamicSamePadding
@@ -259,19 +434,33 @@ class Conv2dStaticSamePadding(nn.Conv2d):
         # Calculate padding based on image size and save it
         assert image_size is not None
         ih, iw = (image_size, image_size) if isinstance(image_size, int) else image_size
+        self.image_size = (ih, iw)
+        pad = self._get_same_padding(ih, iw)
+        if any(pad):
+            self.static_padding = nn.ZeroPad2d(pad)
+        else:
+            self.static_padding = nn.Identity()
+        # Paddings of the other input sizes (e.g. low resolution images), computed on first use
+        self._other_paddings = {}
+
+    def _get_same_padding(self, ih, iw):
+        """Calculates the 'SAME' padding (left, right, top, bottom) for an input of size (ih, iw)."""
         kh, kw = self.weight.size()[-2:]
         sh, sw = self.stride
         oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
         pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
         pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            self.static_padding = nn.ZeroPad2d((pad_w // 2, pad_w - pad_w // 2,
-                                                pad_h // 2, pad_h - pad_h // 2))
-        else:
-            self.static_padding = nn.Identity()
+        return (pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2)
 
     def forward(self, x):
-        x = self.static_padding(x)
+        size = tuple(x.shape[-2:])
+        if size == self.image_size:
+            x = self.static_padding(x)
+        else:
+            # The padding for image_size does not fit other sizes, so calculate it for this size
+            if size not in self._other_paddings:
+                self._other_paddings[size] = self._get_same_padding(*size)
+            x = F.pad(x, self._other_paddings[size])
         x = F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
         return x
 
@@ -356,6 +545,8 @@ class MaxPool2dStaticSamePadding(nn.MaxPool2d):
 # get_model_params and efficientnet:
 #     Functions to get BlockArgs and GlobalParams for efficientnet
 # url_map and url_map_advprop: Dicts of url_map for pretrained weights
+# set_pretrained_weights_dir and get_pretrained_state_dict:
+#     A local, checksummed registry of pretrained weights cached once per process
 # load_pretrained_weights: A function to load pretrained weights
 
 class BlockDecoder(object):
@@ -581,6 +772,93 @@ url_map_advprop = {
 # TODO: add the petrained weights url map of 'efficientnet-l2'
 
 
+# Local registry of pretrained weights.
+# Files are stored under their release file names (e.g. efficientnet-b0-355c32eb.pth), which is also the
+# layout of the torch.hub checkpoint cache used by model_zoo.load_url, so previously downloaded weights are found.
+# The 8 hex digits in the file name are the prefix of the file's sha256 and are checked on the first load.
+# Downloads are off by default so that machines without network access fail fast;
+# set EFFICIENTNET_ALLOW_DOWNLOAD=1 to download missing files from url_map.
+PRETRAINED_WEIGHTS_DIR = os.environ.get('EFFICIENTNET_WEIGHTS_DIR',
+                                        os.path.join(torch.hub.get_dir(), 'checkpoints'))
+PRETRAINED_ALLOW_DOWNLOAD = os.environ.get('EFFICIENTNET_ALLOW_DOWNLOAD', '0') == '1'
+_HASH_REGEX = re.compile(r'-([a-f0-9]*)\.')
+_pretrained_state_dicts = {}
+
+
+def set_pretrained_weights_dir(weights_dir, allow_download=False):
+    """Sets the local directory of the pretrained weight registry.
+
+    Args:
+        weights_dir (str): Directory containing the pretrained weight files.
+        allow_download (bool): Whether to download missing files from url_map.
+                               Set False on machines without network access to fail fast.
+    """
+    global PRETRAINED_WEIGHTS_DIR, PRETRAINED_ALLOW_DOWNLOAD
+    PRETRAINED_WEIGHTS_DIR = weights_dir
+    PRETRAINED_ALLOW_DOWNLOAD = allow_download
+
+
+def _check_hash(path, hash_prefix):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    if not digest.startswith(hash_prefix):
+        raise RuntimeError('Checksum mismatch for pretrained weights {}: expected sha256 starting with {}, got {}. '
+                           'Delete the file and place a correct copy.'.format(path, hash_prefix, digest))
+
+
+def get_pretrained_state_dict(model_name, weights_path=None, advprop=False):
+    """Gets the pretrained state_dict from the local registry.
+
+    The state_dict is loaded once per process and shared by all callers, so it must not be modified.
+
+    Args:
+        model_name (str): Model name of efficientnet.
+        weights_path (None or str):
+            str: path to pretrained weights file on the local disk.
+            None: use the file of url_map in PRETRAINED_WEIGHTS_DIR.
+        advprop (bool): Whether to use pretrained weights
+                        trained with advprop (valid when weights_path is None).
+
+    Returns:
+        state_dict (dict): Shared pretrained state_dict on the cpu.
+    """
+    key = weights_path if isinstance(weights_path, str) else (model_name, advprop)
+    if key in _pretrained_state_dicts:
+        return _pretrained_state_dicts[key]
+
+    if isinstance(weights_path, str):
+        path = weights_path
+    else:
+        url_map_ = url_map_advprop if advprop else url_map
+        url = url_map_[model_name]
+        file_name = os.path.basename(url)
+        path = os.path.join(PRETRAINED_WEIGHTS_DIR, file_name)
+        hash_prefix = _HASH_REGEX.search(file_name).group(1)
+        if not os.path.exists(path):
+            if not PRETRAINED_ALLOW_DOWNLOAD:
+                raise FileNotFoundError('Pretrained weights for {} are not in the local registry: {} does not exist. '
+                                        'Download {} on a machine with network access and copy it there, '
+                                        'call set_pretrained_weights_dir, or set EFFICIENTNET_ALLOW_DOWNLOAD=1 '
+                                        'to download it.'.format(model_name, path, url))
+            os.makedirs(PRETRAINED_WEIGHTS_DIR, exist_ok=True)
+            try:
+                torch.hub.download_url_to_file(url, path, hash_prefix=hash_prefix)
+            except OSError as e:
+                raise RuntimeError('Failed to download pretrained weights for {} from {} ({}). '
+                                   'On machines without network access, place {} in {} '
+                                   'or set EFFICIENTNET_ALLOW_DOWNLOAD=0.'.format(model_name, url, e, file_name,
+                                                                                 PRETRAINED_WEIGHTS_DIR)) from e
+        else:
+            _check_hash(path, hash_prefix)
+
+    state_dict = torch.load(path, map_location='cpu')
+    _pretrained_state_dicts[key] = state_dict
+    return state_dict
+
+
 def load_pretrained_weights(model, model_name, weights_path=None, load_fc=True, advprop=False, verbose=True):
     """Loads pretrained weights from weights path or download using url.
 
@@ -589,17 +867,13 @@ def load_pretrained_weights(model, model_name, weights_path=None, load_fc=True,
         model_name (str): Model name of efficientnet.
         weights_path (None or str):
             str: path to pretrained weights file on the local disk.
-            None: use pretrained weights downloaded from the Internet.
+            None: use pretrained weights from the local registry (see get_pretrained_state_dict).
         load_fc (bool): Whether to load pretrained weights for fc layer at the end of the model.
         advprop (bool): Whether to load pretrained weights
                         trained with advprop (valid when weights_path is None).
     """
-    if isinstance(weights_path, str):
-        state_dict = torch.load(weights_path)
-    else:
-        # AutoAugment or Advprop (different preprocessing)
-        url_map_ = url_map_advprop if advprop else url_map
-        state_dict = model_zoo.load_url(url_map_[model_name])
+    # AutoAugment or Advprop (different preprocessing)
+    state_dict = get_pretrained_state_dict(model_name, weights_path=weights_path, advprop=advprop)
 
     if load_fc:
         ret = model.load_state_dict(state_dict, strict=False)
@@ -608,8 +882,8 @@ def load_pretrained_weights(model, model_name, weights_path=None, load_fc=True,
         assert set(ret.missing_keys) != set(list(model.encode_convs.state_dict().keys()) +\
                      list(model.map2styles.state_dict().keys())), 'Missing keys when loading pretrained weights: {}'.format(ret.missing_keys)
     else:
-        state_dict.pop('_fc.weight')
-        state_dict.pop('_fc.bias')
+        # the cached state_dict is shared, so build a new dict instead of modifying it
+        state_dict = {key: value for key, value in state_dict.items() if key not in ['_fc.weight', '_fc.bias']}
         keys = list(state_dict.keys())
         for key in keys:
             state_dict[key + "_orig"] = state_dict[key].detach()
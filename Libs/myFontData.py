@@ -21,7 +21,8 @@ class FontGeneratorDataset(data.Dataset):
     IMAGE_WH = 256
 
     def __init__(self, fontTools: FontTools, compatibleDict: dict, imageN : list, styleDict: dict,\
-         useTensor=True, startInd = 0, indN = None, isForValid = None, augmentationP = None, originalAugmentationP = None,):
+         useTensor=True, startInd = 0, indN = None, isForValid = None, augmentationP = None, originalAugmentationP = None,
+         returnKeys = False, targetWH = None):
         #  fontTools ... FontTools
         #  compatibleDict ... 各フォントごとに対応している文字のリストを紐づけたディクショナリ
         #  imageN ... ペア画像を出力する数の範囲(要素は２つ)
@@ -32,6 +33,10 @@ class FontGeneratorDataset(data.Dataset):
         #  isForValid ... validationなどで、常に固定したデータで出力をしたいときに使う
         # 　　getInputListForVで取得したディクショナリをここに入れればよい。
         #  augmentationP ... オーグメンテーションをする確率。Noneなら0, floatの二次元リストを受け取る
+        #  returnKeys ... Trueなら変換用画像の[フォントのインデックス, 文字, オーグメンテーションしたか]も返す
+        #  　　特徴量のキャッシュ(RealGlyphFeatureCache)のキーに使う
+        #  targetWH ... 変換後画像をこの大きさに縮小して出力する(生成画像を低いlevelの解像度のまま比較するとき)
+        #  　　変換元画像，教師用データはエンコーダに入力するため256のまま．Noneなら縮小しない
         self.fontTools = fontTools
         self.fontList = FontTools.getFontPathList()
         self.compatibleDict = compatibleDict
@@ -56,6 +61,8 @@ class FontGeneratorDataset(data.Dataset):
         
         self.augmentationP = augmentationP
         self.originalAugmentationP = originalAugmentationP
+        self.returnKeys = returnKeys
+        self.targetWH = targetWH
         
 
     def __len__(self):
@@ -76,11 +83,13 @@ class FontGeneratorDataset(data.Dataset):
         charaChooser = CharacterChooser(self.fontTools, self.fontList[index],
                 self.compatibleDict[self.fontList[index]], useTensor=self.useTensor)
         beforeNormalize= None
+        augmented = False
         styleChangeList0 = [False, False] # 非正方形, ノイズ
         styleChangeList1 = [False] * OriginalAugSet.TRANSFORM_N
         if(self.augmentationP is not  None):
 
             beforeNormalize, styleChangeList = MyPSPAugmentation.getTransform(self.IMAGE_WH, self.augmentationP)
+            augmented = beforeNormalize is not None
         if(self.originalAugmentationP):
             if(beforeNormalize):
                 beforeNormalize = [beforeNormalize]
@@ -89,6 +98,7 @@ class FontGeneratorDataset(data.Dataset):
             aug, styleChangeList1 = OriginalAugSet.getAll(self.originalAugmentationP)
             if(aug):
                 beforeNormalize.append(aug)
+                augmented = True
             beforeNormalize = transforms.Compose(beforeNormalize)
 
         else:
@@ -96,20 +106,31 @@ class FontGeneratorDataset(data.Dataset):
                 beforeNormalize = transforms.Compose([beforeNormalize])
 
         if(self.isForValid):
-            imageList = charaChooser.getImageFromSampleList(self.fixedInput[index], self.normalize, beforeNormalize)
+            sampleList = self.fixedInput[index]
         else:
-            sampleN = self.sampleN
-            imageList = charaChooser.getSampledImagePair(sampleN, self.normalize, beforeNormalize)
+            sampleList = charaChooser.sample(self.sampleN)
+        imageList = charaChooser.getImageFromSampleList(sampleList, self.normalize, beforeNormalize)
 
         convertedPair = imageList[0]
+        if(self.targetWH is not None and self.targetWH != self.IMAGE_WH):
+            convertedPair = [convertedPair[0], self.downsample(convertedPair[1], self.targetWH)]
         teachers = torch.stack([torch.stack(i, 0) for i in imageList[1:]], 0)
 
         # Style情報
         styleLabel = torch.tensor(self.styleDict[self.fontList[index]])
         styleLabel = self.getModifiedStyleLabel(styleLabel, styleChangeList0, styleChangeList1)
         
+        if(self.returnKeys):
+            return [convertedPair, teachers, styleLabel, [index, sampleList[0], augmented]]
         return [convertedPair, teachers, styleLabel]
 
+    @classmethod
+    def downsample(cls, image, wh):
+        # 正規化済みの画像 [..., H, W] を面積平均で[..., wh, wh]に縮小する
+        shape = image.shape
+        image = F.interpolate(image.reshape(-1, 1, shape[-2], shape[-1]), size=(wh, wh), mode="area")
+        return image.reshape(*shape[:-2], wh, wh)
+
     @classmethod
     def getModifiedStyleLabel(cls, label, changeList0, changeList1):
         # augmentationで変わった分ラベルも修正する
@@ -216,6 +237,7 @@ class MyPSPCharaDataset(data.Dataset):
 
 class MyPSPBatchSampler(torch.utils.data.sampler.BatchSampler):
     # MyPSP用のBatchSampler
+    # epochの最初にそのepochのバッチの列(batches)をすべて作っておくため，getState, setStateで途中から再開できる
     def __init__(self, batchSize, fontGeneratorDataset: FontGeneratorDataset, japaneseRate = 0):
         self.fontGeneratorDataset = fontGeneratorDataset
         self.len = len(fontGeneratorDataset)
@@ -224,24 +246,77 @@ class MyPSPBatchSampler(torch.utils.data.sampler.BatchSampler):
             self.japaneseRate = japaneseRate
         else:
             self.japaneseRate = 0
-        
-    def __iter__(self):
-        self.count = self.batchSize
-        self.indicesList = random.sample(list(range(self.len)), self.len)
+        self.batches = []
+        self.start = 0 # このepochで最初に出力したバッチの位置
+        self.resumeState = None # setStateで渡された，次のepochで使う状態
+
+    def makeBatches(self, rand, batchN):
+        # randを使ってシャッフルし，batchN個のバッチの列を作る
+        self.indicesList = rand.sample(list(range(self.len)), self.len)
         if(self.japaneseRate > 0):
-            self.japaneseIndicesList = random.choices(self.fontGeneratorDataset.getJapaneseFontIndices(), k=self.len)
-        while self.count <= self.len:
-            self.fontGeneratorDataset.resetSampleN()
-            if(random.random() < self.japaneseRate):
-                yield(self.japaneseIndicesList[self.count-self.batchSize: self.count])
+            self.japaneseIndicesList = rand.choices(self.fontGeneratorDataset.getJapaneseFontIndices(), k=self.len)
+        batches = []
+        for batchInd in range(batchN):
+            count = (batchInd + 1) * self.batchSize
+            if(rand.random() < self.japaneseRate):
+                batches.append(self.japaneseIndicesList[count-self.batchSize: count])
             else:
-                yield(self.indicesList[self.count-self.batchSize: self.count])
-            self.count += self.batchSize
+                batches.append(self.indicesList[count-self.batchSize: count])
+        return batches
+
+    def getBatches(self):
+        return self.makeBatches(random, self.len // self.batchSize)
+
+    def __iter__(self):
+        if(self.resumeState is None):
+            self.batches = self.getBatches()
+            self.start = 0
+        else:
+            self.batches = self.resumeState["batches"]
+            self.start = self.resumeState["position"]
+            self.resumeState = None
+        for self.count in range(self.start, len(self.batches)):
+            self.fontGeneratorDataset.resetSampleN()
+            yield(self.batches[self.count])
+
+    def getState(self, consumedN):
+        # 現在のepochで，consumedN個のバッチを使い終わったところから再開するための状態
+        # consumedNはepochの最初から数えた数(再開前に使った分も含む．trainModelのiterationと同じ)
+        # (DataLoaderは先読みするため，何個使ったかは呼び出し側が渡す)
+        return {"batches": self.batches, "position": consumedN}
+
+    def setState(self, state):
+        # 次のiterでgetStateを呼んだところから再開する
+        self.resumeState = state
     
     def __len__(self):
         return self.len // self.batchSize
 
 
+class DistributedMyPSPBatchSampler(MyPSPBatchSampler):
+    # DistributedDataParallel用のMyPSPBatchSampler
+    # 全プロセスで同じseedからバッチの列を作り，rankごとに重ならないバッチのみを出力する
+    # 各rankのバッチ数は等しくなるようにする(そうしないとDDPが止まる)
+    def __init__(self, batchSize, fontGeneratorDataset: FontGeneratorDataset, rank, worldSize, japaneseRate = 0, seed = 0):
+        super().__init__(batchSize, fontGeneratorDataset, japaneseRate)
+        self.rank = rank
+        self.worldSize = worldSize
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # epochごとにシャッフルを変えるため，各epochの最初に呼ぶ
+        self.epoch = epoch
+
+    def getBatches(self):
+        # どのrankでも同じ列を作ってからrankで分ける
+        batches = self.makeBatches(random.Random(self.seed + self.epoch), self.__len__() * self.worldSize)
+        return batches[self.rank::self.worldSize]
+
+    def __len__(self):
+        return (self.len // self.batchSize) // self.worldSize
+
+
 class MyPSPAugmentation:
     ROTATE_LIMIT = 15
     TRANSLATE_LIMIT = 5
@@ -0,0 +1,116 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+import PIL.Image
+from .myFontLib import FontTools, CharacterChooser
+
+class GlyphStore:
+    # CharacterChooserが描画する文字画像を，あらかじめすべて描画して保存しておく
+    # 画像はuint8のグレースケールでメモリマップしたファイルに保存するため，複数のプロセスで読んでもメモリ(ページキャッシュ)は共有される
+    # path + ".bin" ... 画像 [slotN, H, W]
+    # path + ".npy" ... [フォント, 文字] -> 画像の位置．描画していなければ-1
+    # path + ".json" ... フォントと文字のリスト．最後に書くため，これがあれば作り終わっている
+    DATA_SUFFIX = ".bin"
+    INDEX_SUFFIX = ".npy"
+    META_SUFFIX = ".json"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + self.META_SUFFIX, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.fontIndex = {font: i for i, font in enumerate(meta["fonts"])}
+        self.charaIndex = {chara: i for i, chara in enumerate(meta["charas"])}
+        self.index = np.load(path + self.INDEX_SUFFIX)
+        self.shape = (meta["slotN"], CharacterChooser.CANVASSIZE[1], CharacterChooser.CANVASSIZE[0])
+        self.data = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    # pickleするとき(DataLoaderのworkerなど)はメモリマップを渡さず，各プロセスで開き直す
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["data"] = None
+        return state
+
+    def getArray(self, fontPath, text):
+        # 保存されていればuint8の画像 [H, W]，なければNone
+        fontInd = self.fontIndex.get(fontPath)
+        charaInd = self.charaIndex.get(text)
+        if(fontInd is None or charaInd is None):
+            return None
+        slot = self.index[fontInd, charaInd]
+        if(slot < 0):
+            return None
+        if(self.data is None):
+            self.data = np.memmap(self.path + self.DATA_SUFFIX, dtype=np.uint8, mode="r", shape=self.shape)
+        return np.array(self.data[slot])
+
+    def getImage(self, fontPath, text):
+        # CharacterChooser.renderImageと同じ形式(RGBのPIL.Image)で返す．なければNone
+        array = self.getArray(fontPath, text)
+        if(array is None):
+            return None
+        return PIL.Image.fromarray(array, "L").convert(CharacterChooser.IMAGEMODE)
+
+    def use(self):
+        # このプロセス(とここからforkするDataLoaderのworker)のCharacterChooserで使う
+        CharacterChooser.glyphStore = self
+        return self
+
+    @classmethod
+    def build(cls, path, compatibleDict, useKanji = False, extraCharas = "", processesN = None):
+        # compatibleDictの各フォントが対応している文字と，基準のフォント(MSゴシック体)の全ての文字を描画して保存する
+        # extraCharas ... 基準のフォントのみで描画する文字(MyPSPCharaDatasetの文字など)
+        # processesN ... 描画に使うプロセス数．Noneならコア数
+        fontTools = FontTools(useKanji)
+        charas = list(dict.fromkeys("".join(fontTools.fontCheckStrings) + "".join(extraCharas)))
+        fonts = [FontTools.STANDARDFONT] + [font for font in FontTools.getFontPathList() if font in compatibleDict]
+        charaIndex = {chara: i for i, chara in enumerate(charas)}
+        index = np.full((len(fonts), len(charas)), -1, dtype=np.int64)
+        tasks = []
+        slot = 0
+        for fontInd, font in enumerate(fonts):
+            if(fontInd == 0):
+                fontCharas = charas
+            else:
+                fontCharas = [chara for string, compatible in zip(fontTools.fontCheckStrings, compatibleDict[font])
+                    if compatible for chara in string]
+            slots = []
+            for chara in fontCharas:
+                index[fontInd, charaIndex[chara]] = slot
+                slots.append((slot, chara))
+                slot += 1
+            tasks.append((font, slots))
+
+        dirName = os.path.dirname(path)
+        if(dirName):
+            os.makedirs(dirName, exist_ok=True)
+        if(os.path.exists(path + cls.META_SUFFIX)):
+            os.remove(path + cls.META_SUFFIX)
+        shape = (slot, CharacterChooser.CANVASSIZE[1], CharacterChooser.CANVASSIZE[0])
+        np.memmap(path + cls.DATA_SUFFIX, dtype=np.uint8, mode="w+", shape=shape).flush()
+        with multiprocessing.get_context("spawn").Pool(processesN) as pool:
+            pool.map(renderGlyphs, [(path + cls.DATA_SUFFIX, shape, font, slots) for font, slots in tasks])
+        np.save(path + cls.INDEX_SUFFIX, index)
+        with open(path + cls.META_SUFFIX + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"fonts": fonts, "charas": charas, "slotN": slot}, f, ensure_ascii=False)
+        os.replace(path + cls.META_SUFFIX + ".tmp", path + cls.META_SUFFIX)
+        return cls(path)
+
+    @classmethod
+    def load(cls, path, compatibleDict = None, **buildArgs):
+        # 作ってあれば読み込み，なければcompatibleDictから作る
+        if(os.path.exists(path + cls.META_SUFFIX)):
+            return cls(path)
+        assert compatibleDict is not None, "glyph store {} is not built".format(path)
+        return cls.build(path, compatibleDict, **buildArgs)
+
+# GlyphStore.buildで1つのフォントの文字を描画するプロセス
+def renderGlyphs(task):
+    dataPath, shape, font, slots = task
+    data = np.memmap(dataPath, dtype=np.uint8, mode="r+", shape=shape)
+    for slot, chara in slots:
+        data[slot] = np.asarray(CharacterChooser.renderImage(font, chara).convert("L"))
+    data.flush()
@@ -2,8 +2,27 @@ import torch
 from torch.nn import functional as F
 import numpy as np
 import random
+import functools
 
 eps = 1e-7
+
+# autocast(bfloat16など)の中で呼ばれても，float32で計算させるデコレータ
+# 小さなepsやlogを使う損失関数はbfloat16だと値が潰れてしまうため
+def float32Forward(forward):
+    @functools.wraps(forward)
+    def wrapped(*args, **kwargs):
+        deviceType = None
+        for e in list(args) + list(kwargs.values()):
+            if(torch.is_tensor(e)):
+                deviceType = e.device.type
+                break
+        if(deviceType is None):
+            return forward(*args, **kwargs)
+        toFloat32 = lambda e: e.float() if(torch.is_tensor(e) and e.is_floating_point()) else e
+        with torch.autocast(device_type=deviceType, enabled=False):
+            return forward(*[toFloat32(e) for e in args], **{k: toFloat32(v) for k, v in kwargs.items()})
+    return wrapped
+
 def d_lsgan_loss(discriminator, trues, fakes, labels, alpha):
     d_trues = discriminator.forward(trues, labels, alpha)
     d_fakes = discriminator.forward(fakes, labels, alpha)
@@ -48,7 +67,10 @@ def d_wgan_loss(discriminator, d_trues, d_fakes, before,  trues, fakes,  teacher
 
     return loss, wd
 
-def d_wgan_loss2(discriminator,  before,  trues, fakes,  teachers, alpha, phase, useGradient = True, useBefore = True):
+# gpScale, gpBatchSize ... lazy regularization用．gradient penaltyをk stepに一度だけ計算するときは
+#   そのstepのみuseGradient = True, gpScale = kとする．gpBatchSizeを指定すると先頭のgpBatchSize個のみでpenaltyを計算する
+def d_wgan_loss2(discriminator,  before,  trues, fakes,  teachers, alpha, phase, useGradient = True, useBefore = True,
+        gpScale = 1, gpBatchSize = None):
     epsilon_drift = 1e-3
     lambda_gp = 1e-2 # 10
     loss_list = []
@@ -81,6 +103,11 @@ def d_wgan_loss2(discriminator,  before,  trues, fakes,  teachers, alpha, phase,
     # gradient penalty
     loss_gp = 0
     if(phase == "train" and useGradient):
+        if(gpBatchSize is not None and gpBatchSize < batch_size):
+            batch_size = gpBatchSize
+            fakes, trues, teachers = fakes[:batch_size], trues[:batch_size], teachers[:batch_size]
+            if(useBefore):
+                before = before[:batch_size]
         epsilon = torch.rand(batch_size, 1, 1, 1, dtype=fakes.dtype, device=fakes.device)
         intpl = epsilon * fakes + (1 - epsilon) * trues
         intpl.requires_grad_()
@@ -90,9 +117,10 @@ def d_wgan_loss2(discriminator,  before,  trues, fakes,  teachers, alpha, phase,
             f = discriminator.forward(intpl, teachers,  alpha)
         grad = torch.autograd.grad(f.sum(), intpl, create_graph=True)[0]
         del intpl, epsilon, f
-        grad_norm = grad.view(batch_size, -1).norm(dim=1)
+        grad_norm = grad.reshape(batch_size, -1).norm(dim=1)
         loss_gp = lambda_gp * ((grad_norm - 1) ** 2).mean()
         loss_list.append(loss_gp.item())
+        loss_gp = gpScale * loss_gp
     else:
         loss_list.append(loss_gp)
 
@@ -130,6 +158,7 @@ def g_logistic_loss(discriminator, fakes, labels, alpha):
 
 
 # 二値でないラベルにも対応したクロスエントロピー
+@float32Forward
 def myCrossE(out, labels):
     a = labels * torch.log(out + eps)
     b = (1.0-labels) * torch.log(1.0 - out + eps)
@@ -0,0 +1,136 @@
+import os
+import json
+import random
+import numpy as np
+import torch
+from .myFontData import FontGeneratorDataset
+
+class FakesReplayBuffer:
+    # Discriminatorの再訓練用に，過去のGeneratorの出力を保存しておくバッファ
+    # 画像はuint8でメモリマップしたファイルに保存するため，再起動しても残り，全体を読み込む必要もない
+    # 1サンプルは [before, after, fakes, teachers(teachersN枚)] の画像で，いずれも[0, 1]の画素値を255倍して保存する
+    # mode ... "fifo" (古いものから上書き) か "reservoir" (これまでに追加された全サンプルから一様に残す)
+    MODES = ["fifo", "reservoir"]
+    DATA_SUFFIX = ".bin"
+    META_SUFFIX = ".json"
+
+    def __init__(self, path, capacity, teachersN, mode = "reservoir", imageWH = FontGeneratorDataset.IMAGE_WH):
+        # path ... 保存先．path + ".bin"に画像, path + ".json"にサイズなどを保存する
+        # capacity ... 保存するサンプル数の上限
+        # teachersN ... 1サンプルあたりに保存するteacherの数の上限
+        assert mode in self.MODES, "mode must be one of {}".format(self.MODES)
+        self.path = path
+        self.capacity = capacity
+        self.teachersN = teachersN
+        self.mode = mode
+        self.imageWH = imageWH
+        self.shape = (capacity, 3 + teachersN, imageWH, imageWH)
+        self.random = random.Random()
+
+        self.size = 0 # 保存されているサンプル数
+        self.next = 0 # fifoで次に書き込む位置
+        self.seenN = 0 # reservoirで，これまでに追加されたサンプル数
+        self.teachersNList = np.zeros((capacity, ), dtype=np.int64) # 各サンプルの実際のteacherの数
+        dataPath = path + self.DATA_SUFFIX
+        fileMode = "w+"
+        if(os.path.exists(dataPath) and self.loadMeta()):
+            fileMode = "r+"
+        else:
+            dirName = os.path.dirname(dataPath)
+            if(dirName):
+                os.makedirs(dirName, exist_ok=True)
+        self.data = np.memmap(dataPath, dtype=np.uint8, mode=fileMode, shape=self.shape)
+
+    def __len__(self):
+        return self.size
+
+    def loadMeta(self):
+        # 保存されたメタデータを読み込む．形が違えば読み込まずFalseを返す
+        metaPath = self.path + self.META_SUFFIX
+        if(not os.path.exists(metaPath)):
+            return False
+        with open(metaPath, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if(tuple(meta["shape"]) != self.shape):
+            return False
+        self.size = meta["size"]
+        self.next = meta["next"]
+        self.seenN = meta["seenN"]
+        self.teachersNList = np.array(meta["teachersNList"], dtype=np.int64)
+        return True
+
+    def flush(self):
+        # 書き込んだ画像をファイルに反映し，メタデータを保存する
+        # メタデータは一時ファイルに書いてから置き換えるため，途中で落ちても壊れない
+        self.data.flush()
+        metaPath = self.path + self.META_SUFFIX
+        meta = {"shape": list(self.shape), "mode": self.mode, "size": self.size, "next": self.next,
+            "seenN": self.seenN, "teachersNList": self.teachersNList.tolist()}
+        with open(metaPath + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(metaPath + ".tmp", metaPath)
+
+    @classmethod
+    def quantize(cls, images):
+        # 正規化された画像 -> uint8
+        images = images.detach().float() * FontGeneratorDataset.IMAGE_VAR + FontGeneratorDataset.IMAGE_MEAN
+        return (images.clamp(0, 1) * 255).round().to(torch.uint8).cpu().numpy()
+
+    @classmethod
+    def dequantize(cls, images, device = "cpu"):
+        # uint8 -> 正規化された画像
+        images = torch.from_numpy(images).to(device, torch.float32) / 255
+        return (images - FontGeneratorDataset.IMAGE_MEAN) / FontGeneratorDataset.IMAGE_VAR
+
+    def getSlot(self):
+        # 次のサンプルを書き込む位置．reservoirで捨てるサンプルならNone
+        if(self.mode == "fifo"):
+            slot = self.next
+            self.next = (self.next + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            return slot
+        self.seenN += 1
+        if(self.size < self.capacity):
+            self.size += 1
+            return self.size - 1
+        slot = self.random.randrange(self.seenN)
+        return slot if slot < self.capacity else None
+
+    def add(self, beforeCharacter, afterCharacter, fakes, teachers):
+        # minibatchを追加する
+        # beforeCharacter, afterCharacter, fakes ... [B, 1, WH, WH]
+        # teachers ... [B, teachersN, 1, WH, WH]
+        teachersN = min(teachers.shape[1], self.teachersN)
+        slots = []
+        batchInds = []
+        for i in range(beforeCharacter.shape[0]):
+            slot = self.getSlot()
+            if(slot is not None):
+                slots.append(slot)
+                batchInds.append(i)
+        if(len(slots) == 0):
+            return
+        images = torch.cat([beforeCharacter[batchInds], afterCharacter[batchInds], fakes[batchInds],
+            teachers[batchInds, :teachersN, 0]], dim=1)
+        images = self.quantize(images)
+        # reservoirでは同じ位置に2回書き込むことがあるため，後のものを残す
+        order = {slot: i for i, slot in enumerate(slots)}
+        slots = sorted(order)
+        images = images[[order[slot] for slot in slots]]
+        self.data[slots, :3 + teachersN] = images
+        self.teachersNList[slots] = teachersN
+
+    def sample(self, batchSize, device = "cpu"):
+        # ランダムにminibatchを取り出す．読み込むのは選んだサンプルのみ
+        # 返り値 [beforeCharacter, afterCharacter, fakes, teachers] (addと同じ形)
+        batchSize = min(batchSize, self.size)
+        slots = sorted(self.random.sample(range(self.size), batchSize))
+        teachersN = int(self.teachersNList[slots].min())
+        images = self.dequantize(np.ascontiguousarray(self.data[slots, :3 + teachersN]), device)
+        images = images.unsqueeze(2)
+        return [images[:, 0], images[:, 1], images[:, 2], images[:, 3:]]
+
+    def addBackLogFile(self, path, key = "data"):
+        # 以前の形式(minibatchのリストをtorch.saveしたもの)のファイルを追加する
+        for data in torch.load(path)[key]:
+            self.add(*data)
@@ -0,0 +1,165 @@
+from .myTrain import *
+from .myGlyphStore import GlyphStore
+import csv
+import itertools
+
+# ハイパーパラメータの探索を，1台のマシンで複数のプロセスに分けて並列に行う
+# 各trialはCPUのコアを分け合い(CPU affinity)，文字画像はあらかじめ描画した1つのGlyphStoreを共有する
+# 検証のlossがよくないtrialは途中で止め，結果は1つの表(sweepDir/results.csv)にまとめる
+
+GLYPH_STORE_PATH = "cpts/glyph_store"
+SWEEP_DIR = "cpts/sweep"
+SWEEP_METRIC = "g_loss" # 比較に使う検証のloss (runEpochの返り値のキー)
+# 全trialに共通の設定．事前訓練済みのcheckpointFileからモデルのみを引き継ぐ
+SWEEP_BASE_SETTINGS = {"epochN": 30, "inheritOnlyModel": True, "workers": 1}
+
+# spaceの組み合わせからtrialの設定のリストを作る．trialsNを指定すればその数だけランダムに選ぶ
+# (例) getTrialSettings({"DforGFactor": [20, 40], "d_dropout": [0.9, 0.925]})
+def getTrialSettings(space, trialsN = None, seed = 0):
+    keys = list(space)
+    trials = [dict(zip(keys, values)) for values in itertools.product(*[space[key] for key in keys])]
+    if(trialsN is not None and trialsN < len(trials)):
+        trials = random.Random(seed).sample(trials, trialsN)
+    return trials
+
+# 各trialにコアを分ける．連続したコアをまとめて渡す
+def getCPUGroups(parallelN):
+    if(hasattr(os, "sched_getaffinity")):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    return [[int(cpu) for cpu in group] for group in np.array_split(cpus, parallelN) if len(group) > 0]
+
+# trialを止めるかを判定する
+# losses ... このtrialの各epochの検証のloss
+# otherBests ... 他のtrialがこのtrialと同じepochまでに出した最良のloss
+# minEpochs epochまでは止めない．その後，patience epoch改善しないか，最良のlossが他のtrialの中央値より悪ければ止める
+def shouldStopTrial(losses, otherBests, minEpochs = 3, patience = 5):
+    if(len(losses) <= minEpochs):
+        return False
+    best = min(losses)
+    if(len(losses) - 1 - losses.index(best) >= patience):
+        return True
+    return len(otherBests) > 0 and best > float(np.median(otherBests))
+
+# 1つのtrialを訓練するプロセス
+# 各epochの検証のlossを(trialId, epoch, loss)としてreportQueueに送り，stopEventが立てば止める
+def runTrial(trialId, settings, cpus, glyphStorePath, reportQueue, stopEvent):
+    from torch.utils.tensorboard import SummaryWriter
+    if(hasattr(os, "sched_setaffinity")):
+        os.sched_setaffinity(0, cpus)
+    settings = getTrainSettings(**settings)
+    torch.set_num_threads(len(cpus))
+    torch.manual_seed(settings["seed"])
+    random.seed(settings["seed"])
+    np.random.seed(settings["seed"])
+    if(glyphStorePath is not None):
+        # DataLoaderのworkerはこのプロセスからforkされるため，同じGlyphStoreを使う
+        GlyphStore(glyphStorePath).use()
+    device = torch.device("cpu")
+
+    forUnderTraining = settings["forCharaTraining"] or settings["forStyleTraining"]
+    trainCharaDis = settings["forCharaTraining"]
+    models = buildModels(settings)
+    for model in models:
+        model.to(device)
+    optimizers = getOptimizers(models, settings["forCharaTraining"], trainCharaDis, torch.optim.AdamW, settings["optimizer_d_lr"])
+    setSpectralNormInterval(models, optimizers, settings["snInterval"])
+    start = loadCheckpoints(settings["checkpointFile"], models, optimizers, "", "", settings["inheritOnlyModel"], forUnderTraining,
+        trainCharaDis)
+    dataLoaders = getDataLoaders(settings)
+    writer = AsyncSummaryWriter(SummaryWriter(log_dir=settings["logDir"]))
+    trainState = initTrainState(settings, device)
+    epoch = start
+    for epoch in range(start, settings["epochN"]):
+        results = runEpoch(models, optimizers, dataLoaders, device, epoch, settings, trainState, writer)
+        updateTrainRate(trainState, models[1], epoch, settings)
+        reportQueue.put((trialId, epoch, results["val"][SWEEP_METRIC]))
+        if(stopEvent.is_set()):
+            break
+    checkpointWriter = CheckpointWriter(settings["checkpointFormat"])
+    checkpointWriter.save(getCheckpoint(models, optimizers, epoch, trainCharaDis), epoch)
+    checkpointWriter.close()
+    writer.close()
+
+# spaceの各組み合わせを訓練し，結果の表(lossの良い順のdictのリスト)を返す
+# baseSettings ... 全trialに共通の設定(DEFAULT_TRAIN_SETTINGSのうち変更するもの)
+# parallelN ... 同時に訓練するtrialの数．Noneならコア4つに1つ
+# glyphStorePath ... 共有する文字画像．なければ作る．Noneなら使わない(各プロセスで描画する)
+# (例) sweep({"DforGFactor": [20, 40], "styleLossFactor": [2, 5]}, {"checkpointFile": "cpts/pretrained.cpt"}, parallelN=4)
+def sweep(space, baseSettings = None, parallelN = None, trialsN = None, sweepDir = SWEEP_DIR,
+    glyphStorePath = GLYPH_STORE_PATH, minEpochs = 3, patience = 5, seed = 0):
+    trials = getTrialSettings(space, trialsN, seed)
+    baseSettings = dict(SWEEP_BASE_SETTINGS, **(baseSettings or {}))
+    if(parallelN is None):
+        parallelN = max(1, (os.cpu_count() or 1) // 4)
+    freeGroups = getCPUGroups(min(parallelN, len(trials)))
+    # メモリは同時に動くtrialで分け合う
+    baseSettings = dict({"memoryProcessN": len(freeGroups)}, **baseSettings)
+    if(glyphStorePath is not None):
+        GlyphStore.load(glyphStorePath, loadFontInfo()[0], useKanji=getTrainSettings(**baseSettings)["useKanji"],
+            extraCharas=loadCharaList())
+
+    context = mp.get_context("spawn")
+    reportQueue = context.Queue()
+    pending = list(enumerate(trials))
+    running = {} # trialId -> [process, cpus, stopEvent]
+    history = {trialId: [] for trialId in range(len(trials))}
+    stoppedEarly = set()
+    exitCodes = {}
+
+    def receive(report):
+        trialId, epoch, loss = report
+        history[trialId].append(loss)
+        if(trialId in running and trialId not in stoppedEarly):
+            epochN = len(history[trialId])
+            otherBests = [min(losses[:epochN]) for otherId, losses in history.items()
+                if otherId != trialId and len(losses) >= epochN]
+            if(shouldStopTrial(history[trialId], otherBests, minEpochs, patience)):
+                running[trialId][2].set()
+                stoppedEarly.add(trialId)
+        print("trial {} epoch {} || {}: {:.4f}".format(trialId, epoch, SWEEP_METRIC, loss))
+
+    while pending or running:
+        while pending and freeGroups:
+            trialId, params = pending.pop(0)
+            cpus = freeGroups.pop(0)
+            trialDir = os.path.join(sweepDir, "trial{}".format(trialId))
+            settings = dict(baseSettings, **params)
+            settings.update({"checkpointFormat": os.path.join(trialDir, "output{}.cpt"), "logDir": os.path.join(trialDir, "logs")})
+            stopEvent = context.Event()
+            process = context.Process(target=runTrial, args=(trialId, settings, cpus, glyphStorePath, reportQueue, stopEvent))
+            process.start()
+            running[trialId] = [process, cpus, stopEvent]
+        try:
+            receive(reportQueue.get(timeout=1))
+        except queue.Empty:
+            pass
+        for trialId in [trialId for trialId, (process, _, _) in running.items() if not process.is_alive()]:
+            process, cpus, _ = running.pop(trialId)
+            process.join()
+            exitCodes[trialId] = process.exitcode
+            freeGroups.append(cpus)
+    while True:
+        try:
+            receive(reportQueue.get(timeout=1))
+        except queue.Empty:
+            break
+
+    table = []
+    for trialId, params in enumerate(trials):
+        losses = history[trialId]
+        row = {"trial": trialId}
+        row.update(params)
+        row.update({"epochs": len(losses), "best_" + SWEEP_METRIC: min(losses) if losses else np.nan,
+            "best_epoch": losses.index(min(losses)) if losses else -1, "last_" + SWEEP_METRIC: losses[-1] if losses else np.nan,
+            "stopped_early": trialId in stoppedEarly, "exit_code": exitCodes.get(trialId)})
+        table.append(row)
+    table.sort(key=lambda row: (np.isnan(row["best_" + SWEEP_METRIC]), row["best_" + SWEEP_METRIC]))
+    os.makedirs(sweepDir, exist_ok=True)
+    with open(os.path.join(sweepDir, "results.csv"), "w", encoding="utf-8", newline="") as f:
+        csvWriter = csv.DictWriter(f, fieldnames=list(table[0]))
+        csvWriter.writeheader()
+        for row in table:
+            csvWriter.writerow({key: str(value) if isinstance(value, list) else value for key, value in row.items()})
+    return table
@@ -2,10 +2,24 @@ from .mypSp import *
 from .myFontLib import *
 from .myFontData import *
 from .myLoss import *
+from .myReplayBuffer import *
 import random
 import time
 import gc
 import shutil
+import os
+import queue
+import threading
+import traceback
+import contextlib
+import copy
+import itertools
+import pickle
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from EfficientNet.utils import use_amortized_spectral_norm
 
 GENERATOR_NAME = "style_gen"
 ENCODER_CONV_NAME = "encode_convs"
@@ -164,81 +178,317 @@ def getOptimizers(models, forCharaTraining, trainCharaDis, d_optimFun, optimizer
 
     return optimizer, optimizer_d, optimizer_styleDis, optimizer_charaDis 
 
+# spectral normのsigmaを，各モデルのoptimizerのinterval回のstepごとに更新するようにする(AmortizedSpectralNorm)
+# 間のforward(Dの3回の呼び出し，teacherごとのstyle_encoderなど)は同じu, vを使う．intervalがNoneなら何もしない
+def setSpectralNormInterval(models, optimizers, interval):
+    if(interval is None):
+        return
+    for model, optimizer in zip(models, optimizers):
+        if(model is not None):
+            use_amortized_spectral_norm(unwrapModel(model), optimizer, interval)
+
 
 FAKES_BACK_LOG_PATH = "cpts/fakes_back_log"
 FAKES_BACK_LOG_PATH_BODY = "cpts/backlog/fakes_back_log{}"
 FAKES_BACK_LOG_N = 40
 FAKES_BACK_LOG_KEY = "data"
+FAKES_REPLAY_PATH = "cpts/fakes_replay"
+FAKES_REPLAY_CAPACITY = 640
+FAKES_REPLAY_TEACHERS_N = 3
+FAKES_REPLAY_BATCH_N = 20 # 1 epochで再訓練に使うminibatchの数
+
+# 以前の形式のBackLogがあれば取り込んだReplayBufferを得る
+def getFakesReplayBuffer(mode = "reservoir"):
+    replayBuffer = FakesReplayBuffer(FAKES_REPLAY_PATH, FAKES_REPLAY_CAPACITY, FAKES_REPLAY_TEACHERS_N, mode)
+    if(len(replayBuffer) == 0):
+        for i in range(FAKES_BACK_LOG_N):
+            path = FAKES_BACK_LOG_PATH_BODY.format(i)
+            if(os.path.exists(path)):
+                replayBuffer.addBackLogFile(path, FAKES_BACK_LOG_KEY)
+        replayBuffer.flush()
+    return replayBuffer
+
+# メモリの予算を管理する
+# 段階(stage)ごとに，Discriminatorに入れた画像1枚あたりのピークメモリを測り，
+# 予算に収まる最大のminibatch, teacherの数を選ぶ．gc, empty_cacheは使用量が予算に近いときのみ行う
+# CPUではピークを取得できないため，stageの間だけ別スレッドでRSSを読んで最大値をとる
+class MemoryBudget:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def __init__(self, device, budgetRate = 0.9, collectRate = 0.85, budgetBytes = None, minTeachersN = 2,
+            firstSize = (2, 3), sampleIntervalSec = 0.002, minCollectIntervalSec = 5, processN = 1):
+        # budgetRate ... 全メモリのうち予算とする割合．budgetBytesが指定されればそちらを使う
+        # processN ... 同じメモリを同時に使う訓練のプロセス数(DDPのworldSizeなど)．予算はその数で割る
+        # collectRate ... 予算のうち，この割合を超えたらgc, empty_cacheをする
+        # minTeachersN ... teacherの数はこれより小さくしない
+        # firstSize ... まだ測定していない段階で使う(minibatch, teacherの数)．以前の固定値
+        # sampleIntervalSec ... CPUでstageの間にRSSを読む間隔
+        # minCollectIntervalSec ... gcを続けて行う最小の間隔
+        self.device = torch.device(device)
+        self.useCuda = self.device.type == "cuda"
+        if(budgetBytes is None):
+            budgetBytes = budgetRate * self.getTotalBytes() / max(1, processN)
+        self.budgetBytes = budgetBytes
+        self.collectBytes = collectRate * budgetBytes
+        self.minTeachersN = minTeachersN
+        self.firstSize = firstSize
+        self.bytesPerImage = {} # stage -> 画像1枚あたりのピークメモリ
+        self.collectN = 0
+        self.startBytes = None
+        self.sampleIntervalSec = sampleIntervalSec
+        self.minCollectIntervalSec = minCollectIntervalSec
+        # gcしても減らなかったときに，すぐに再びgcしないための閾値(ヒステリシス)
+        self.nextCollectBytes = self.collectBytes
+        self.lastCollectTime = None
+        self.peakBytes = 0
+        self.stopSampling = threading.Event()
+        self.samplerThread = None
+    
+    def getTotalBytes(self):
+        if(self.useCuda):
+            return torch.cuda.get_device_properties(self.device).total_memory
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError, AttributeError):
+            return float("inf")
+
+    def getUsedBytes(self):
+        # 現在の使用量．CPUではプロセスのRSS
+        if(self.useCuda):
+            return torch.cuda.memory_allocated(self.device)
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self.PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def getPeakBytes(self):
+        # startStageからのピーク．CPUではsampleで読んだRSSの最大値
+        if(self.useCuda):
+            return torch.cuda.max_memory_allocated(self.device)
+        return max(self.peakBytes, self.getUsedBytes())
+
+    def sample(self):
+        # stageの間(stopSamplingが立つまで)，RSSを読んでpeakBytesを更新するスレッド
+        while not self.stopSampling.is_set():
+            used = self.getUsedBytes()
+            if(used > self.peakBytes):
+                self.peakBytes = used
+            self.stopSampling.wait(self.sampleIntervalSec)
+
+    def startStage(self):
+        self.startBytes = self.getUsedBytes()
+        if(self.useCuda):
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return
+        self.peakBytes = self.startBytes
+        self.stopSampling.clear()
+        self.samplerThread = threading.Thread(target=self.sample, daemon=True)
+        self.samplerThread.start()
+
+    def endStage(self, stage, minibatchN, teachersN):
+        # minibatchN個のデータ(teacherはteachersN個)でstageを行ったときのピークを記録する
+        imageN = minibatchN * (teachersN + 2)
+        if(self.samplerThread is not None):
+            self.stopSampling.set()
+            self.samplerThread.join()
+            self.samplerThread = None
+        used = self.getPeakBytes() - self.startBytes
+        self.startBytes = None
+        if(imageN <= 0):
+            return
+        # 使用量が増えなければ，既に確保されたメモリに収まったため，小さい値を記録して次はより大きくする
+        used = max(used, self.PAGE_SIZE)
+        perImage = used / imageN
+        # 測定ごとのばらつきがあるため，大きい方に寄せる
+        self.bytesPerImage[stage] = max(perImage, 0.9 * self.bytesPerImage.get(stage, 0))
+    
+    def getDiscriminatorSize(self, stage, minibatchN, teachersN):
+        # 予算に収まる最大の(minibatch, teacherの数)を返す．minibatchを優先して大きくする
+        minTeachersN = min(self.minTeachersN, teachersN)
+        if(stage not in self.bytesPerImage):
+            return min(minibatchN, self.firstSize[0]), min(teachersN, max(self.firstSize[1], minTeachersN))
+        available = self.budgetBytes - self.getUsedBytes()
+        maxImageN = available / self.bytesPerImage[stage]
+        for b in range(minibatchN, 0, -1):
+            t = min(teachersN, int(maxImageN / b) - 2)
+            if(t >= minTeachersN):
+                return b, t
+        return 1, minTeachersN
+
+    def getReservedBytes(self):
+        return torch.cuda.memory_reserved(self.device) if self.useCuda else self.getUsedBytes()
+
+    def collectIfNeeded(self):
+        # 使用量が予算に近いときのみgc, empty_cacheを行う
+        # gcしても使用量がcollectBytesより下がらなければ，そこから予算までの半分増えるまで(または予算を超えるまで)行わない
+        # また，minCollectIntervalSec秒以内には続けて行わない
+        used = self.getReservedBytes()
+        if(used < self.collectBytes):
+            self.nextCollectBytes = self.collectBytes
+            return False
+        if(used < self.nextCollectBytes and used < self.budgetBytes):
+            return False
+        if(self.lastCollectTime is not None and time.time() - self.lastCollectTime < self.minCollectIntervalSec):
+            return False
+        gc.collect()
+        if(self.useCuda):
+            torch.cuda.empty_cache()
+        self.collectN += 1
+        self.lastCollectTime = time.time()
+        used = self.getReservedBytes()
+        self.nextCollectBytes = max(self.collectBytes, used + 0.5 * (self.budgetBytes - self.collectBytes))
+        return True
 
 # BackLogを使っての訓練
-def trainWithBackLog(phase, device, D, optimizer_d, noiseP, useWSGradient ):
+# gpInterval, gpBatchSize ... d_wgan_loss2のlazy regularizationの設定．gradient penaltyはgpInterval stepに一度のみ計算する
+def trainWithBackLog(phase, device, D, optimizer_d, noiseP, useWSGradient, replayBuffer, batchSize, memoryBudget = None,
+        gpInterval = 1, gpBatchSize = None):
     discriminator_problems_n_b = 0
     discriminator_correct_n_b = 0 
+    if(memoryBudget is None):
+        memoryBudget = MemoryBudget(device)
     print("BackLog")
-    # どれからロードするか決定
-    nowFakesBackInd = random.randint(0, FAKES_BACK_LOG_N-1)
-    nowFakesBackPath = FAKES_BACK_LOG_PATH_BODY.format(nowFakesBackInd)
-    fakesBackLog = torch.load(nowFakesBackPath)[FAKES_BACK_LOG_KEY]
-    initFakesBackLogLen = len(fakesBackLog)
+    batchN = min(FAKES_REPLAY_BATCH_N, len(replayBuffer) // batchSize)
 
     for i_ in range(1):
         epochDLoss = 0
         iteration = 0
-        for i in range(initFakesBackLogLen):
-            if(random.random() < 0.5):
-                continue
-            data = fakesBackLog[i]
+        for i in range(batchN):
+            data = replayBuffer.sample(batchSize, device)
             minibatch_size = data[0].size()[0]
             # label_fake = (torch.zeros((minibatch_size, )) + 0.3 * torch.rand((minibatch_size, )) ).to(device)
-            beforeCharacter = data[0].to(device, non_blocking=True)
-            afterCharacter = data[1].to(device, non_blocking=True)
-            fakes = data[2]
-            teachers = data[3] # ver=4から差分をとらない
-            fakes = fakes.to(device, non_blocking=True)
-            teachers = teachers.to(device, non_blocking=True)
-            beforeCharacter, afterCharacter, fakes, teachers = MyPSPAugmentation.getNoisedImages([beforeCharacter, afterCharacter, fakes, teachers], noiseP, device)
+            beforeCharacter, afterCharacter, fakes, teachers = MyPSPAugmentation.getNoisedImages(data, noiseP, device)
             alpha = torch.ones((1, 1))
             alpha = alpha.to(device, torch.float32, non_blocking=True)
 
-            if(minibatch_size > 2):
-                # ここでメモリをよく使うため，minibatchを小さくしておく
-                if(useWSGradient):
-                    if(minibatch_size > 2):
-                        minibatch_size = 2
-                    else:
-                        minibatch_size = 1
-                    if(teachers.shape[1] > 3):
-                        teachers = teachers[:, : 2]
-                else:
-                    minibatch_size = 4
-                # beforeCharacterN = beforeCharacterN[:minibatch_size]
-                fakes = fakes[:minibatch_size]
-                afterCharacter = afterCharacter[:minibatch_size]
-                teachers = teachers[:minibatch_size]
-                
-                with torch.set_grad_enabled(True):
-
-                    d_loss_back, discCorrectN_b, lossList_b, tcorrect_b, fcorrect_b = d_wgan_loss2(D, None, afterCharacter,\
-                    fakes, teachers, alpha, phase, useGradient=useWSGradient, useBefore=False)
-                    
-                    # Discriminator loss
-                    epochDLoss += d_loss_back.item()
-                    d_loss_back.backward()
-                    optimizer_d.step()
-                    optimizer_d.zero_grad()
+            # ここでメモリをよく使うため，予算に収まるようにminibatch, teacherの数を決める
+            useGradient = useWSGradient and iteration % gpInterval == 0
+            stage = "DBackLog" if useGradient else "DBackLogNoGP"
+            minibatch_size, teachersN = memoryBudget.getDiscriminatorSize(stage, minibatch_size, teachers.shape[1])
+            # beforeCharacterN = beforeCharacterN[:minibatch_size]
+            fakes = fakes[:minibatch_size]
+            afterCharacter = afterCharacter[:minibatch_size]
+            teachers = teachers[:minibatch_size, :teachersN]
+            
+            with torch.set_grad_enabled(True):
+                memoryBudget.startStage()
+                d_loss_back, discCorrectN_b, lossList_b, tcorrect_b, fcorrect_b = d_wgan_loss2(D, None, afterCharacter,\
+                fakes, teachers, alpha, phase, useGradient=useGradient, useBefore=False, gpScale=gpInterval, gpBatchSize=gpBatchSize)
                 
-                    discriminator_problems_n_b += minibatch_size*2
-                    discriminator_correct_n_b +=  discCorrectN_b
-                    
-                    del beforeCharacter, afterCharacter, teachers, fakes, data, minibatch_size, alpha, d_loss_back, discCorrectN_b, lossList_b, tcorrect_b, fcorrect_b
+                # Discriminator loss
+                epochDLoss += d_loss_back.item()
+                d_loss_back.backward()
+                optimizer_d.step()
+                optimizer_d.zero_grad()
+                memoryBudget.endStage(stage, minibatch_size, teachersN)
+            
+                discriminator_problems_n_b += minibatch_size*2
+                discriminator_correct_n_b +=  discCorrectN_b
                 
-                # gc.collect()
-                # torch.cuda.empty_cache()
-            print("\riter {:4}/{}".format(iteration ,len(fakesBackLog)-1), end="")
+                del beforeCharacter, afterCharacter, teachers, fakes, data, minibatch_size, alpha, d_loss_back, discCorrectN_b, lossList_b, tcorrect_b, fcorrect_b
+            
+            memoryBudget.collectIfNeeded()
+            print("\riter {:4}/{}".format(iteration ,batchN-1), end="")
             iteration += 1
-    if(initFakesBackLogLen > 0 and discriminator_problems_n_b > 0):
+    if(batchN > 0 and discriminator_problems_n_b > 0):
         print("BackLog correct rate = {:4}".format(discriminator_correct_n_b / discriminator_problems_n_b))
-    return epochDLoss, fakesBackLog, nowFakesBackPath, [discriminator_problems_n_b, discriminator_correct_n_b]
+    return epochDLoss, [discriminator_problems_n_b, discriminator_correct_n_b]
+
+# tensorboardへの出力をバックグラウンドで行うwriter
+# SummaryWriterと同様に使える．tensorはdetachしてCPUにコピーしたものを別スレッドに渡し，そこでSummaryWriterに書き込む
+# ヒストグラムはmaxHistogramN個に間引いてからコピーする(Noneなら間引かない)
+# scalar以外の出力はintervalSec秒ごとにmaxItemsPerInterval個まで(Noneなら制限なし)で，超えた分は捨てる
+class AsyncSummaryWriter:
+    SCALAR_METHODS = ["add_scalar", "add_scalars"]
+
+    def __init__(self, writer, maxHistogramN = None, maxItemsPerInterval = None, intervalSec = 60, maxQueueN = 256):
+        self.writer = writer
+        self.maxHistogramN = maxHistogramN
+        self.maxItemsPerInterval = maxItemsPerInterval
+        self.intervalSec = intervalSec
+        self.intervalStart = time.time()
+        self.intervalItemN = 0
+        self.droppedN = 0 # 予算を超えたり，queueが一杯だったりして捨てた数
+        self.error = None
+        self.queue = queue.Queue(maxQueueN)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def snapshot(cls, obj, maxN = None):
+        # tensorをdetachしてCPUにコピーする．bfloat16などはfloat32にする
+        if(isinstance(obj, torch.Tensor)):
+            obj = obj.detach()
+            if(maxN is not None and obj.numel() > maxN):
+                obj = obj.flatten()[::-(-obj.numel() // maxN)]
+            if(obj.is_floating_point()):
+                return obj.to("cpu", torch.float32, copy=True)
+            return obj.to("cpu", copy=True)
+        return obj
+
+    def isInBudget(self):
+        if(self.maxItemsPerInterval is None):
+            return True
+        now = time.time()
+        if(now - self.intervalStart > self.intervalSec):
+            self.intervalStart = now
+            self.intervalItemN = 0
+        if(self.intervalItemN >= self.maxItemsPerInterval):
+            return False
+        self.intervalItemN += 1
+        return True
+
+    def put(self, method, args, kwargs):
+        if(self.error is not None):
+            error = self.error
+            self.error = None
+            raise error
+        isScalar = method in self.SCALAR_METHODS
+        if(not isScalar and not self.isInBudget()):
+            self.droppedN += 1
+            return
+        maxN = self.maxHistogramN if method == "add_histogram" else None
+        args = [self.snapshot(e, maxN) for e in args]
+        kwargs = {key: self.snapshot(value, maxN) for key, value in kwargs.items()}
+        if(isScalar):
+            self.queue.put((method, args, kwargs))
+            return
+        try:
+            self.queue.put_nowait((method, args, kwargs))
+        except queue.Full:
+            self.droppedN += 1
+
+    def __getattr__(self, name):
+        # add_scalar, add_histogram, add_imagesなどをqueueに入れる関数にする
+        if(name.startswith("add_")):
+            return lambda *args, **kwargs: self.put(name, args, kwargs)
+        raise AttributeError(name)
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if(task is None):
+                    return
+                method, args, kwargs = task
+                getattr(self.writer, method)(*args, **kwargs)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # queueにあるものをすべて書き込む
+        self.queue.join()
+        self.writer.flush()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
 
 # 中間層出力用の関数を得る
 def getIntermidiateHandlers(genIntermidiateList, disIntermidiateList, writer, iteration, epoch, \
@@ -266,16 +516,22 @@ def getIntermidiateHandlers(genIntermidiateList, disIntermidiateList, writer, it
                 handles.append(handle)
     return Dhandles, Ghandles
 
+# chara_encoderの訓練で使う損失関数(パラメータを持たないので，一度だけ作って使い回す)
+CHARA_TRAINING_LOSS = MyPSPLoss(onSharp=0, rareP=4, separateN=8, hingeLoss=0)
+
 # Generatorに順伝播させる関数
+# featureCache, charaKeys ... 訓練しないchara_encoderの出力をキャッシュするとき(main stage)に渡す
+#   charaKeysは各データの文字のリスト．chara_encoderへの入力はMSゴシック体なので，文字のみで決まる
 def forwardG(myPSP, styleDis, charaDis, charaDisLoss, beforeCharacter, teachers, afterCharacter,\
             alpha, styleLabel, GLossDict, factors, \
-            forCharaTraining, forStyleTraining):
+            forCharaTraining, forStyleTraining, featureCache = None, charaKeys = None):
     SquareLossFactor, fakeRawFactor, styleLossFactor, charaDisFactor = factors
     featureT = fakes = None
     iterGLoss = 0
     if(forCharaTraining):
         featureT, fakeRaw, fakes = myPSP(beforeCharacter, None, alpha)
-        iterGLoss = SquareLossFactor* MyPSPLoss(onSharp=0, rareP=4, separateN=8, hingeLoss=0)(fakes, beforeCharacter)
+        # nativeResolutionなら，エンコーダに入力した256の画像を縮小して比べる
+        iterGLoss = SquareLossFactor* CHARA_TRAINING_LOSS(fakes, matchResolution(beforeCharacter, fakes.shape[-1]))
         iterMLoss = iterGLoss.item()
         GLossDict["M"] +=  iterMLoss
         fakeRaw = fakeRaw ** 2
@@ -288,7 +544,7 @@ def forwardG(myPSP, styleDis, charaDis, charaDisLoss, beforeCharacter, teachers,
         featureT = featureT.detach()
     elif(forStyleTraining):
         featureT, style, fakeRaw,  fakes = myPSP(beforeCharacter, teachers, alpha)
-        del featureT, fakeRaw
+        del fakeRaw
         styleOut, rawStyleOut = styleDis(style)
         styleOut = styleLossFactor * (myCrossE(styleOut,styleLabel) + 0.001 * (((((rawStyleOut > 2.0) + (rawStyleOut < -2.0)) * rawStyleOut) ** 2).mean()))
         iterGLoss = iterGLoss + styleOut
@@ -297,12 +553,19 @@ def forwardG(myPSP, styleDis, charaDis, charaDisLoss, beforeCharacter, teachers,
         GLossDict["R"] += iterGLoss.item() - styleOut.item()
         del style
     else:
-        featureT, style, fakeRaw,  fakes = myPSP(beforeCharacter, teachers, alpha)
+        charaFeatures = None
+        if(featureCache is not None and charaKeys is not None):
+            charaFeatures = featureCache.getFeatures(unwrapModel(myPSP).chara_encoder, beforeCharacter,
+                [("standard", chara) for chara in charaKeys])
+        featureT, style, fakeRaw,  fakes = myPSP(beforeCharacter, teachers, alpha, charaFeatures)
         featureT = featureT.detach()
         iterGLoss = SquareLossFactor * torch.nn.MSELoss()(fakes.mean([1, 2, 3]), afterCharacter.mean([1, 2, 3]))
         iterMLoss = iterGLoss.item()
         GLossDict["M"] += iterMLoss
         featureO = charaDis(fakes)
+        if(featureO.shape[-2:] != featureT.shape[-2:]):
+            # 低い解像度の生成画像ではcharaDisの出力も小さいため，chara_encoderの出力を同じ大きさに平均する
+            featureT = F.adaptive_avg_pool2d(featureT, featureO.shape[-2:])
         iterGLoss  = iterGLoss + charaDisFactor *  charaDisLoss(featureO, featureT)
         iterMCLoss = iterGLoss.item()
         GLossDict["C"] += iterMCLoss - iterMLoss
@@ -369,22 +632,132 @@ def outputWriter(writer,d_loss, d_correct_rate, g_loss, GLossDict, c_loss, phase
             writer.add_scalar("lossD/valid", d_loss, global_step=epoch)
             writer.add_scalar("correctD/valid", d_correct_rate, global_step=epoch)
 
+# checkpointをバックグラウンドで保存する
+# saveではstate_dictをCPUにコピーするだけで，書き込みは別スレッドで行う
+# 一時ファイルに書き込んでからrenameするため，途中で落ちても壊れたcheckpointは残らない
+# epochごとのcheckpointは最新keepLastN個と，keepEveryKの倍数のepochのもののみ残す
+class CheckpointWriter:
+    def __init__(self, checkpointFormat, keepLastN = 3, keepEveryK = 20, maxQueueN = 2):
+        # checkpointFormat ... epochごとのcheckpointのパス (例) "cpts/output{}.cpt"
+        # maxQueueN ... 書き込み待ちの上限．これを超えるとsaveで待つ(メモリを使いすぎないため)
+        self.checkpointFormat = checkpointFormat
+        self.keepLastN = keepLastN
+        self.keepEveryK = keepEveryK
+        self.savedEpochs = []
+        self.latest = None # 最後にsaveしたcheckpoint (CPU上)
+        self.latestPath = None
+        self.error = None
+        self.queue = queue.Queue(maxQueueN)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def toCPU(cls, obj):
+        # state_dictなどに含まれるtensorをCPUにコピーする(訓練中に書き換えられないように)
+        if(isinstance(obj, torch.Tensor)):
+            return obj.detach().to("cpu", copy=True)
+        if(isinstance(obj, dict)):
+            ans = obj.__class__()
+            for key, value in obj.items():
+                ans[key] = cls.toCPU(value)
+            if(hasattr(obj, "_metadata")):
+                ans._metadata = obj._metadata
+            return ans
+        if(isinstance(obj, (list, tuple))):
+            return obj.__class__(cls.toCPU(e) for e in obj)
+        return obj
+
+    def getPath(self, epoch):
+        return self.checkpointFormat.format(epoch)
+
+    def save(self, checkpoint, epoch = None, path = None):
+        # epochを指定すればcheckpointFormatのパスに保存し，古いものを消す．pathを指定すればそこに保存する
+        # 保存先のパスを返す
+        self.raiseError()
+        if(checkpoint is not self.latest):
+            checkpoint = self.toCPU(checkpoint)
+        removePaths = []
+        if(path is None):
+            path = self.getPath(epoch)
+            if(epoch not in self.savedEpochs):
+                self.savedEpochs.append(epoch)
+            removeEpochs = [e for e in self.savedEpochs[:-self.keepLastN] if e % self.keepEveryK != 0]
+            self.savedEpochs = [e for e in self.savedEpochs if e not in removeEpochs]
+            removePaths = [self.getPath(e) for e in removeEpochs]
+            self.latest = checkpoint
+            self.latestPath = path
+        self.queue.put(("save", checkpoint, path, removePaths))
+        return path
+
+    def copyPrevious(self, path):
+        # 1つ前のepochのcheckpointをpathにコピーする．なければ何もしない
+        if(len(self.savedEpochs) < 2):
+            return
+        self.queue.put(("copy", self.getPath(self.savedEpochs[-2]), path))
+
+    def remove(self, path):
+        # 書き込み待ちのものを保存し終えてからpathを消す
+        self.queue.put(("remove", path))
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if(task is None):
+                    return
+                if(task[0] == "save"):
+                    _, checkpoint, path, removePaths = task
+                    dirName = os.path.dirname(path)
+                    if(dirName):
+                        os.makedirs(dirName, exist_ok=True)
+                    torch.save(checkpoint, path + ".tmp")
+                    os.replace(path + ".tmp", path)
+                    for removePath in removePaths:
+                        if(os.path.exists(removePath)):
+                            os.remove(removePath)
+                elif(task[0] == "remove"):
+                    if(os.path.exists(task[1])):
+                        os.remove(task[1])
+                else:
+                    _, src, dst = task
+                    if(os.path.exists(src)):
+                        shutil.copy(src, dst + ".tmp")
+                        os.replace(dst + ".tmp", dst)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raiseError(self):
+        if(self.error is not None):
+            error = self.error
+            self.error = None
+            raise error
+
+    def wait(self):
+        # 書き込み待ちがなくなるまで待つ
+        self.queue.join()
+        self.raiseError()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
 # dropout率をupdateする
-def updateDropout(D, optimizer_d, disIntermidiateList, writer, checkpoint, checkpointFile, train_d_correct,
+# checkpointはcheckpointWriterで保存済みのものを使う
+def updateDropout(D, writer, checkpointWriter, train_d_correct,
          nowDropout, dropoutChangeCount, epoch,\
-        trainRate,  trainRateC, device, d_optimFun, optimizer_d_lr,\
+        trainRate,  trainRateC,\
         trainD, emergencySave, forUnderTraining, changeDropout): 
 
     dropoutChangeCount, nextDropout = getNextDropoutSafe(nowDropout, train_d_correct, dropoutChangeCount)
     writer.add_scalar("D_dropout", nextDropout, global_step=epoch)
-    torch.cuda.empty_cache()
-    gc.collect()
+    checkpoint = checkpointWriter.latest
     if(train_d_correct > 0.65 and not emergencySave):
         emergencySave = True
-        torch.save(checkpoint, "cpts/emergency.cpt")
-        shutil.copy("cpts/before.cpt", "cpts/emergency_before.cpt")
-    else:
-        torch.save(checkpoint, checkpointFile)
+        checkpointWriter.save(checkpoint, path="cpts/emergency.cpt")
+        checkpointWriter.copyPrevious("cpts/emergency_before.cpt")
     if(trainD):
         dropoutChangeCount, nextDropout = getNextDropoutSafe(nowDropout, train_d_correct, dropoutChangeCount)
         writer.add_scalar("D_dropout", nextDropout, global_step=epoch)
@@ -392,20 +765,1222 @@ def updateDropout(D, optimizer_d, disIntermidiateList, writer, checkpoint, check
             trainRate = min(trainRate + 1, 7)
             trainRateC = (epoch) % trainRate
         if(nextDropout != nowDropout and (not forUnderTraining) and changeDropout):
-            D = Discriminator4(dropout_p=nextDropout).to(device)
+            # その場でdropout率のみを変える(重み, optimizerの状態はそのまま)
+            D.set_dropout(nextDropout)
             nowDropout = nextDropout
-            checkpoint = torch.load(checkpointFile)
-            D.load_state_dict(checkpoint["discriminatorStateDict"], strict = False)
-            D.train()
-            optimizer_d = d_optimFun(D.parameters(), optimizer_d_lr, [0.0, 0.99])
-            optimizer_d.load_state_dict(checkpoint["optDStateDict"])
-            disIntermidiateList = getDisIntermidiatelayers(D)
             dropoutChangeCount = 0
-    torch.cuda.empty_cache()
-    gc.collect()
-    return D, optimizer_d,  disIntermidiateList, dropoutChangeCount, nowDropout, trainRate, trainRateC, emergencySave
+    return dropoutChangeCount, nowDropout, trainRate, trainRateC, emergencySave
 
 
 # Generatorの損失をまとめるディクショナリを作成
 def initGLossDict():
-    return {key: 0 for key in G_LOSS_TYPE}
\ No newline at end of file
+    return {key: 0 for key in G_LOSS_TYPE}
+
+# mixed precision用のautocastのコンテキストを得る
+# useBF16 = Falseなら何もしない．CPUではbfloat16のmatmul, convが速く，中間層のメモリも半分になる
+# 損失関数の内部やPixelNormalizationLayerはfloat32で計算される
+def getAutocast(device, useBF16):
+    device = torch.device(device)
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=useBF16)
+
+# 一時的にモデルのパラメータを微分しないようにする
+# GのlossでDを通すときに使う(fakesへの勾配は流れるが，Dに蓄積している勾配は変わらない)
+@contextlib.contextmanager
+def frozenParams(model):
+    params = [param for param in model.parameters() if param.requires_grad]
+    for param in params:
+        param.requires_grad_(False)
+    try:
+        yield model
+    finally:
+        for param in params:
+            param.requires_grad_(True)
+
+# 複数のmicro-batchの勾配を足し合わせ，logicalBatchSize個のサンプルが溜まるごとにoptimizerを更新する
+# メモリに収まるmicro-batchの大きさとは別に，更新に使うbatchの大きさを決められる
+# micro-batchの大きさは毎回違ってもよく(MemoryBudgetで決まるDのminibatchなど)，サンプル数で重み付けした平均の勾配で更新する
+# BatchNormは各micro-batchの統計量で正規化する．running_mean, running_varは1回の更新あたりの減衰が元のmomentumと同じになるように，
+#   直前の更新に使ったmicro-batchの数からmomentumを変える
+#   (AdaINのbn0, bn1, StyleDiscriminatorのbn0などは2サンプル以上のmicro-batchが必要)
+class GradientAccumulator:
+    def __init__(self, optimizers, logicalBatchSize = None, models = (), microBatchSize = None):
+        # optimizers ... 同時に更新するoptimizer．Noneは無視する
+        # logicalBatchSize ... 1回の更新に使うサンプル数．Noneならmicro-batchごとに更新する(従来通り)
+        # models ... momentumを変えるBatchNormを含むモデル
+        # microBatchSize ... 分かっていれば，最初の更新のmomentumを決めるのに使う
+        self.optimizers = [optimizer for optimizer in optimizers if optimizer is not None]
+        self.logicalBatchSize = logicalBatchSize
+        self.sampleN = 0
+        self.microN = 0
+        self.batchNorms = [module for model in models for module in model.modules()
+            if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.momentum is not None]
+        self.baseMomentums = [module.momentum for module in self.batchNorms]
+        if(logicalBatchSize is not None and microBatchSize is not None):
+            self.setMomentum(-(-logicalBatchSize // microBatchSize))
+
+    def setMomentum(self, microN):
+        for module, momentum in zip(self.batchNorms, self.baseMomentums):
+            module.momentum = 1 - (1 - momentum) ** (1 / max(microN, 1))
+
+    def backward(self, loss, sampleN):
+        # lossはmicro-batchでの平均
+        if(self.logicalBatchSize is None):
+            loss.backward()
+        else:
+            (loss * sampleN).backward()
+        self.sampleN += sampleN
+        self.microN += 1
+
+    def step(self, force = False):
+        # サンプルが溜まっていれば(forceならいくつでも)更新する．更新したかを返す
+        if(self.sampleN == 0 or (self.logicalBatchSize is not None and self.sampleN < self.logicalBatchSize and not force)):
+            return False
+        if(self.logicalBatchSize is not None):
+            for optimizer in self.optimizers:
+                for group in optimizer.param_groups:
+                    for param in group["params"]:
+                        if(param.grad is not None):
+                            param.grad.div_(self.sampleN)
+        for optimizer in self.optimizers:
+            optimizer.step()
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+        if(self.logicalBatchSize is not None):
+            self.setMomentum(self.microN)
+        self.sampleN = 0
+        self.microN = 0
+        return True
+
+
+# epochの途中から訓練を再開するための部分
+# resumeInterval stepごとに，通常のcheckpointをcheckpointFormat.format("resume")に，resumeStateをその隣のファイルに保存する
+# resumeStateは乱数の状態，MyPSPBatchSamplerのバッチの列と位置，epoch内の集計，dropoutなどの制御の状態を持つ
+# epochの終わりのcheckpointを保存したら消す
+
+RESUME_NAME = "resume"
+RESUME_STATE_SUFFIX = ".state" # resumeStateを保存するファイル(getResumeStatePath)
+# 再開時に戻すepoch内の集計(trainModelの変数名)
+RESUME_COUNTER_KEYS = ["iteration", "d_iteration", "epochGLoss", "epochDLoss", "epochCharaLoss", "epochDLossList", "GLossDict",
+    "discriminator_problems_n", "discriminator_correct_n", "discriminator_problems_n_b", "discriminator_correct_n_b", "TCorrectN"]
+# 再開時に戻すepochをまたぐ状態
+RESUME_CONTROLLER_KEYS = ["nowDropout", "trainRate", "trainRateC", "dropoutChangeCount", "train_d_correct", "emergencySave"]
+
+def getResumePath(checkpointFormat):
+    return checkpointFormat.format(RESUME_NAME)
+
+# resumeStateはcheckpointとは別の小さなファイルに保存する(再開するかの判定でcheckpoint全体を読まないため)
+def getResumeStatePath(checkpointFormat):
+    return getResumePath(checkpointFormat) + RESUME_STATE_SUFFIX
+
+def getRandomState():
+    return {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+def setRandomState(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if(state["cuda"] is not None and torch.cuda.is_available()):
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+# 現在の状態からresumeStateを作る．counters, controllerはRESUME_COUNTER_KEYS, RESUME_CONTROLLER_KEYSをキーに持つ
+def getResumeState(epoch, dataLoader, usingCharaDataLoader, counters, controller):
+    sampler = getattr(dataLoader, "batch_sampler", None)
+    samplerState = None
+    if(hasattr(sampler, "getState")):
+        samplerState = sampler.getState(counters["iteration"])
+    # GLossDict, epochDLossListは訓練を続けると書き換わるためコピーする
+    return {"epoch": epoch, "usingCharaDataLoader": usingCharaDataLoader, "sampler": samplerState,
+        "counters": copy.deepcopy({key: counters[key] for key in RESUME_COUNTER_KEYS}),
+        "controller": copy.deepcopy({key: controller[key] for key in RESUME_CONTROLLER_KEYS}),
+        "random": getRandomState()}
+
+# 途中のepochのcheckpointを保存する．読み込むとそのepochから始まるように，epochは1つ前にする
+# checkpointWriterは順に書き込むため，resumeStateのファイルはcheckpointを書き終えてから置き換わる
+def saveResumeCheckpoint(checkpointWriter, checkpointFormat, checkpoint, resumeState):
+    checkpoint = dict(checkpoint)
+    checkpoint["epoch"] = resumeState["epoch"] - 1
+    path = checkpointWriter.save(checkpoint, path=getResumePath(checkpointFormat))
+    checkpointWriter.save(resumeState, path=getResumeStatePath(checkpointFormat))
+    return path
+
+# 途中のepochのcheckpointがあればresumeStateを返す．なければNone
+# (モデルなどはloadCheckpointsにgetResumePathを渡して読み込む)
+def loadResumeState(checkpointFormat):
+    if(not (os.path.exists(getResumePath(checkpointFormat)) and os.path.exists(getResumeStatePath(checkpointFormat)))):
+        return None
+    # 乱数の状態(numpy, random)を含むため，weights_onlyにはしない
+    return torch.load(getResumeStatePath(checkpointFormat), map_location="cpu", weights_only=False)
+
+# epochを最後まで訓練したら途中のcheckpointを消す．resumeStateのファイルを先に消す
+def removeResumeCheckpoint(checkpointWriter, checkpointFormat):
+    checkpointWriter.remove(getResumeStatePath(checkpointFormat))
+    checkpointWriter.remove(getResumePath(checkpointFormat))
+
+# 中断したところから続きのバッチを出力するiteratorを得る．乱数の状態もここで戻す
+# MyPSPBatchSampler以外(MyPSPCharaDatasetのRandomSamplerなど)は，残りのバッチ数だけ新しい順で出力する
+def resumeDataLoader(dataLoader, resumeState):
+    sampler = getattr(dataLoader, "batch_sampler", None)
+    setRandomState(resumeState["random"])
+    if(resumeState["sampler"] is not None and hasattr(sampler, "setState")):
+        sampler.setState(resumeState["sampler"])
+        return iter(dataLoader)
+    return itertools.islice(iter(dataLoader), max(len(dataLoader) - resumeState["counters"]["iteration"], 0))
+
+
+# 以下，train_net.ipynbを使わずにスクリプトから訓練するための部分
+# DistributedDataParallel (gloo, CPU)で複数プロセスに分けて訓練する
+
+DDP_BACKEND = "gloo"
+DDP_MASTER_ADDR = "127.0.0.1"
+DDP_MASTER_PORT = "29500"
+
+# 訓練の設定．train_net.ipynbの値と同じにしてある
+DEFAULT_TRAIN_SETTINGS = {
+    "epochN": 100000,
+    "forCharaTraining": False,
+    "forStyleTraining": False,
+    "modelLevel": 3,
+    "batchSize": 16,
+    "workers": 2,
+    "useKanji": False,
+    "imageN": [3, 3],
+    "japaneseRate": 0.7,
+    "augmentationP": [0.3, 0.3, 0],
+    "originalAugmentationP": [0.02, 0.05, 0.02, 0.04, 0.02, 0.05],
+    "d_dropout": 0.925,
+    "changeDropout": False,
+    "optimizer_d_lr": 3e-5,
+    "SquareLossFactor": 10,
+    "fakeRawFactor": 0.002,
+    "charaDisFactor": 1000,
+    "styleLossFactor": 5,
+    "DforGFactor": 40,
+    "useWSGradient": True,
+    "gpInterval": 1, # gradient penaltyを計算する間隔
+    "gpBatchSize": None, # gradient penaltyを計算するminibatchの大きさ．Noneなら全体
+    "logicalBatchSize": None, # G, charaDisの1回の更新に使うサンプル数(GradientAccumulator)．NoneならbatchSizeごとに更新
+    "dLogicalBatchSize": None, # Dの1回の更新に使うサンプル数．Noneならminibatchごとに更新
+    "useDforG": True,
+    "noiseP": 0.0,
+    "trainRate": 5,
+    "modelVer": 4, # MyPSPのver．5ならstyle_genが重みの変調(ModulatedSynthBlock)を使う
+    "useCheckpoint": False,
+    "snInterval": None, # spectral normのpower iterationを何回のoptimizerのstepごとに行うか．Noneならforwardごと
+    "fusedUpsample": False, # style_genのupsampleとconvを1つの転置畳み込みにする(upsample_conv2d)．SynthBlockはnearestのときのみ
+    "nativeResolution": False, # 低いlevelで生成画像を256に拡大せず，変換後画像，D, charaDisの入力もそのlevelの解像度にする
+    "useBF16": False,
+    "useFeatureCache": False, # chara_encoder(main stage), charaDis(valid)の出力をキャッシュする
+    "checkpointFile": "cpts/output0.cpt",
+    "checkpointFormat": "cpts/output{}.cpt",
+    "inheritOnlyModel": False,
+    "logDir": "./logs1",
+    "seed": 0,
+    "threadsPerProcess": None, # Noneならコア数をプロセス数で割った数
+    "memoryProcessN": None, # MemoryBudgetの予算を分け合うプロセス数．Noneなら同時に訓練するプロセス数
+    "masterPort": DDP_MASTER_PORT,
+    "asyncMaxStaleness": 8, # trainAsyncで，Dの重みを受け取らずにGを更新してよいstep数の上限
+    "asyncPushInterval": 4, # trainAsyncで，Dが重みをGに送る間隔(Dのstep数)
+    "asyncQueueN": 4, # trainAsyncで，Dの訓練待ちのfakesの数の上限．超えた分は捨てる
+    "validationThreads": None, # 検証を別プロセス(ValidationWorker)で行うときのスレッド数．Noneなら各epochの後に行う
+}
+
+# デフォルトの設定を一部変更した設定を得る
+def getTrainSettings(**override):
+    for key in override:
+        assert key in DEFAULT_TRAIN_SETTINGS, "unknown setting: {}".format(key)
+    settings = dict(DEFAULT_TRAIN_SETTINGS)
+    settings.update(override)
+    return settings
+
+# DDPで包まれている場合は中のモデルを返す
+def unwrapModel(model):
+    if(isinstance(model, DistributedDataParallel)):
+        return model.module
+    return model
+
+# 全プロセスで値の和をとる．分散訓練でなければそのまま返す
+def allReduceSum(values):
+    if(not (dist.is_available() and dist.is_initialized())):
+        return list(values)
+    values = torch.tensor(list(values), dtype=torch.float64)
+    dist.all_reduce(values)
+    return values.tolist()
+
+# checker.pkl, fixedDataset.pkl, styleChecker.pklを読み込む
+def loadFontInfo():
+    ans = []
+    for path in ["checker.pkl", "fixedDataset.pkl", "styleChecker.pkl"]:
+        with open(path, "br") as f:
+            ans.append(pickle.load(f))
+    return ans
+
+# chara stageで使う文字のリスト(MyPSPCharaDataset用)を読み込む
+def loadCharaList(path = "Libs/difficult_list2.txt"):
+    charaList = []
+    with open(path, "r", encoding="utf-8") as f:
+        line = f.readline()
+        while line:
+            charaList.append(line.strip())
+            line = f.readline()
+    return charaList
+
+# nativeResolutionのときの変換後画像の大きさ．Noneなら256のまま
+def getTargetWH(settings):
+    if(not settings["nativeResolution"]):
+        return None
+    return get_native_resolution(settings["modelLevel"], settings["forCharaTraining"])
+
+# 画像 [..., H, W] を生成画像と同じ大きさwhに縮小する．同じ大きさならそのまま
+def matchResolution(images, wh):
+    if(images is None or images.shape[-1] == wh):
+        return images
+    return FontGeneratorDataset.downsample(images, wh)
+
+# 検証用のDatasetを作る
+def getValidDataset(settings, fontInfo = None):
+    compatibleDict, fixedDataset, styleDict = fontInfo or loadFontInfo()
+    return FontGeneratorDataset(FontTools(useKanji=settings["useKanji"]), compatibleDict, [5, 5], styleDict, useTensor=True,
+        startInd=0, indN=10, isForValid=fixedDataset, returnKeys=True, targetWH=getTargetWH(settings))
+
+# train_net.ipynbと同様にDataLoaderを作る．worldSize > 1ならrankごとに分割する
+def getDataLoaders(settings, rank = 0, worldSize = 1):
+    fontInfo = loadFontInfo()
+    compatibleDict, fixedDataset, styleDict = fontInfo
+    trainDataset = FontGeneratorDataset(FontTools(useKanji=settings["useKanji"]), compatibleDict, settings["imageN"], styleDict,
+        useTensor=True, startInd=10, augmentationP=settings["augmentationP"], originalAugmentationP=settings["originalAugmentationP"],
+        returnKeys=True, targetWH=getTargetWH(settings))
+    validDataset = getValidDataset(settings, fontInfo)
+    charaTrainDataset = MyPSPCharaDataset(loadCharaList())
+
+    batchSize = settings["batchSize"]
+    workers = settings["workers"]
+    if(worldSize > 1):
+        batchSampler = DistributedMyPSPBatchSampler(batchSize, trainDataset, rank, worldSize,
+            japaneseRate=settings["japaneseRate"], seed=settings["seed"])
+        validSampler = torch.utils.data.distributed.DistributedSampler(validDataset, worldSize, rank, shuffle=False)
+        charaSampler = torch.utils.data.distributed.DistributedSampler(charaTrainDataset, worldSize, rank, shuffle=True,
+            seed=settings["seed"])
+    else:
+        batchSampler = MyPSPBatchSampler(batchSize, trainDataset, japaneseRate=settings["japaneseRate"])
+        validSampler = None
+        charaSampler = torch.utils.data.RandomSampler(charaTrainDataset)
+    trainDataLoader = torch.utils.data.dataloader.DataLoader(trainDataset, batch_sampler=batchSampler, num_workers=workers)
+    validDataLoader = torch.utils.data.dataloader.DataLoader(validDataset, batch_size=batchSize, sampler=validSampler,
+        num_workers=workers)
+    charaDataLoader = torch.utils.data.dataloader.DataLoader(charaTrainDataset, batch_size=batchSize, sampler=charaSampler,
+        num_workers=workers)
+    return [trainDataLoader, validDataLoader, charaDataLoader]
+
+# train_net.ipynbと同様にモデルを作る [myPSP, D, styleDis, charaDis]
+def buildModels(settings):
+    myPSP = MyPSP(ver=settings["modelVer"], dropout_p=0.0, useBNform2s=True, useBin=True)
+    myPSP.chara_encoder.init_original_layer()
+    myPSP.style_encoder.init_original_layer()
+    D = Discriminator4(dropout_p=settings["d_dropout"])
+    charaDis = CharaDiscriminator(ver=4)
+    styleDis = StyleDiscriminator()
+    myPSP.set_level(settings["modelLevel"])
+    myPSP.set_for_chara_training(settings["forCharaTraining"])
+    myPSP.set_for_style_training(settings["forStyleTraining"])
+    for model in [myPSP, D, charaDis]:
+        model.set_checkpoint(settings["useCheckpoint"])
+    myPSP.style_gen.set_fused_upsample(settings["fusedUpsample"])
+    myPSP.set_native_resolution(settings["nativeResolution"])
+    return [myPSP, D, styleDis, charaDis]
+
+# 各モデルをDDPで包む．使われないパラメータがある(Discriminatorの_bn1など)ためfind_unused_parameters=True
+def wrapDistributed(models, forUnderTraining, trainCharaDis):
+    myPSP, D, styleDis, charaDis = models
+    myPSP = DistributedDataParallel(myPSP, find_unused_parameters=True)
+    styleDis = DistributedDataParallel(styleDis, find_unused_parameters=True)
+    if(not forUnderTraining):
+        D = DistributedDataParallel(D, find_unused_parameters=True)
+    if(trainCharaDis):
+        charaDis = DistributedDataParallel(charaDis, find_unused_parameters=True)
+    return [myPSP, D, styleDis, charaDis]
+
+# 訓練の状態のうち，epochをまたいで引き継ぐもの
+# processN ... 同時に訓練するプロセス数．settingsのmemoryProcessNがNoneならこの数でメモリの予算を分ける
+def initTrainState(settings, device, processN = 1):
+    memoryBudget = MemoryBudget(device, processN=settings["memoryProcessN"] or processN)
+    return {"trainRate": settings["trainRate"], "trainRateC": 0, "nowDropout": settings["d_dropout"],
+        "dropoutChangeCount": 0, "train_d_correct": 0, "memoryBudget": memoryBudget,
+        "featureCache": RealGlyphFeatureCache() if settings["useFeatureCache"] else None}
+
+# 1 epoch分の訓練，検証を行う(train_net.ipynbのtrainModelのループをスクリプト用にしたもの)
+# modelsはDDPで包まれていてもよい．検証は各プロセスで包まずに行う
+# phases ... 行うphase．非同期訓練(trainAsync)では検証のみに使う
+# 行ったphaseごとのlossを返す
+def runEpoch(models, optimizers, dataLoaders, device, epoch, settings, trainState, writer = None, rank = 0,
+    phases = ("train", "val")):
+    myPSP, D, styleDis, charaDis = models
+    optimizer, optimizer_d, optimizer_styleDis, optimizer_charaDis = optimizers
+    forCharaTraining = settings["forCharaTraining"]
+    forStyleTraining = settings["forStyleTraining"]
+    forUnderTraining = forCharaTraining or forStyleTraining
+    trainCharaDis = forCharaTraining
+    useWSGradient = settings["useWSGradient"]
+    noiseP = settings["noiseP"]
+    useBF16 = settings["useBF16"]
+    factors = [settings["SquareLossFactor"], settings["fakeRawFactor"], settings["styleLossFactor"], settings["charaDisFactor"]]
+    charaDisLoss = torch.nn.MSELoss()
+    memoryBudget = trainState["memoryBudget"]
+    featureCache = trainState["featureCache"]
+    gpInterval = settings["gpInterval"]
+    gAccumulator = GradientAccumulator([optimizer, optimizer_styleDis], settings["logicalBatchSize"],
+        [unwrapModel(myPSP), unwrapModel(styleDis)], settings["batchSize"])
+    charaAccumulator = GradientAccumulator([optimizer_charaDis], settings["logicalBatchSize"], [unwrapModel(charaDis)],
+        settings["batchSize"])
+    dAccumulator = GradientAccumulator([optimizer_d], settings["dLogicalBatchSize"], [unwrapModel(D)])
+    epochStartTime = time.time()
+    # どのDataLoaderを使うかは全プロセスで揃える必要がある
+    epochRandom = random.Random(settings["seed"] + epoch)
+    results = {} # phaseごとの{"g_loss", "d_loss", "c_loss"}
+
+    for phase in phases:
+        if(phase == "train"):
+            if(epoch == 0):
+                continue
+            phaseModels = models
+            dataLoader = dataLoaders[0]
+            usingCharaDataLoader = forCharaTraining and epochRandom.random() > 0.2
+            if(usingCharaDataLoader):
+                dataLoader = dataLoaders[2]
+            for model in models:
+                model.train()
+            if(featureCache is not None and not forUnderTraining):
+                unwrapModel(myPSP).chara_encoder.eval()
+        else:
+            phaseModels = [unwrapModel(model) for model in models]
+            dataLoader = dataLoaders[1]
+            usingCharaDataLoader = False
+            phaseModels[0].eval()
+            if(featureCache is not None):
+                phaseModels[3].eval()
+        G, Dm, styleDisM, charaDisM = phaseModels
+        sampler = getattr(dataLoader, "batch_sampler", None)
+        if(hasattr(sampler, "set_epoch")):
+            sampler.set_epoch(epoch)
+        if(hasattr(dataLoader.sampler, "set_epoch")):
+            dataLoader.sampler.set_epoch(epoch)
+
+        GLossDict = initGLossDict()
+        epochGLoss = epochDLoss = epochCharaLoss = 0
+        epochDLossList = np.zeros(3)
+        discriminator_problems_n = discriminator_correct_n = TCorrectN = 0
+        iteration = d_iteration = 0
+        for data in dataLoader:
+            if(usingCharaDataLoader):
+                beforeCharacter = data
+            else:
+                beforeCharacter = data[0][0]
+            minibatch_size = beforeCharacter.size()[0]
+            alpha = torch.ones((1, 1), device=device)
+            beforeCharacter = beforeCharacter.to(device, torch.float32)
+            afterCharacter = beforeCharacter
+            teachers = styleLabel = charaKeys = None
+            if(not usingCharaDataLoader and len(data) > 3):
+                charaKeys = data[3][1]
+            if(not forCharaTraining):
+                afterCharacter = data[0][1].to(device, torch.float32)
+                teachers = data[1][:, :, 1].to(device, torch.float32)
+                styleLabel = data[2].to(device, torch.float32)
+
+            with torch.set_grad_enabled(phase == "train"):
+                # Generator
+                with getAutocast(device, useBF16):
+                    iterGLoss, featureT, fakes = forwardG(G, styleDisM, charaDisM, charaDisLoss, beforeCharacter, teachers,
+                        afterCharacter, alpha, styleLabel, GLossDict, factors, forCharaTraining, forStyleTraining,
+                        featureCache, charaKeys)
+                if(fakes is not None):
+                    fakes = fakes.float()
+                # Dへの教師用データは生成画像と同じ解像度にする
+                teachersD = None if forUnderTraining else matchResolution(teachers, fakes.shape[-1])
+                if(not forUnderTraining and settings["useDforG"]):
+                    fakes = transforms.Normalize(FontGeneratorDataset.IMAGE_MEAN, FontGeneratorDataset.IMAGE_VAR)(fakes)
+                    fakesN, teachersN = MyPSPAugmentation.getNoisedImages([fakes, teachersD], noiseP, device)
+                    with getAutocast(device, useBF16), frozenParams(Dm):
+                        d_fake = Dm(fakesN, teachersN, alpha)
+                    iterGLoss += settings["DforGFactor"] * g_wgan_loss(d_fake)
+                    del d_fake, fakesN, teachersN
+                epochGLoss += iterGLoss.item()
+                if(phase == "train"):
+                    gAccumulator.backward(iterGLoss, minibatch_size)
+                    gAccumulator.step()
+                    if(not trainCharaDis):
+                        charaDis.zero_grad()
+                del iterGLoss
+                if(not forUnderTraining):
+                    fakes = fakes.detach()
+
+                # CharaDiscriminator
+                if(trainCharaDis):
+                    with getAutocast(device, useBF16):
+                        if(phase == "val" and featureCache is not None and charaKeys is not None):
+                            featureO = featureCache.getFeatures(charaDisM, afterCharacter,
+                                [("standard", chara) for chara in charaKeys])
+                        else:
+                            featureO = charaDisM(afterCharacter)
+                        c_loss = charaDisLoss(featureO.float(), featureT.float())
+                    epochCharaLoss += c_loss.item()
+                    if(phase == "train"):
+                        charaAccumulator.backward(c_loss, minibatch_size)
+                        charaAccumulator.step()
+                    del featureO, c_loss
+
+                # Discriminator
+                if(not forUnderTraining and (iteration % trainState["trainRate"] == trainState["trainRateC"] or phase == "val")):
+                    fakesN, afterCharacterN, teachersN = MyPSPAugmentation.getNoisedImages([fakes, afterCharacter, teachersD], noiseP, device)
+                    # gradient penaltyはgpInterval stepに一度のみ計算する(lazy regularization)
+                    useGradient = useWSGradient and d_iteration % gpInterval == 0
+                    dStage = "D" if useGradient else "DNoGP"
+                    dBatchSize, dTeachersN = minibatch_size, teachersN.shape[1]
+                    if(phase == "train"):
+                        # 予算に収まるようにminibatch, teacherの数を決める
+                        dBatchSize, dTeachersN = memoryBudget.getDiscriminatorSize(dStage, minibatch_size, dTeachersN)
+                        fakesN = fakesN[:dBatchSize]
+                        afterCharacterN = afterCharacterN[:dBatchSize]
+                        teachersN = teachersN[:dBatchSize, :dTeachersN]
+                        memoryBudget.startStage()
+                    with getAutocast(device, useBF16):
+                        d_loss, discCorrectN, lossList, tcorrect, fcorrect = d_wgan_loss2(Dm, None, afterCharacterN,
+                            fakesN, teachersN, alpha, phase, useGradient=useGradient, useBefore=False,
+                            gpScale=gpInterval, gpBatchSize=settings["gpBatchSize"])
+                    TCorrectN += tcorrect
+                    epochDLossList += lossList
+                    epochDLoss += d_loss.item()
+                    discriminator_problems_n += dBatchSize*2
+                    discriminator_correct_n += discCorrectN
+                    if(phase == "train"):
+                        dAccumulator.backward(d_loss, dBatchSize)
+                        dAccumulator.step()
+                        memoryBudget.endStage(dStage, dBatchSize, dTeachersN)
+                    del d_loss, fakesN, afterCharacterN, teachersN
+                    d_iteration += 1
+            iteration += 1
+            memoryBudget.collectIfNeeded()
+            if(rank == 0):
+                print("\riter {:4}/{}".format(iteration, len(dataLoader)), end="")
+            del beforeCharacter, afterCharacter, teachers, teachersD, alpha, data, fakes, featureT
+        if(phase == "train"):
+            # epochの最後に残ったmicro-batchの分も更新する
+            for accumulator in [gAccumulator, charaAccumulator, dAccumulator]:
+                accumulator.step(force=True)
+
+        # 全プロセスで集計
+        counts = allReduceSum([epochGLoss, epochDLoss, epochCharaLoss, iteration, d_iteration, discriminator_problems_n,
+            discriminator_correct_n, TCorrectN] + list(epochDLossList) + [GLossDict[key] for key in G_LOSS_TYPE])
+        epochGLoss, epochDLoss, epochCharaLoss, iteration, d_iteration, discriminator_problems_n, discriminator_correct_n, TCorrectN =\
+            counts[:8]
+        epochDLossList = np.array(counts[8:11])
+        GLossDict = {key: value / iteration for key, value in zip(G_LOSS_TYPE, counts[11:])}
+        d_loss = np.nan if d_iteration == 0 else epochDLoss / d_iteration
+        g_loss = epochGLoss / iteration
+        c_loss = epochCharaLoss / iteration
+        discriminator_ns = [[discriminator_correct_n, discriminator_problems_n], [0, 0]]
+        if(rank == 0):
+            print()
+            d_correct_rate = printResults(d_loss, discriminator_ns, g_loss, GLossDict, c_loss, epochDLossList, TCorrectN,
+                epochStartTime, epoch, forUnderTraining, True)
+            if(writer is not None):
+                outputWriter(writer, d_loss, d_correct_rate, g_loss, GLossDict, c_loss, phase, epoch, forUnderTraining, True)
+        if(phase == "train" and not forUnderTraining and discriminator_problems_n > 0):
+            trainState["train_d_correct"] = discriminator_correct_n / discriminator_problems_n
+        results[phase] = {"g_loss": g_loss, "d_loss": d_loss, "c_loss": c_loss}
+    return results
+
+# train_d_correctからDiscriminatorの訓練頻度, dropout率を更新する(updateDropoutと同様)
+def updateTrainRate(trainState, D, epoch, settings):
+    count, nextDropout = getNextDropoutSafe(trainState["nowDropout"], trainState["train_d_correct"],
+        trainState["dropoutChangeCount"])
+    trainState["dropoutChangeCount"] = count
+    if(nextDropout > trainState["nowDropout"]):
+        trainState["trainRate"] = min(trainState["trainRate"] + 1, 7)
+        trainState["trainRateC"] = epoch % trainState["trainRate"]
+    forUnderTraining = settings["forCharaTraining"] or settings["forStyleTraining"]
+    if(nextDropout != trainState["nowDropout"] and (not forUnderTraining) and settings["changeDropout"]):
+        unwrapModel(D).set_dropout(nextDropout)
+        trainState["nowDropout"] = nextDropout
+        trainState["dropoutChangeCount"] = 0
+    return nextDropout
+
+# train_net.ipynbと同じ形式のcheckpointを作る
+def getCheckpoint(models, optimizers, epoch, trainCharaDis):
+    myPSP, D, styleDis, charaDis = [unwrapModel(model) for model in models]
+    optimizer, optimizer_d, optimizer_styleDis, optimizer_charaDis = optimizers
+    return {"epoch": epoch,
+        "modelStateDict": myPSP.state_dict(),
+        "discriminatorStateDict": D.state_dict(),
+        "charaDiscriminatorStateDict": charaDis.state_dict(),
+        "styleDiscriminatorStateDict": styleDis.state_dict(),
+        "optStateDict": optimizer.state_dict(),
+        "optDStateDict": optimizer_d.state_dict(),
+        "optCDStateDict": optimizer_charaDis.state_dict() if trainCharaDis else None,
+        "optSDStateDict": optimizer_styleDis.state_dict()
+        }
+
+# 各プロセスで実行される訓練．checkpointの保存，tensorboardへの出力はrank 0のみが行う
+def trainDistributed(rank, worldSize, settings):
+    from torch.utils.tensorboard import SummaryWriter
+    settings = getTrainSettings(**settings)
+    os.environ.setdefault("MASTER_ADDR", DDP_MASTER_ADDR)
+    os.environ["MASTER_PORT"] = str(settings["masterPort"])
+    dist.init_process_group(DDP_BACKEND, rank=rank, world_size=worldSize)
+    threadsN = settings["threadsPerProcess"]
+    if(threadsN is None):
+        threadsN = max(1, (os.cpu_count() or 1) // worldSize)
+    torch.set_num_threads(threadsN)
+    # モデルの初期値は全プロセスで揃え，データの乱数はプロセスごとに変える
+    torch.manual_seed(settings["seed"])
+    random.seed(settings["seed"] + rank)
+    np.random.seed(settings["seed"] + rank)
+    device = torch.device("cpu")
+
+    forUnderTraining = settings["forCharaTraining"] or settings["forStyleTraining"]
+    trainCharaDis = settings["forCharaTraining"]
+    models = buildModels(settings)
+    for model in models:
+        model.to(device)
+    optimizers = getOptimizers(models, settings["forCharaTraining"], trainCharaDis, torch.optim.AdamW, settings["optimizer_d_lr"])
+    setSpectralNormInterval(models, optimizers, settings["snInterval"])
+    checkpointFile = settings["checkpointFile"]
+    start = loadCheckpoints(checkpointFile, models, optimizers, "", "", settings["inheritOnlyModel"], forUnderTraining,
+        trainCharaDis)
+    models = wrapDistributed(models, forUnderTraining, trainCharaDis)
+    dataLoaders = getDataLoaders(settings, rank, worldSize)
+    writer = AsyncSummaryWriter(SummaryWriter(log_dir=settings["logDir"])) if rank == 0 else None
+    checkpointWriter = CheckpointWriter(settings["checkpointFormat"]) if rank == 0 else None
+    trainState = initTrainState(settings, device, worldSize)
+    phases, validationWorker = getValidationPhases(settings, rank)
+
+    for epoch in range(start, settings["epochN"]):
+        if(rank == 0):
+            print('-------------')
+            print('Epoch {}/{}'.format(epoch, settings["epochN"]))
+        runEpoch(models, optimizers, dataLoaders, device, epoch, settings, trainState, writer, rank, phases)
+        nextDropout = updateTrainRate(trainState, models[1], epoch, settings)
+        if(rank == 0):
+            if(writer is not None):
+                writer.add_scalar("D_dropout", nextDropout, global_step=epoch)
+            checkpointWriter.save(getCheckpoint(models, optimizers, epoch, trainCharaDis), epoch)
+            if(validationWorker is not None):
+                validationWorker.submit(checkpointWriter.latest, epoch)
+        dist.barrier()
+    if(writer is not None):
+        writer.close()
+        checkpointWriter.close()
+    if(validationWorker is not None):
+        validationWorker.close()
+    dist.destroy_process_group()
+
+# worldSize個のプロセスで訓練を始める．settingsはDEFAULT_TRAIN_SETTINGSのうち変更するもの
+# (例) launchDistributed(4, forCharaTraining=True, modelLevel=1)
+def launchDistributed(worldSize, **settings):
+    mp.spawn(trainDistributed, args=(worldSize, settings), nprocs=worldSize, join=True)
+
+
+# Chara, StyleEncoderの事前訓練を同時に行うための部分
+# chara stageが更新するのはchara_encoder, style_gen, charaDis，style stageが更新するのはstyle_encoder, styleDisのみで重ならないため，
+# 別々のプロセスで訓練し，最後にstate_dictを1つのcheckpointにまとめる
+
+PRETRAIN_CHARA_SETTINGS = {"forCharaTraining": True, "modelLevel": 1, "checkpointFile": "cpts/chara0.cpt",
+    "checkpointFormat": "cpts/chara{}.cpt", "logDir": "./logs_chara", "masterPort": "29501"}
+PRETRAIN_STYLE_SETTINGS = {"forStyleTraining": True, "checkpointFile": "cpts/style0.cpt",
+    "checkpointFormat": "cpts/style{}.cpt", "logDir": "./logs_style", "masterPort": "29502"}
+PRETRAIN_CHARA_PREFIXES = ["chara_encoder.", GENERATOR_NAME + "."] # chara stageの結果を使うMyPSPのパラメータ
+
+# checkpointFormatで保存されたもののうち，最も新しいepochのパスを返す．なければNone
+def getLatestCheckpointPath(checkpointFormat):
+    prefix, suffix = checkpointFormat.split("{}")
+    latestEpoch = -1
+    latestPath = None
+    dirName = os.path.dirname(checkpointFormat) or "."
+    if(not os.path.isdir(dirName)):
+        return None
+    for name in os.listdir(dirName):
+        path = os.path.join(os.path.dirname(checkpointFormat), name)
+        if(not (path.startswith(prefix) and path.endswith(suffix))):
+            continue
+        epoch = path[len(prefix):len(path) - len(suffix)]
+        if(epoch.isdigit() and int(epoch) > latestEpoch):
+            latestEpoch = int(epoch)
+            latestPath = path
+    return latestPath
+
+# chara stage, style stageのcheckpointを，通常の訓練でそのまま読み込める1つのcheckpointにまとめる
+# MyPSPのうちchara_encoder, style_genはchara stageから，style_encoderはstyle stageからとる
+# optimizerは通常の訓練と同じ構成(chara_encoderを含まない)のstyle stageのものを使う
+def mergePretrainedCheckpoints(charaCheckpointFile, styleCheckpointFile, outputFile):
+    charaCheckpoint = torch.load(charaCheckpointFile, map_location="cpu")
+    checkpoint = torch.load(styleCheckpointFile, map_location="cpu")
+    modelStateDict = checkpoint["modelStateDict"]
+    for key, value in charaCheckpoint["modelStateDict"].items():
+        if(any(key.startswith(prefix) for prefix in PRETRAIN_CHARA_PREFIXES)):
+            modelStateDict[key] = value
+    checkpoint["charaDiscriminatorStateDict"] = charaCheckpoint["charaDiscriminatorStateDict"]
+    checkpoint["optCDStateDict"] = charaCheckpoint["optCDStateDict"]
+    checkpoint["epoch"] = max(checkpoint["epoch"], charaCheckpoint["epoch"])
+    dirName = os.path.dirname(outputFile)
+    if(dirName):
+        os.makedirs(dirName, exist_ok=True)
+    torch.save(checkpoint, outputFile + ".tmp")
+    os.replace(outputFile + ".tmp", outputFile)
+    return outputFile
+
+# chara stageとstyle stageを別プロセスで同時に訓練し，終わったらoutputFileにまとめる
+# charaSettings, styleSettings ... PRETRAIN_CHARA_SETTINGS, PRETRAIN_STYLE_SETTINGSのうち変更するもの(DEFAULT_TRAIN_SETTINGSのキー)
+# 各stageはそれぞれのworldSizeのDDPで訓練し，DataLoaderも別々に持つ(chara stageはMyPSPCharaDatasetも使う)
+# (例) launchPretraining(charaSettings={"epochN": 50}, styleSettings={"epochN": 50})
+def launchPretraining(charaSettings = None, styleSettings = None, outputFile = "cpts/pretrained.cpt",
+    charaWorldSize = 1, styleWorldSize = 1):
+    charaSettings = dict(PRETRAIN_CHARA_SETTINGS, **(charaSettings or {}))
+    styleSettings = dict(PRETRAIN_STYLE_SETTINGS, **(styleSettings or {}))
+    getTrainSettings(**charaSettings)
+    getTrainSettings(**styleSettings)
+    assert charaSettings["masterPort"] != styleSettings["masterPort"], "each stage needs its own masterPort"
+    assert charaSettings["checkpointFormat"] != styleSettings["checkpointFormat"], "each stage needs its own checkpointFormat"
+    # コアとメモリは2つのstageのプロセスで分け合う
+    threadsN = max(1, (os.cpu_count() or 1) // (charaWorldSize + styleWorldSize))
+    for settings in [charaSettings, styleSettings]:
+        if(settings.get("threadsPerProcess") is None):
+            settings["threadsPerProcess"] = threadsN
+        if(settings.get("memoryProcessN") is None):
+            settings["memoryProcessN"] = charaWorldSize + styleWorldSize
+
+    context = mp.get_context("spawn")
+    processes = [context.Process(target=launchDistributed, args=(worldSize, ), kwargs=settings)
+        for worldSize, settings in [(charaWorldSize, charaSettings), (styleWorldSize, styleSettings)]]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    for process, name in zip(processes, ["chara", "style"]):
+        if(process.exitcode != 0):
+            raise RuntimeError("{} stage exited with code {}".format(name, process.exitcode))
+
+    paths = [getLatestCheckpointPath(settings["checkpointFormat"]) for settings in [charaSettings, styleSettings]]
+    if(None in paths):
+        raise RuntimeError("checkpoint not found: {}".format(paths))
+    return mergePretrainedCheckpoints(paths[0], paths[1], outputFile)
+
+
+# Generator, Discriminatorを別プロセスで非同期に訓練するための部分(main stageのみ)
+# Gのプロセスはfakesをキューに入れ，Dのプロセスはそれを取り出して訓練し，asyncPushInterval stepごとに重みをGに送る
+# GはasyncMaxStaleness step以上新しい重みを受け取っていなければ，受け取るまで待つ
+# Dの訓練頻度はDの速さで決まるため，trainRate, dropoutの変更は行わない
+
+ASYNC_WAIT_SEC = 1.0 # Dのプロセスがキューを待つ時間．この間fakesが来なければ重みを送る
+ASYNC_D_STATS_N = 8 # [d_loss, d_iteration, correctN, problemsN, TCorrectN, DLossList(3)]
+
+# Dの重みを送る．受け取られていない古い重みは捨てる
+def putLatest(weightsQueue, message):
+    try:
+        while True:
+            weightsQueue.get_nowait()
+    except queue.Empty:
+        pass
+    weightsQueue.put(message)
+
+# Dのプロセスが終了していればエラーを送出する
+def checkDiscriminatorAlive(dProcess):
+    if(not dProcess.is_alive()):
+        raise RuntimeError("discriminator process exited unexpectedly (exit code {})".format(dProcess.exitcode))
+
+# Dのプロセスからweightsを受け取る．Dのプロセスのエラー，終了はここで送出する(Dが落ちてもGが待ち続けないように)
+# blockがFalseなら待たず，届いていなければqueue.Emptyを送出する
+def getFromDiscriminator(weightsQueue, dProcess, block = True):
+    while True:
+        try:
+            message = weightsQueue.get(timeout=ASYNC_WAIT_SEC) if block else weightsQueue.get_nowait()
+        except queue.Empty:
+            if(not block):
+                raise
+            if(dProcess.is_alive()):
+                continue
+            try:
+                # 終了する直前に送られたエラーがまだ届いていなければ受け取る
+                message = weightsQueue.get(timeout=ASYNC_WAIT_SEC)
+            except queue.Empty:
+                checkDiscriminatorAlive(dProcess)
+        if(message[0] == "error"):
+            raise RuntimeError("discriminator process failed:\n{}".format(message[1]))
+        return message
+
+# fakesQueueにmessageを入れる．キューが空かないままDのプロセスが終了していればエラーを送出する
+def putToDiscriminator(fakesQueue, message, dProcess):
+    while True:
+        try:
+            fakesQueue.put(message, timeout=ASYNC_WAIT_SEC)
+            return
+        except queue.Full:
+            checkDiscriminatorAlive(dProcess)
+
+# Discriminatorを訓練するプロセス
+# fakesQueueには ("fakes", fakes, afterCharacter, teachers)，("sync", ) (epochの終わり)，None (終了) が入る
+# weightsQueueには (Dのstep数, state_dict, optimizerのstate_dict, epochの集計) を送る．後ろ2つはsyncのときのみ
+# エラーで止まるときは ("error", traceback) を送る(Gのプロセスが待ち続けないように，getFromDiscriminatorで送出する)
+def trainAsyncDiscriminator(settings, dStateDict, optDStateDict, fakesQueue, weightsQueue):
+    try:
+        runAsyncDiscriminator(settings, dStateDict, optDStateDict, fakesQueue, weightsQueue)
+    except BaseException:
+        weightsQueue.put(("error", traceback.format_exc()))
+        raise
+
+# trainAsyncDiscriminatorの本体
+def runAsyncDiscriminator(settings, dStateDict, optDStateDict, fakesQueue, weightsQueue):
+    settings = getTrainSettings(**settings)
+    torch.set_num_threads(settings["threadsPerProcess"] or max(1, (os.cpu_count() or 1) // 2))
+    torch.manual_seed(settings["seed"] + 1)
+    device = torch.device("cpu")
+    D = Discriminator4(dropout_p=settings["d_dropout"])
+    D.set_checkpoint(settings["useCheckpoint"])
+    D.load_state_dict(dStateDict, strict=False)
+    D.to(device)
+    D.train()
+    optimizer_d = torch.optim.AdamW(D.parameters(), settings["optimizer_d_lr"], [0.0, 0.99])
+    if(optDStateDict is not None):
+        optimizer_d.load_state_dict(optDStateDict)
+    setSpectralNormInterval([D], [optimizer_d], settings["snInterval"])
+    alpha = torch.ones((1, 1), device=device)
+    gpInterval = settings["gpInterval"]
+    dAccumulator = GradientAccumulator([optimizer_d], settings["dLogicalBatchSize"], [D])
+    dStep = 0
+    lastPushStep = 0
+    stats = np.zeros(ASYNC_D_STATS_N)
+    while True:
+        try:
+            message = fakesQueue.get(timeout=ASYNC_WAIT_SEC)
+        except queue.Empty:
+            # Gが重みを待っている可能性があるため，暇なときは送っておく
+            if(dStep != lastPushStep):
+                putLatest(weightsQueue, (dStep, CheckpointWriter.toCPU(D.state_dict()), None, None))
+                lastPushStep = dStep
+            continue
+        if(message is None):
+            break
+        if(message[0] == "sync"):
+            dAccumulator.step(force=True)
+            putLatest(weightsQueue, (dStep, CheckpointWriter.toCPU(D.state_dict()),
+                CheckpointWriter.toCPU(optimizer_d.state_dict()), stats.tolist()))
+            lastPushStep = dStep
+            stats = np.zeros(ASYNC_D_STATS_N)
+            continue
+        _, fakes, afterCharacter, teachers = message
+        fakesN, afterCharacterN, teachersN = MyPSPAugmentation.getNoisedImages([fakes, afterCharacter, teachers],
+            settings["noiseP"], device)
+        useGradient = settings["useWSGradient"] and dStep % gpInterval == 0
+        with getAutocast(device, settings["useBF16"]):
+            d_loss, discCorrectN, lossList, tcorrect, fcorrect = d_wgan_loss2(D, None, afterCharacterN, fakesN, teachersN,
+                alpha, "train", useGradient=useGradient, useBefore=False, gpScale=gpInterval,
+                gpBatchSize=settings["gpBatchSize"])
+        dAccumulator.backward(d_loss, fakesN.shape[0])
+        dAccumulator.step()
+        stats += [d_loss.item(), 1, discCorrectN, fakes.shape[0] * 2, tcorrect] + list(lossList)
+        del d_loss, fakes, afterCharacter, teachers, fakesN, afterCharacterN, teachersN
+        dStep += 1
+        if(dStep - lastPushStep >= settings["asyncPushInterval"]):
+            putLatest(weightsQueue, (dStep, CheckpointWriter.toCPU(D.state_dict()), None, None))
+            lastPushStep = dStep
+
+# Generatorの1 epoch分の訓練．fakesはDのプロセスに送り，Dの重みは届き次第反映する
+# asyncStateは["staleness"](最後に重みを受け取ってからのstep数)を持つ
+def runAsyncGeneratorEpoch(models, optimizers, dataLoader, device, epoch, settings, trainState, asyncState,
+    fakesQueue, weightsQueue, dProcess):
+    myPSP, D, styleDis, charaDis = models
+    optimizer, optimizer_d, optimizer_styleDis, optimizer_charaDis = optimizers
+    factors = [settings["SquareLossFactor"], settings["fakeRawFactor"], settings["styleLossFactor"], settings["charaDisFactor"]]
+    charaDisLoss = torch.nn.MSELoss()
+    featureCache = trainState["featureCache"]
+    useBF16 = settings["useBF16"]
+    normalize = transforms.Normalize(FontGeneratorDataset.IMAGE_MEAN, FontGeneratorDataset.IMAGE_VAR)
+    for model in models:
+        model.train()
+    if(featureCache is not None):
+        myPSP.chara_encoder.eval()
+    gAccumulator = GradientAccumulator([optimizer, optimizer_styleDis], settings["logicalBatchSize"], [myPSP, styleDis],
+        settings["batchSize"])
+    GLossDict = initGLossDict()
+    epochGLoss = 0
+    iteration = droppedN = 0
+    for data in dataLoader:
+        # 届いている最新の重みを反映する．古すぎれば届くまで待つ
+        try:
+            message = getFromDiscriminator(weightsQueue, dProcess, block=asyncState["staleness"] >= settings["asyncMaxStaleness"])
+            D.load_state_dict(message[1])
+            asyncState["staleness"] = 0
+        except queue.Empty:
+            pass
+        beforeCharacter = data[0][0].to(device, torch.float32)
+        afterCharacter = data[0][1].to(device, torch.float32)
+        teachers = data[1][:, :, 1].to(device, torch.float32)
+        styleLabel = data[2].to(device, torch.float32)
+        charaKeys = data[3][1] if len(data) > 3 else None
+        alpha = torch.ones((1, 1), device=device)
+        with getAutocast(device, useBF16):
+            iterGLoss, featureT, fakes = forwardG(myPSP, styleDis, charaDis, charaDisLoss, beforeCharacter, teachers,
+                afterCharacter, alpha, styleLabel, GLossDict, factors, False, False, featureCache, charaKeys)
+        fakes = normalize(fakes.float())
+        teachers = matchResolution(teachers, fakes.shape[-1])
+        if(settings["useDforG"]):
+            fakesN, teachersN = MyPSPAugmentation.getNoisedImages([fakes, teachers], settings["noiseP"], device)
+            with getAutocast(device, useBF16):
+                d_fake = D(fakesN, teachersN, alpha)
+            iterGLoss += settings["DforGFactor"] * g_wgan_loss(d_fake)
+            del d_fake, fakesN, teachersN
+        epochGLoss += iterGLoss.item()
+        gAccumulator.backward(iterGLoss, beforeCharacter.shape[0])
+        gAccumulator.step()
+        charaDis.zero_grad()
+        # Dの訓練が追いつかなければfakesは捨てる(Gは待たない)
+        try:
+            fakesQueue.put_nowait(("fakes", fakes.detach(), afterCharacter, teachers))
+        except queue.Full:
+            droppedN += 1
+        asyncState["staleness"] += 1
+        iteration += 1
+        print("\riter {:4}/{}".format(iteration, len(dataLoader)), end="")
+        del iterGLoss, featureT, fakes, beforeCharacter, afterCharacter, teachers, styleLabel, data
+        trainState["memoryBudget"].collectIfNeeded()
+    gAccumulator.step(force=True)
+    print()
+    return epochGLoss / max(iteration, 1), {key: value / max(iteration, 1) for key, value in GLossDict.items()}, droppedN
+
+# Dの訓練中のepochの集計，最新の重み，optimizerを受け取る
+def syncAsyncDiscriminator(D, optimizer_d, fakesQueue, weightsQueue, dProcess):
+    putToDiscriminator(fakesQueue, ("sync", ), dProcess)
+    while True:
+        dStep, dStateDict, optDStateDict, stats = getFromDiscriminator(weightsQueue, dProcess)
+        if(optDStateDict is not None):
+            break
+    D.load_state_dict(dStateDict)
+    optimizer_d.load_state_dict(optDStateDict)
+    return dStep, stats
+
+# GをこのプロセスでDを別プロセスで非同期に訓練する(main stageのみ)．settingsはDEFAULT_TRAIN_SETTINGSのうち変更するもの
+# (例) trainAsync(inheritOnlyModel=True, checkpointFile="cpts/pretrained.cpt")
+def trainAsync(**settings):
+    from torch.utils.tensorboard import SummaryWriter
+    settings = getTrainSettings(**settings)
+    assert not (settings["forCharaTraining"] or settings["forStyleTraining"]), "trainAsync is only for the main stage"
+    if(settings["threadsPerProcess"] is None):
+        settings["threadsPerProcess"] = max(1, (os.cpu_count() or 1) // 2)
+    torch.set_num_threads(settings["threadsPerProcess"])
+    torch.manual_seed(settings["seed"])
+    random.seed(settings["seed"])
+    np.random.seed(settings["seed"])
+    device = torch.device("cpu")
+
+    models = buildModels(settings)
+    for model in models:
+        model.to(device)
+    optimizers = getOptimizers(models, False, False, torch.optim.AdamW, settings["optimizer_d_lr"])
+    # Dの重みは学習用のプロセスから受け取るため，optimizer_dのstepでは更新しない
+    setSpectralNormInterval(models, [optimizers[0], None, optimizers[2], optimizers[3]], settings["snInterval"])
+    start = loadCheckpoints(settings["checkpointFile"], models, optimizers, "", "", settings["inheritOnlyModel"], False, False)
+    D = models[1]
+    # GのプロセスのDは重みを受け取るだけなので微分しない
+    D.requires_grad_(False)
+    dataLoaders = getDataLoaders(settings)
+    writer = AsyncSummaryWriter(SummaryWriter(log_dir=settings["logDir"]))
+    checkpointWriter = CheckpointWriter(settings["checkpointFormat"])
+    # メモリはDのプロセスと分け合う
+    trainState = initTrainState(settings, device, 2)
+    asyncState = {"staleness": 0}
+    phases, validationWorker = getValidationPhases(settings)
+
+    context = mp.get_context("spawn")
+    fakesQueue = context.Queue(settings["asyncQueueN"])
+    weightsQueue = context.Queue()
+    dProcess = context.Process(target=trainAsyncDiscriminator, args=(settings, CheckpointWriter.toCPU(D.state_dict()),
+        CheckpointWriter.toCPU(optimizers[1].state_dict()), fakesQueue, weightsQueue), daemon=True)
+    dProcess.start()
+    try:
+        for epoch in range(start, settings["epochN"]):
+            print('-------------')
+            print('Epoch {}/{}'.format(epoch, settings["epochN"]))
+            epochStartTime = time.time()
+            if(epoch > 0):
+                g_loss, GLossDict, droppedN = runAsyncGeneratorEpoch(models, optimizers, dataLoaders[0], device, epoch,
+                    settings, trainState, asyncState, fakesQueue, weightsQueue, dProcess)
+                dStep, stats = syncAsyncDiscriminator(D, optimizers[1], fakesQueue, weightsQueue, dProcess)
+                asyncState["staleness"] = 0
+                d_loss, d_iteration, discriminator_correct_n, discriminator_problems_n, TCorrectN = stats[:5]
+                d_loss = np.nan if d_iteration == 0 else d_loss / d_iteration
+                discriminator_ns = [[discriminator_correct_n, max(discriminator_problems_n, 1)], [0, 0]]
+                d_correct_rate = printResults(d_loss, discriminator_ns, g_loss, GLossDict, 0, np.array(stats[5:]), TCorrectN,
+                    epochStartTime, epoch, False, True)
+                outputWriter(writer, d_loss, d_correct_rate, g_loss, GLossDict, 0, "train", epoch, False, True)
+                writer.add_scalar("async/dropped_fakes", droppedN, global_step=epoch)
+                writer.add_scalar("async/D_steps", d_iteration, global_step=epoch)
+            # 検証は受け取ったDで行う
+            if("val" in phases):
+                runEpoch(models, optimizers, dataLoaders, device, epoch, settings, trainState, writer, phases=("val", ))
+            checkpointWriter.save(getCheckpoint(models, optimizers, epoch, False), epoch)
+            if(validationWorker is not None):
+                validationWorker.submit(checkpointWriter.latest, epoch)
+    finally:
+        if(dProcess.is_alive()):
+            try:
+                fakesQueue.put(None, timeout=ASYNC_WAIT_SEC)
+            except queue.Full:
+                pass
+            dProcess.join(ASYNC_WAIT_SEC * 10)
+            if(dProcess.is_alive()):
+                dProcess.terminate()
+        writer.close()
+        checkpointWriter.close()
+        if(validationWorker is not None):
+            validationWorker.close()
+
+
+# 検証を別プロセスで行うための部分
+# 訓練のプロセスはepochごとのcheckpoint(CPU上のコピー)かそのパスを渡すだけで，検証の終わりを待たない
+# 結果は訓練と同じlogDirに，そのcheckpointのepochで書き込む
+
+# checkpointのうち検証に使うもの
+VALIDATION_CHECKPOINT_KEYS = ["modelStateDict", "discriminatorStateDict", "charaDiscriminatorStateDict",
+    "styleDiscriminatorStateDict"]
+
+# checkpointのモデルの重みを読み込む(loadCheckpointsのうちモデルの部分)
+def loadModelStates(models, checkpoint):
+    myPSP, D, styleDis, charaDis = models
+    myPSP.load_state_dict(checkpoint["modelStateDict"], strict=False)
+    D.load_state_dict(checkpoint["discriminatorStateDict"], strict=False)
+    styleDis.load_state_dict(checkpoint["styleDiscriminatorStateDict"])
+    charaDis.load_state_dict(checkpoint["charaDiscriminatorStateDict"])
+
+# 検証を行うプロセス．taskQueueには (epoch, checkpointかそのパス) か None (終了) が入る
+def runValidationWorker(settings, taskQueue, threadsN):
+    from torch.utils.tensorboard import SummaryWriter
+    settings = getTrainSettings(**settings)
+    torch.set_num_threads(threadsN)
+    device = torch.device("cpu")
+    models = buildModels(settings)
+    for model in models:
+        model.to(device)
+    validDataLoader = torch.utils.data.dataloader.DataLoader(getValidDataset(settings), batch_size=settings["batchSize"],
+        num_workers=settings["workers"])
+    writer = SummaryWriter(log_dir=settings["logDir"])
+    trainState = initTrainState(settings, device)
+    while True:
+        task = taskQueue.get()
+        if(task is None):
+            break
+        epoch, checkpoint = task
+        if(isinstance(checkpoint, str)):
+            if(not os.path.exists(checkpoint)): # 古いcheckpointは消されていることがある
+                continue
+            checkpoint = torch.load(checkpoint, map_location="cpu")
+        loadModelStates(models, checkpoint)
+        del checkpoint
+        runEpoch(models, [None] * 4, [None, validDataLoader, None], device, epoch, settings, trainState, writer, phases=("val", ))
+        writer.flush()
+    writer.close()
+
+class ValidationWorker:
+    # 検証用のプロセスを管理する
+    # 検証が訓練より遅いときは，待っているもののうち最新のepochのみを検証する(訓練は待たない)
+    def __init__(self, settings, threadsN = 1):
+        # settings ... DEFAULT_TRAIN_SETTINGSのうち変更するもの．forCharaTraining, forStyleTraining, modelLevel, logDirなどは訓練と揃える
+        # threadsN ... 検証のプロセスが使うスレッド数
+        context = mp.get_context("spawn")
+        self.taskQueue = context.Queue()
+        self.process = context.Process(target=runValidationWorker, args=(dict(settings), self.taskQueue, threadsN), daemon=True)
+        self.process.start()
+
+    def submit(self, checkpoint, epoch):
+        # checkpoint ... checkpointの辞書(CheckpointWriterのlatestなどCPU上のコピー)かそのパス
+        if(isinstance(checkpoint, dict)):
+            checkpoint = {key: checkpoint[key] for key in VALIDATION_CHECKPOINT_KEYS}
+        putLatest(self.taskQueue, (epoch, checkpoint))
+
+    def close(self):
+        # 待っているものを検証し終えてから終わる
+        self.taskQueue.put(None)
+        self.process.join()
+
+# settingsのvalidationThreadsに応じて，runEpochで行うphaseとValidationWorker(rank 0のみ．使わなければNone)を得る
+def getValidationPhases(settings, rank = 0):
+    if(settings["validationThreads"] is None):
+        return ("train", "val"), None
+    validationWorker = ValidationWorker(settings, settings["validationThreads"]) if rank == 0 else None
+    return ("train", ), validationWorker
+
+# checkpointFormatに新しいcheckpointが保存されるのを待って検証し続ける(訓練とは別に起動する)
+# (例) watchValidation(logDir="./logs1", checkpointFormat="cpts/output{}.cpt")
+def watchValidation(pollSec = 30, threadsN = 1, **settings):
+    settings = getTrainSettings(**settings)
+    worker = ValidationWorker(settings, threadsN)
+    prefix, suffix = settings["checkpointFormat"].split("{}")
+    lastPath = None
+    try:
+        while worker.process.is_alive():
+            path = getLatestCheckpointPath(settings["checkpointFormat"])
+            if(path is not None and path != lastPath):
+                worker.submit(path, int(path[len(prefix):len(path) - len(suffix)]))
+                lastPath = path
+            time.sleep(pollSec)
+    finally:
+        worker.close()
+
+
+# chara_encoderを軽量なCharaEncoderStudentに蒸留するための部分
+# chara_encoderへの入力は常に基準のフォント(MSゴシック体)の文字画像なので，その全ての文字で出力を真似させる
+
+STUDENT_CHECKPOINT_FILE = "cpts/chara_student.cpt"
+
+# 蒸留に使うDataLoader．FontToolsの全ての文字とloadCharaListの文字の，基準のフォントの画像を出力する
+def getDistillDataLoader(batchSize = 32, useKanji = True, workers = 2, shuffle = True):
+    charaList = list(dict.fromkeys("".join(FontTools(useKanji).fontCheckStrings) + "".join(loadCharaList())))
+    return torch.utils.data.dataloader.DataLoader(MyPSPCharaDataset(charaList), batch_size=batchSize, shuffle=shuffle,
+        num_workers=workers)
+
+# teacher(MyPSP.chara_encoder)の出力をMSEで真似るようにstudentを訓練し，checkpointFileに保存する
+def distillCharaEncoder(teacher, student, dataLoader, epochN, device, lr = 1e-3, writer = None,
+    checkpointFile = STUDENT_CHECKPOINT_FILE):
+    teacher.to(device)
+    teacher.eval()
+    student.to(device)
+    optimizer = torch.optim.Adam(student.parameters(), lr, [0.9, 0.99])
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochN)
+    lossFunction = torch.nn.MSELoss()
+    for epoch in range(epochN):
+        student.train()
+        epochStartTime = time.time()
+        epochLoss = 0
+        iteration = 0
+        for images in dataLoader:
+            images = images.to(device, torch.float32)
+            with torch.no_grad():
+                target = teacher(images)
+            loss = lossFunction(student(images), target)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            epochLoss += loss.item()
+            iteration += 1
+            print("\riter {:4}/{}".format(iteration, len(dataLoader)), end="")
+        scheduler.step()
+        epochLoss /= max(iteration, 1)
+        print()
+        print("epoch {} || distill loss: {:.6f}, timer: {:.4f} sec.".format(epoch, epochLoss, time.time() - epochStartTime))
+        if(writer is not None):
+            writer.add_scalar("distill/loss", epochLoss, global_step=epoch)
+        checkpoint = {"epoch": epoch, "channels": student.channels, "studentStateDict": student.state_dict(),
+            "optStateDict": optimizer.state_dict()}
+        torch.save(checkpoint, checkpointFile + ".tmp")
+        os.replace(checkpointFile + ".tmp", checkpointFile)
+    return student
+
+# 保存したCharaEncoderStudentを読み込む．MyPSPで使うときはmyPSP.set_chara_encoder(student)
+def loadCharaEncoderStudent(checkpointFile = STUDENT_CHECKPOINT_FILE):
+    checkpoint = torch.load(checkpointFile, map_location="cpu")
+    student = CharaEncoderStudent(checkpoint["channels"])
+    student.load_state_dict(checkpoint["studentStateDict"])
+    return student
+
+# teacher, studentの1枚あたりの推論時間と，teacherの出力に対する誤差を比べる
+# 返り値は各モデルの{"name", "params", "ms_per_image", "feature_mse", "relative_error"}のリスト
+def benchmarkCharaEncoder(teacher, student, dataLoader, device, batchN = 10, repeatN = 3):
+    batches = []
+    for images in dataLoader:
+        batches.append(images.to(device, torch.float32))
+        if(len(batches) >= batchN):
+            break
+    imageN = sum(images.shape[0] for images in batches)
+    results = []
+    with torch.no_grad():
+        teacher.to(device).eval()
+        student.to(device).eval()
+        targets = [teacher(images) for images in batches]
+        for name, model in [["teacher", teacher], ["student", student]]:
+            model(batches[0]) # warm up
+            startTime = time.time()
+            for _ in range(repeatN):
+                outs = [model(images) for images in batches]
+            elapsed = (time.time() - startTime) / repeatN
+            squareError = sum(((out - target) ** 2).sum().item() for out, target in zip(outs, targets))
+            targetNorm = sum((target ** 2).sum().item() for target in targets)
+            results.append({"name": name, "params": sum(p.numel() for p in model.parameters()),
+                "ms_per_image": 1000 * elapsed / imageN, "feature_mse": squareError / sum(t.numel() for t in targets),
+                "relative_error": (squareError / targetNorm) ** 0.5})
+    for result in results:
+        print("{name:8} params {params:10d} | {ms_per_image:8.3f} ms/image | mse {feature_mse:.6f} | relative {relative_error:.4f}".format(
+            **result))
+    return results
+
+
+# Generator(style_gen)のチャンネルを減らし(StyleGAN/pruning.py)，出力画像の誤差と推論時間を比べる部分
+# 重要度は検証用のフォント(getValidDataset)の一部で測り，残りで比べる．CPUで使うならdeviceはcpuにする
+
+PRUNED_GENERATOR_FORMAT = "cpts/pruned_gen{}.cpt" # 減らした割合ごと
+
+# dataLoader(FontGeneratorDatasetのもの)からstyle_genへの入力[(chara_z, style_z)]をbatchN個作る
+def getGeneratorInputs(myPSP, dataLoader, device, batchN):
+    inputs = []
+    myPSP.eval()
+    with torch.no_grad():
+        for data in dataLoader:
+            beforeCharacter = data[0][0].to(device, torch.float32)
+            teachers = data[1][:, :, 1].to(device, torch.float32)
+            inputs.append(myPSP.encode(beforeCharacter, teachers))
+            if(len(inputs) >= batchN):
+                break
+    return inputs
+
+# generatorの1枚あたりの推論時間(ms)と出力のリストを返す．ノイズは固定する
+def measureGenerator(generator, inputs, alpha, repeatN = 3):
+    generator.eval()
+    with torch.no_grad(), fixed_noise(generator):
+        outputs = [generator(chara_z, style_z, alpha) for chara_z, style_z in inputs] # warm upを兼ねる
+        startTime = time.time()
+        for _ in range(repeatN):
+            for chara_z, style_z in inputs:
+                generator(chara_z, style_z, alpha)
+        elapsed = (time.time() - startTime) / repeatN
+    imageN = sum(chara_z.shape[0] for chara_z, _ in inputs)
+    return 1000 * elapsed / imageN, outputs
+
+# myPSP.style_genのチャンネルをratiosの割合ずつ減らしたものを作り，元のstyle_genと比べる
+# mse ... 二値化前の出力の二乗誤差，pixel_error ... 二値化した出力(MyPSPのuseBin)で値が変わった画素の割合
+# outputFormatがNoneでなければ，減らしたGeneratorを保存する(loadPrunedGeneratorで読み込む)
+# 返り値は(各ratioの結果のリスト(先頭は元のstyle_gen), ratio -> 減らしたGenerator)
+def pruneGenerator(myPSP, dataLoader, device, ratios = (0.0, 0.25, 0.5, 0.75), calibrationBatchN = 8, evalBatchN = 4,
+    repeatN = 3, outputFormat = PRUNED_GENERATOR_FORMAT):
+    generator = myPSP.style_gen
+    alpha = torch.ones((1, 1), device=device)
+    inputs = getGeneratorInputs(myPSP, dataLoader, device, calibrationBatchN + evalBatchN)
+    calibration, evaluation = inputs[:calibrationBatchN], inputs[calibrationBatchN:]
+    assert len(evaluation) > 0, "dataLoader has no batches left for evaluation"
+    scores = get_channel_saliency(generator, calibration, alpha)
+    channels = get_channels(generator.synthesis_module)
+    baseMs, baseOutputs = measureGenerator(generator, evaluation, alpha, repeatN)
+    report = [{"ratio": None, "params": sum(p.numel() for p in generator.parameters()), "ms_per_image": baseMs,
+        "speedup": 1.0, "mse": 0.0, "pixel_error": 0.0, "file": None}]
+    prunedGenerators = {}
+    for ratio in ratios:
+        prunedGen = prune_generator(generator, select_channels(scores, channels, ratio))
+        ms, outputs = measureGenerator(prunedGen, evaluation, alpha, repeatN)
+        mse = np.mean([((out - base) ** 2).mean().item() for out, base in zip(outputs, baseOutputs)])
+        pixelError = np.mean([((out > 0) != (base > 0)).float().mean().item() for out, base in zip(outputs, baseOutputs)])
+        checkpointFile = None
+        if(outputFormat is not None):
+            checkpointFile = outputFormat.format(ratio)
+            torch.save({"ratio": ratio, "channels": get_channels(prunedGen.synthesis_module),
+                "genStateDict": prunedGen.state_dict()}, checkpointFile)
+        report.append({"ratio": ratio, "params": sum(p.numel() for p in prunedGen.parameters()), "ms_per_image": ms,
+            "speedup": baseMs / ms, "mse": mse, "pixel_error": pixelError, "file": checkpointFile})
+        prunedGenerators[ratio] = prunedGen
+    for result in report:
+        print("ratio {:>8} | params {:10d} | {:8.3f} ms/image | x{:.2f} | mse {:.6f} | pixel error {:.4%}".format(
+            "original" if result["ratio"] is None else result["ratio"], result["params"], result["ms_per_image"],
+            result["speedup"], result["mse"], result["pixel_error"]))
+    return report, prunedGenerators
+
+# pruneGeneratorで保存したGeneratorをmyPSP.style_genに読み込む
+def loadPrunedGenerator(myPSP, checkpointFile):
+    checkpoint = torch.load(checkpointFile, map_location="cpu")
+    resize_generator(myPSP.style_gen, checkpoint["channels"])
+    myPSP.style_gen.load_state_dict(checkpoint["genStateDict"])
+    return myPSP
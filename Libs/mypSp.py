@@ -1,14 +1,17 @@
 
 from Libs.myFontData import FontGeneratorDataset
-from Libs.myFontLib import FontStyleChecker
+from Libs.myFontLib import STYLE_LIST_INDEX
+from Libs.myLoss import float32Forward
 import torch
 import torch.nn as nn
 import sys
+from collections import OrderedDict
 
 from torchvision import transforms
 sys.path.append('../')
 from EfficientNet.model import *
 from StyleGAN.network import *
+from StyleGAN.pruning import *
 
 
 # 画像を入力とし，それが何の文字かを判別する
@@ -37,6 +40,10 @@ class CharaDiscriminator(nn.Module):
             self.last_conv = None
                             
         self.chara_encoder._change_in_channels(1)
+
+    def set_checkpoint(self, enabled = True, blocks = None):
+        self.chara_encoder.set_checkpoint(enabled, blocks)
+
     def forward(self, images):
         # teacherとなるmyPSPのself.chara_encoderの出力は
         # ほぼ正規化されている(mean ~ 0.075, var ~ 1.1)ので，正規化しなくてよい?
@@ -47,9 +54,58 @@ class CharaDiscriminator(nn.Module):
         else:
             return ans
 
+# 実際のフォント画像(生成画像ではないもの)に対するモデルの出力のキャッシュ
+# (モデル, フォントのインデックス, 文字, モデルのバージョン)をキーとする
+# モデルのバージョンはパラメータ, バッファの_versionの和で，optimizer.stepやload_state_dictで変わると
+# そのモデルのキャッシュはすべて捨てる．maxNを超えたら古く使われていないものから捨てる
+# 同じ画像に同じ出力を返すように，キャッシュを使うモデルはeval()にしておくこと
+class RealGlyphFeatureCache:
+    def __init__(self, maxN = 2048):
+        self.maxN = maxN
+        self.caches = {} # id(model) -> [version, OrderedDict]
+        self.hitN = 0
+        self.missN = 0
+
+    @staticmethod
+    def getVersion(model):
+        return sum(p._version for p in model.parameters()) + sum(b._version for b in model.buffers())
+
+    def clear(self):
+        self.caches = {}
+
+    def getFeatures(self, model, images, keys):
+        # images ... [B, ...] modelへの入力
+        # keys ... 長さBのリスト．各要素は(フォントのインデックス, 文字)など．Noneならキャッシュを使わない
+        version = self.getVersion(model)
+        if(id(model) not in self.caches or self.caches[id(model)][0] != version):
+            self.caches[id(model)] = [version, OrderedDict()]
+        cache = self.caches[id(model)][1]
+
+        missing = [i for i, key in enumerate(keys) if key is None or key not in cache]
+        self.hitN += len(keys) - len(missing)
+        self.missN += len(missing)
+        computed = {}
+        if(len(missing) > 0):
+            with torch.no_grad():
+                out = model(images[missing])
+            for i, feature in zip(missing, out):
+                computed[i] = feature
+                if(keys[i] is not None):
+                    cache[keys[i]] = feature
+                    if(len(cache) > self.maxN):
+                        cache.popitem(last = False)
+        ans = []
+        for i, key in enumerate(keys):
+            if(i in computed):
+                ans.append(computed[i])
+            else:
+                cache.move_to_end(key)
+                ans.append(cache[key])
+        return torch.stack(ans)
+
 # Styleの特徴量を入力として，それぞれの要素の値のテンソルで返す
 class StyleDiscriminator(nn.Module):
-    OUT_F_N = len(FontStyleChecker.defaultListIndex)
+    OUT_F_N = len(STYLE_LIST_INDEX)
     IN_F_N = FEATURE_V_N * 2
     MID_F_N = [256, 128, 64, 32]
     DIVID_N = 4 
@@ -92,6 +148,50 @@ class StyleDiscriminator(nn.Module):
         #     raw = self.bn1(raw)
         return self.lastActivation(raw), raw
 
+# MyPSP.chara_encoder(EfficientNet-B0, ver >= 2)の出力を真似るように蒸留する軽量なエンコーダ
+# 入力 [B, 1, 256, 256] -> 出力 [B, 320, 8, 8] (chara_encoderと同じ)
+# 各段はstride 2の3x3 conv, depthwise conv, pointwise convで，5段で1/32にする
+# MyPSP.set_chara_encoderでchara_encoderと置き換えられる
+class CharaEncoderStudent(nn.Module):
+    OUT_CHANNEL_N = 320
+    def __init__(self, channels = (16, 32, 64, 128, 192)):
+        super().__init__()
+        self.channels = list(channels)
+        stages = []
+        inChannelN = 1
+        for channelN in self.channels:
+            stages.append(nn.Sequential(
+                nn.Conv2d(inChannelN, channelN, 3, stride=2, padding=1, bias=False), nn.BatchNorm2d(channelN), nn.SiLU(),
+                nn.Conv2d(channelN, channelN, 3, padding=1, groups=channelN, bias=False), nn.BatchNorm2d(channelN), nn.SiLU(),
+                nn.Conv2d(channelN, channelN, 1, bias=False), nn.BatchNorm2d(channelN), nn.SiLU()))
+            inChannelN = channelN
+        self.stages = nn.ModuleList(stages)
+        self.last_conv = nn.Conv2d(inChannelN, self.OUT_CHANNEL_N, 1, bias=False)
+        self.bn = nn.BatchNorm2d(self.OUT_CHANNEL_N)
+        self.checkpoint_blocks = set()
+
+    @property
+    def _blocks(self):
+        # getGenIntermidiateLayersなど，EfficientNetEncoderの_blocksを参照するところ用
+        return self.stages
+
+    def set_checkpoint(self, enabled = True, blocks = None):
+        if not enabled:
+            self.checkpoint_blocks = set()
+        elif blocks is None:
+            self.checkpoint_blocks = set(range(len(self.stages)))
+        else:
+            self.checkpoint_blocks = set(blocks)
+
+    def init_original_layer(self):
+        pass
+
+    def forward(self, images):
+        x = images
+        for idx, stage in enumerate(self.stages):
+            x = checkpoint_block(stage, x, enabled=idx in self.checkpoint_blocks)
+        return self.bn(self.last_conv(x))
+
 class MyPSP(nn.Module):
     # 複数画像からフォントを構成するモデル
     def __init__(self, ver = 1, dropout_p = 0, useBNform2s = False, useBin = False):
@@ -123,6 +223,21 @@ class MyPSP(nn.Module):
         self.style_encoder._change_in_channels(1)
     
     
+    def set_chara_encoder(self, chara_encoder):
+        # chara_encoderを同じ形の出力をするもの(CharaEncoderStudentなど)に置き換える
+        # checkpointのmodelStateDictのchara_encoderのキーも置き換わるため，読み込むときはstrict=Falseにすること
+        self.chara_encoder = chara_encoder
+        return self
+
+    def encode(self, chara_images, style_pairs):
+        # style_genへの入力(chara_encoderの出力と，style_encoderの出力のペアについての平均)を返す
+        # style_pairsはforwardと同じ形
+        chara_z = self.chara_encoder(chara_images)
+        if(self.ver <= 3):
+            style_pairs = style_pairs[:, :, 1] -  style_pairs[:, :, 0]
+        style_z = torch.stack([self.style_encoder(style_pairs[:, i]) for i in range(style_pairs.size()[1])], dim = 1)
+        return chara_z, style_z.mean(1)
+
     def set_level(self, level):
         self.style_gen.set_level(level)
     
@@ -133,16 +248,35 @@ class MyPSP(nn.Module):
     def set_for_style_training(self, b):
         # フォントのエンコードデコードのみを訓練するとき
         self.for_style_training = b
+
+    def set_native_resolution(self, b):
+        # 低いlevelでは生成画像をそのlevelの解像度のまま返す
+        # エンコーダへの入力(chara_images, style_pairs)は256x256のままにすること
+        self.style_gen.set_native_resolution(b)
+
+    def get_resolution(self):
+        # 生成画像の1辺の長さ
+        return self.style_gen.get_resolution()
+
+    def set_checkpoint(self, enabled = True):
+        # エンコーダ，Generatorのブロックでactivation checkpointingを行う
+        # 再計算が増える代わりに，中間層の出力を保持しなくなる
+        self.chara_encoder.set_checkpoint(enabled)
+        self.style_encoder.set_checkpoint(enabled)
+        self.style_gen.set_checkpoint(enabled)
     
-    def forward(self, chara_images,  style_pairs, alpha):
+    def forward(self, chara_images,  style_pairs, alpha, chara_features = None):
         # chara_image ... 変換したい文字のMSゴシック体の画像
         #   [B, 1, 256, 256]
+        # chara_features ... chara_encoderの出力を既に計算してあれば渡す(RealGlyphFeatureCacheなど)．Noneならここで計算
         # style_pairs ... MSゴシック体の文字と、その文字に対応する変換先のフォントの文字の画像のペアのテンソル
         #   [B, pair_n, 2, 1, 256, 256]　→　 ver=4, [B, pair_n, 1, 256, 256] MSゴシック体をなくす
         # alpha ... どれだけ変化させるかの係数？バッチで共通なため、サイズは[1, 1]
 
         # 文字をエンコード [B, 256*6, 1, 1](ver1) or [B, 320, 8, 8](ver2)
-        if(not self.for_style_training):
+        if(chara_features is not None):
+            chara_images = chara_features
+        elif(not self.for_style_training):
             chara_images = self.chara_encoder(chara_images)
 
         if self.for_chara_training:
@@ -180,6 +314,7 @@ class SoftCrossEntropy(nn.Module):
         super().__init__()
         self.mean = mean
         self.std = std
+    @float32Forward
     def forward(self, out, teacher):
         teacher = teacher * self.std + self.mean
         out = teacher * torch.log(out + self.eps) + (1-teacher) * torch.log(1-out + self.eps)
@@ -223,6 +358,20 @@ class MyPSPLoss(nn.Module):
             self.hingeLoss = ImageHingeLoss()
         else:
             self.hingeLoss = None
+        self.normalize = transforms.Normalize(FontGeneratorDataset.IMAGE_MEAN, FontGeneratorDataset.IMAGE_VAR)
+
+    def getPyramid(self, images):
+        # 1/START_SCALEから，SCALE分の1ずつ縮小した画像のリスト(長さMAIN_LOSS_N)
+        # 倍率1のときは補間しても値が変わらないので，そのまま使う
+        if(self.START_SCALE != 1):
+            images = F.interpolate(images, scale_factor=1/self.START_SCALE, mode="bilinear")
+        ans = [images]
+        for i in range(self.MAIN_LOSS_N-1):
+            images = F.interpolate(images, scale_factor=1/self.SCALE, mode="bilinear")
+            ans.append(images)
+        return ans
+
+    @float32Forward
     def forward(self, outputs, targets):
         # outputs, targetsともに[B, 1, W, H]
 
@@ -242,26 +391,16 @@ class MyPSPLoss(nn.Module):
 
         # outputsは正規化されていないので、それに合わせる
         if(self.useNormalize):
-            outputs = transforms.Compose([
-                transforms.Normalize(FontGeneratorDataset.IMAGE_MEAN, 
-                    FontGeneratorDataset.IMAGE_VAR)])(outputs)
+            outputs = self.normalize(outputs)
         if(self.mode == "crossE"):
             targets = (targets * FontGeneratorDataset.IMAGE_VAR) + FontGeneratorDataset.IMAGE_MEAN
-            
 
-        ans = [0] * self.MAIN_LOSS_N
-
-        # 1/8スタートで各SCALEでSCALE分の1してさらに誤差を計算
+        # 1/START_SCALEスタートで各SCALEでSCALE分の1してさらに誤差を計算
         factor = 1
-        outputs = F.interpolate(outputs, scale_factor=1/self.START_SCALE, mode="bilinear")
-        targets = F.interpolate(targets, scale_factor=1/self.START_SCALE, mode="bilinear")
-        ans[0] = self.mainLoss[0](outputs, targets) * factor
-        
-        for i in range(self.MAIN_LOSS_N-1):
+        ans = []
+        for i, (o, t) in enumerate(zip(self.getPyramid(outputs), self.getPyramid(targets))):
+            ans.append(self.mainLoss[i](o, t) * factor)
             factor *= self.FACTOR
-            outputs = F.interpolate(outputs, scale_factor=1/self.SCALE, mode="bilinear")
-            targets = F.interpolate(targets, scale_factor=1/self.SCALE, mode="bilinear")
-            ans[i+1] = self.mainLoss[i+1](outputs, targets) * factor
         ans = torch.stack(ans)
         return torch.mean(ans) + sharpScore + rareScore + hingeLoss
 
@@ -289,6 +428,7 @@ class ImageHingeLoss(nn.Module):
     def __init___(self):
         super().__init__()
     
+    @float32Forward
     def forward(self, outputs, teachers):
         biggerT = torch.ge(teachers, 0.)
         smallerT = torch.lt(teachers, 0.)
@@ -320,12 +460,26 @@ class ImageRarePixelLoss(nn.Module):
         return -1 *lAns-uAns 
 
     
+    @float32Forward
     def forward(self, outputs, teachers):
         teachers = teachers * FontGeneratorDataset.IMAGE_VAR + FontGeneratorDataset.IMAGE_MEAN
         size = tuple(teachers.size())
         reversedSize = tuple(reversed(size))
-        if(self.separateN == 1):
+        n = self.separateN
+        if(n == 1):
             return self.getSectionLoss(reversedSize, outputs, teachers)
+        elif(size[2] % n == 0 and size[3] % n == 0):
+            # 各区画の大きさが等しいので，区画ごとの平均の平均は全体の平均に等しい
+            # [B, C, n, H/n, n, W/n]にして区画ごとに判定する
+            blockSize = (size[0], size[1], n, size[2]//n, n, size[3]//n)
+            outputs = outputs.reshape(blockSize)
+            teachers = teachers.reshape(blockSize)
+            teachersMean = teachers.mean(dim = (1, 3, 5), keepdim = True)
+            uValue = torch.lt(teachers, self.LOWER_LIM) * torch.log(1 - outputs + self.eps)
+            uAns = ((teachersMean > self.UPPER_LIM) * uValue).mean() # -log x
+            lValue = torch.gt(teachers, self.UPPER_LIM) * torch.log(outputs + self.eps)
+            lAns = ((teachersMean < self.LOWER_LIM) * lValue).mean() # -log(1-x)
+            return -1 *lAns-uAns
         else:
             size = (size[0], size[1], size[2]//self.separateN, size[3]//self.separateN)
             reversedSize = tuple(reversed(size))
@@ -23,11 +23,14 @@ class PixelNormalizationLayer(nn.Module):
         # x is [B, C, H, W]
         if x is None:
             return x
-        x2 = x ** 2
+        # epsilonが小さいため，autocast中でもfloat32で計算する
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x32 = x.float()
+            x2 = x32 ** 2
 
-        length_inv = torch.rsqrt(x2.mean(1, keepdim=True) + self.epsilon)
+            length_inv = torch.rsqrt(x2.mean(1, keepdim=True) + self.epsilon)
 
-        return x * length_inv
+            return (x32 * length_inv).to(x.dtype)
 
 
 class MinibatchStdConcatLayer(nn.Module):
@@ -109,15 +112,28 @@ class WSConv2d(nn.Module):
         self.stride = stride
         self.padding = padding
 
+    def get_weight(self):
+        return self.weight * self.scale
+
     def forward(self, x):
-        scaled_weight = self.weight * self.scale
-        return F.conv2d(x, scaled_weight, self.bias, self.stride, self.padding)
+        return F.conv2d(x, self.get_weight(), self.bias, self.stride, self.padding)
 
 class SNConv2d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride, padding):
         super().__init__()
         self.conv = nn.utils.spectral_norm(nn.Conv2d(in_channels, out_channels, kernel_size, stride, padding))
 
+    @property
+    def bias(self):
+        return self.conv.bias
+
+    def get_weight(self):
+        # spectral_normのhookで正規化した重み(forwardと同じく，訓練中はpower iterationも行う)
+        # remove_spectral_normした後はhookがないため，そのままの重み
+        for hook in self.conv._forward_pre_hooks.values():
+            hook(self.conv, None)
+        return self.conv.weight
+
     def forward(self, x):
         return self.conv(x)
 
@@ -141,6 +157,36 @@ class WSConvTranspose2d(nn.Module):
         return F.conv_transpose2d(x, scaled_weight, self.bias, self.stride, self.padding)
 
 
+# 2倍のupsampleを転置畳み込み(stride 2)で表したときのカーネル(1次元)とpadding
+# F.interpolate(scale_factor=2)と同じ値になる．bilinearはalign_corners=False
+UPSAMPLE_KERNELS = {"nearest": ([1., 1.], 0), "bilinear": ([0.25, 0.75, 0.75, 0.25], 1)}
+
+def upsample_conv2d(x, weight, bias, upsample_mode, blur = None, groups = 1):
+    # F.interpolate(x, scale_factor=2) -> conv(weight, padding=k//2) (-> blur) を1つの転置畳み込みで行う
+    # 2倍に拡大した入力を作らず，拡大後の解像度で畳み込む場合と同じ計算量(nearestなら4/9)で済む
+    # 転置畳み込みのカーネルは，upsampleのカーネルと(blurを畳み込んだ)weightを反転したものの畳み込み
+    # 内部では元の計算と一致する．ただし端の画素は，bilinearの端の扱い(端の値の複製)と
+    # blurの前のゼロ埋めを再現しないため異なる(bilinearは端から2画素，blurがあればさらに1画素)
+    # nearestでblurなしなら端も一致する
+    # 後ろにinstance norm(AdaIN)がある場合は，端の誤差で平均，分散が変わり出力全体が変わるので注意(SynthBlock)
+    # groups ... F.conv2dと同じ．weightは[groups * out, in, kh, kw]
+    assert upsample_mode in UPSAMPLE_KERNELS, "fused upsample supports only {}".format(list(UPSAMPLE_KERNELS))
+    out_channels, in_channels, kh, kw = weight.shape
+    w = weight.reshape(out_channels * in_channels, 1, kh, kw)
+    if blur is not None:
+        # blurのフィルタは対称なので，weightとの合成はそのまま畳み込めばよい
+        w = F.conv2d(F.pad(w, [2, 2, 2, 2]), blur.filter.to(w.dtype))
+        kh += 2
+        kw += 2
+    u, upsample_padding = UPSAMPLE_KERNELS[upsample_mode]
+    u = torch.tensor(u, dtype=w.dtype, device=w.device)
+    u = (u[:, None] * u[None, :])[None, None]
+    w = F.conv2d(F.pad(w.flip([2, 3]), [len(u[0, 0]) - 1] * 4), u)
+    w = w.view(groups, out_channels // groups, in_channels, w.shape[2], w.shape[3]).transpose(1, 2)
+    w = w.reshape(groups * in_channels, out_channels // groups, w.shape[3], w.shape[4])
+    return F.conv_transpose2d(x, w, bias, stride=2, padding=upsample_padding + (kh - 1) // 2, groups=groups)
+
+
 class AdaIN(nn.Module):
     def __init__(self, dim, w_dim, ver = 1):
         super().__init__()
@@ -279,17 +325,37 @@ class SynthBlock(nn.Module):
         self.activation = nn.LeakyReLU(negative_slope=0.2)
 
         self.upsample_mode = upsample_mode
+        # upsampleとconv1(とblur)を1つの転置畳み込みで行う(upsample_conv2d)．重みはそのまま使う
+        self.fused_upsample = False
 
         self.dropout = nn.Dropout2d(p = dropout_p)
 
+    def can_fuse_upsample(self):
+        # AdaINのinstance normは特徴量マップ全体の平均，分散を使うため，端の画素の誤差でも出力全体が変わる
+        # そのため端まで一致する場合(nearestで，blurを合成しない)のみupsample_conv2dを使う
+        return self.upsample_mode == "nearest" and (self.blur is None or self.ver >= 3)
+
+    def set_fused_upsample(self, enabled = True):
+        # 実際に合成したかを返す
+        self.fused_upsample = enabled and self.can_fuse_upsample()
+        return self.fused_upsample
+
     def forward(self, x, w1, w2):
 
-        x = F.interpolate(x, scale_factor=2, mode=self.upsample_mode)
-        x = self.conv1(x)
+        blur = self.blur
+        if self.fused_upsample:
+            # ver >= 3ではconv1とblurの間にbn1があるため，blurは合成しない
+            fused_blur = blur if self.ver < 3 else None
+            x = upsample_conv2d(x, self.conv1.get_weight(), self.conv1.bias, self.upsample_mode, fused_blur)
+            if fused_blur is not None:
+                blur = None
+        else:
+            x = F.interpolate(x, scale_factor=2, mode=self.upsample_mode)
+            x = self.conv1(x)
         if(self.ver >= 3):
             x = self.bn1(x)
-        if self.blur is not None:
-            x = self.blur(x)
+        if blur is not None:
+            x = blur(x)
         x = self.noise1(x)
         x = self.activation(x)
         x = self.adain1(x, w1)
@@ -305,6 +371,104 @@ class SynthBlock(nn.Module):
         return x
 
 
+# ver >= 5ではSynthBlockの代わりにModulatedSynthBlockを使う
+MODULATED_CONV_VER = 5
+
+class ModulatedConv2d(nn.Module):
+    # StyleGAN2のweight modulation / demodulation
+    # wから入力チャンネルごとのscaleを作って重みに掛け，出力チャンネルごとに重みのノルムで割る
+    # 特徴量マップではなく重みを正規化するため，AdaINのinstance norm, BatchNormが要らない
+    # サンプルごとに重みが異なるため，バッチをgroupsとした畳み込みで計算する
+    def __init__(self, in_channels, out_channels, kernel_size, w_dim, demodulate = True):
+        super().__init__()
+        weight = torch.empty(out_channels, in_channels, kernel_size, kernel_size)
+        init.normal_(weight)
+        self.weight = nn.Parameter(weight)
+        self.register_buffer("scale", torch.tensor(1 / np.sqrt(in_channels * kernel_size * kernel_size)))
+        self.bias = nn.Parameter(torch.zeros(out_channels))
+        # 初期状態ではscaleが1になるようにする
+        self.affine = WSConv2d(w_dim, in_channels, 1, 1, 0, gain=1)
+        nn.init.ones_(self.affine.bias)
+        self.padding = kernel_size // 2
+        self.demodulate = demodulate
+        self.epsilon = 1e-8
+
+    def get_weight(self, w):
+        # w is [B, w_dim, 1, 1] -> [B, out, in, k, k]
+        batch_size = w.size()[0]
+        style = self.affine(w).view(batch_size, 1, -1, 1, 1)
+        weight = self.weight[None] * self.scale * style
+        if self.demodulate:
+            weight = weight * torch.rsqrt((weight ** 2).sum([2, 3, 4], keepdim=True) + self.epsilon)
+        return weight
+
+    def forward(self, x, w, upsample_mode = None, blur = None):
+        # upsample_modeを指定すると，2倍に拡大してから畳み込む(upsample_conv2d)
+        batch_size, in_channels, height, width = x.size()
+        weight = self.get_weight(w)
+        weight = weight.view(-1, in_channels, weight.size()[3], weight.size()[4])
+        x = x.reshape(1, batch_size * in_channels, height, width)
+        bias = self.bias.repeat(batch_size)
+        if upsample_mode is None:
+            x = F.conv2d(x, weight, bias, padding=self.padding, groups=batch_size)
+        else:
+            x = upsample_conv2d(x, weight, bias, upsample_mode, blur, groups=batch_size)
+        return x.view(batch_size, -1, x.size()[2], x.size()[3])
+
+
+class ModulatedSynthBlock(nn.Module):
+    # SynthBlockの畳み込みとAdaINを，wで変調した畳み込み(ModulatedConv2d)に置き換えたもの (ver >= 5)
+    # 入出力はSynthBlockと同じ．conv1をw1, conv2をw2で変調する
+    def __init__(self, input_dim, output_dim, output_size, w_dim, upsample_mode, use_blur, use_noise, dropout_p = 0):
+        super().__init__()
+        self.conv1 = ModulatedConv2d(input_dim, output_dim, 3, w_dim)
+        self.conv2 = ModulatedConv2d(output_dim, output_dim, 3, w_dim)
+        if use_blur:
+            self.blur = Blur3x3()
+        else:
+            self.blur = None
+
+        self.noise1 = NoiseLayer(output_dim, output_size)
+        self.noise2 = NoiseLayer(output_dim, output_size)
+        if not use_noise:
+            nn.init.zeros_(self.noise1.noise_scale)
+            self.noise1.fixed = True
+            nn.init.zeros_(self.noise2.noise_scale)
+            self.noise2.fixed = True
+
+        # pruningでチャンネルの重要度を測るため，活性化関数を分けておく
+        self.activation1 = nn.LeakyReLU(negative_slope=0.2)
+        self.activation2 = nn.LeakyReLU(negative_slope=0.2)
+
+        self.upsample_mode = upsample_mode
+        self.fused_upsample = False
+
+        self.dropout = nn.Dropout2d(p = dropout_p)
+
+    def set_fused_upsample(self, enabled = True):
+        # AdaINがないため，端の誤差(bilinear, blur)は端の数画素にとどまる
+        self.fused_upsample = enabled
+        return self.fused_upsample
+
+    def forward(self, x, w1, w2):
+        if self.fused_upsample:
+            x = self.conv1(x, w1, self.upsample_mode, self.blur)
+        else:
+            x = F.interpolate(x, scale_factor=2, mode=self.upsample_mode)
+            x = self.conv1(x, w1)
+            if self.blur is not None:
+                x = self.blur(x)
+        x = self.noise1(x)
+        x = self.activation1(x)
+
+        x = self.conv2(x, w2)
+        x = self.dropout(x)
+        x = self.noise2(x)
+        x = self.activation2(x)
+
+        return x
+
+
 class SynthesisModule(nn.Module):
     def __init__(self, settings, make_blocks = True, ver = 1):
         super().__init__()
@@ -354,16 +518,43 @@ class SynthesisModule(nn.Module):
 
         self.level = 7
         self.for_chara_training = False
+        # activation checkpointingを行うblocksのインデックス
+        self.checkpoint_blocks = set()
+        # Trueなら低いlevelでも256x256に拡大せず，そのlevelの解像度のまま出力する(SynthesisModule2のみ)
+        self.native_resolution = False
 
         # self.register_buffer("level", torch.tensor(1, dtype=torch.int32))
     def set_level(self, level: int):
         assert 0 < level <= 7
         self.level = level
+    def set_checkpoint(self, enabled = True, blocks = None):
+        # blocksを再計算することで中間層のメモリを減らす. blocks=Noneなら全て
+        if not enabled:
+            self.checkpoint_blocks = set()
+        elif blocks is None:
+            self.checkpoint_blocks = set(range(len(self.blocks)))
+        else:
+            self.checkpoint_blocks = set(blocks)
     def set_for_chara_training(self, b):
         self.for_chara_training = b
         if b:
             self.level = min(self.level, 3)
 
+    def set_fused_upsample(self, enabled = True):
+        # blocksのupsampleとconv1を1つの転置畳み込みにする. 重みは変わらないため，訓練済みのものにも使える
+        # SynthBlockは出力が変わらない場合(can_fuse_upsample)のみ合成する
+        refused = 0
+        for block in self.blocks:
+            if isinstance(block, (SynthBlock, ModulatedSynthBlock)):
+                if not block.set_fused_upsample(enabled) and enabled:
+                    refused += 1
+        if refused > 0:
+            print("fused upsample is not used in {} SynthBlocks (upsample_mode={}, blur={}): it would change the outputs".format(
+                refused, self.upsample_mode, any(getattr(block, "blur", None) is not None for block in self.blocks)))
+
+    def set_native_resolution(self, b):
+        self.native_resolution = b
+
     def set_noise_fixed(self, fixed):
         for module in self.modules():
             if isinstance(module, NoiseLayer):
@@ -374,7 +565,8 @@ class SynthesisModule(nn.Module):
             x = F.interpolate(x, scale_factor=2, mode="bilinear")
             x = self.chara_training_convs[i](x)
             x = nn.LeakyReLU(negative_slope=0.2)(x)
-        x = F.interpolate(x, size=(256, 256), mode = "bicubic")
+        if not self.native_resolution:
+            x = F.interpolate(x, size=(256, 256), mode = "bicubic")
         return x
 
     def forward(self, w, alpha):
@@ -420,8 +612,19 @@ class SynthesisModule(nn.Module):
         for name, param in self.to_rgbs.named_parameters():
             writer.add_histogram(f"g_synth_block.torgb/{name}", param.cpu().data.numpy(), step)
 
+def get_native_resolution(level, for_chara_training = False):
+    # SynthesisModule2がlevelの解像度のまま(native_resolution)出力する画像の1辺の長さ
+    if for_chara_training:
+        level = min(level, 3)
+    if level == 1:
+        return 8
+    if for_chara_training:
+        return 16 if level == 2 else 64
+    return 2 ** (level + 2)
+
 class SynthesisModule2(SynthesisModule):
     # myPSP ver2用のsyntethis. forwardの入力が特徴量マップとwになる
+    # ver >= 5(MODULATED_CONV_VER)ではblocksがModulatedSynthBlockになる．first_conv, to_monosはver 3以降と同じ
     def __init__(self, settings, dropout_p = 0, ver = 2):
         super().__init__(settings, make_blocks=False)
         use_blur = settings["use_blur"]
@@ -432,12 +635,20 @@ class SynthesisModule2(SynthesisModule):
             self.first_bn = BatchNorm2d(256)
         else:
             self.first_conv = WSConv2d(320, 256, 3, 1, 1, gain=1)
-        self.blocks = nn.ModuleList([
-            SynthBlock(256, 128, 32, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p, ver = ver),
-            SynthBlock(128, 64, 64, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p, ver = ver),
-            SynthBlock(64, 32, 128, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p, ver = ver),
-            SynthBlock(32, 16, 256, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p, ver = ver)
-        ])
+        if(ver >= MODULATED_CONV_VER):
+            self.blocks = nn.ModuleList([
+                ModulatedSynthBlock(256, 128, 32, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p),
+                ModulatedSynthBlock(128, 64, 64, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p),
+                ModulatedSynthBlock(64, 32, 128, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p),
+                ModulatedSynthBlock(32, 16, 256, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p)
+            ])
+        else:
+            self.blocks = nn.ModuleList([
+                SynthBlock(256, 128, 32, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p, ver = ver),
+                SynthBlock(128, 64, 64, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p, ver = ver),
+                SynthBlock(64, 32, 128, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p, ver = ver),
+                SynthBlock(32, 16, 256, self.w_dim, self.upsample_mode, use_blur, use_noise, dropout_p=dropout_p, ver = ver)
+            ])
         if(ver >= 3):
             self.to_monos = nn.ModuleList([
             SNConv2d(320, 1, 1, 1, 0),
@@ -466,6 +677,12 @@ class SynthesisModule2(SynthesisModule):
         if b:
             self.level = min(self.level, 3)
 
+    def get_resolution(self):
+        # 出力画像の1辺の長さ. native_resolutionでなければ常に256
+        if not self.native_resolution:
+            return 256
+        return get_native_resolution(self.level, self.for_chara_training)
+
     def forward(self, chara_z, w, alpha):
         # w is [batch_size. 8, w_dim, 1, 1]
         # chara_z is [batch_size, 320, 8, 8]
@@ -478,7 +695,8 @@ class SynthesisModule2(SynthesisModule):
             if(self.ver >= 3):
                 x = self.bns[0](x)
 
-            x = F.interpolate(x, size=(256, 256), mode = "bilinear")
+            if not self.native_resolution:
+                x = F.interpolate(x, size=(256, 256), mode = "bilinear")
             return x
         
         x = F.interpolate(x, scale_factor=2, mode="bilinear")
@@ -493,14 +711,17 @@ class SynthesisModule2(SynthesisModule):
                 x =  self.to_monos[1](x)
                 if(self.ver >= 3):
                     x = self.bns[1](x)
+                if self.native_resolution:
+                    return x
                 return F.interpolate(x, size=(256, 256), mode = "bicubic")
             else:
                 return self.chara_training_layer(x)
 
         for i in range(0, level-3):
-            x = self.blocks[i](x, w[:, i*2], w[:, i*2+1])
+            x = checkpoint_block(self.blocks[i], x, w[:, i*2], w[:, i*2+1], enabled=i in self.checkpoint_blocks)
         x2 = x
-        x2= self.blocks[level-3](x2, w[:, (level-3)*2], w[:, (level-3)*2+1])
+        x2= checkpoint_block(self.blocks[level-3], x2, w[:, (level-3)*2], w[:, (level-3)*2+1],
+            enabled=(level-3) in self.checkpoint_blocks)
 
         x2 = self.to_monos[level-1](x2)
         if(self.ver >= 3):
@@ -517,7 +738,7 @@ class SynthesisModule2(SynthesisModule):
             x1 = F.interpolate(x1, scale_factor=2, mode=self.upsample_mode)
             x = torch.lerp(x1, x2, alpha.item())
         
-        if level < 6:
+        if level < 6 and not self.native_resolution:
             x = F.interpolate(x, size = (256, 256), mode = "bilinear")
         return x
 
@@ -550,6 +771,20 @@ class Generator(nn.Module):
         self.for_chara_training = b
         self.synthesis_module.set_for_chara_training(b)
 
+    def set_checkpoint(self, enabled = True, blocks = None):
+        self.synthesis_module.set_checkpoint(enabled, blocks)
+
+    def set_fused_upsample(self, enabled = True):
+        self.synthesis_module.set_fused_upsample(enabled)
+
+    def set_native_resolution(self, b):
+        # 低いlevelの画像を256x256に拡大せずに出力する. 比較する画像もそのlevelの解像度にすること
+        assert self.ver >= 2 or not b, "native resolution supports only SynthesisModule2"
+        self.synthesis_module.set_native_resolution(b)
+
+    def get_resolution(self):
+        return self.synthesis_module.get_resolution() if self.ver >= 2 else 256
+
     def forward(self, chara_z, style_z, alpha):
         batch_size = chara_z.size()[0]
         level = self.synthesis_module.level
@@ -776,6 +1011,16 @@ class Discriminator4(nn.Module):
     # def set_level(self, level):
     #     self.discriminator.set_level(level)
 
+    def set_checkpoint(self, enabled = True, blocks = None):
+        self.discriminator.set_checkpoint(enabled, blocks)
+
+    def set_dropout(self, p):
+        # モデルを作り直さずにdropout率を変える(optimizerの状態はそのまま)
+        self.discriminator.set_dropout(p)
+        for layer in self.linears:
+            if(isinstance(layer, nn.Dropout)):
+                layer.p = p
+
     def forward(self, after, teachers, alpha):
         # after ... 変換したい文字の変換後の画像
         #   [B, 1, 256, 256]
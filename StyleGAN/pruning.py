@@ -0,0 +1,219 @@
+import copy
+import contextlib
+import torch
+import torch.nn as nn
+
+from StyleGAN.network import *
+
+# SynthesisModule2(Generator ver >= 2)のチャンネルを減らして軽くする
+# 減らせるチャンネルのまとまり(group)は次の3種類
+#   "first_conv" ... first_convの出力 (blocks[0].conv1, to_monos[1], chara_training_convs[0]の入力)
+#   "blocks.{i}.conv1" ... blocks[i].conv1の出力 (bn1, noise1, adain1, conv2の入力)
+#   "blocks.{i}.conv2" ... blocks[i].conv2の出力 (bn2, noise2, adain2, blocks[i+1].conv1, to_monos[i+2]の入力)
+# ModulatedSynthBlock(ver >= 5)ではAdaIN, BatchNormの代わりに，入力側のModulatedConv2dのaffineの出力を減らす
+# demodulationは残した入力チャンネルの重みで正規化し直すため，残したチャンネルの出力も少し変わる
+# 重要度は，そのチャンネルを0にしたときの出力画像の変化(二乗誤差)の1次近似で測る
+# 出力yとランダムなrに対して g = d<y, r>/da とすると，E[(Σ a g)^2] = |(dy/da) a|^2 になる
+# SNConv2dはチャンネルを減らすとスペクトルノルムが変わり出力が変わるため，減らすときに正規化後の重みに置き換える
+# そのため減らしたGeneratorは推論用で，state_dictのキーも元のGeneratorとは異なる(resize_generatorで同じ形を作って読み込む)
+
+def get_prune_groups(synthesis):
+    # group名 -> 重要度を測るモジュール(出力がそのgroupのチャンネルになる)
+    groups = {"first_conv": synthesis.first_bn if synthesis.ver >= 3 else synthesis.first_conv}
+    for i, block in enumerate(synthesis.blocks):
+        if isinstance(block, ModulatedSynthBlock):
+            groups["blocks.{}.conv1".format(i)] = block.activation1
+            groups["blocks.{}.conv2".format(i)] = block.activation2
+        else:
+            groups["blocks.{}.conv1".format(i)] = block.adain1
+            groups["blocks.{}.conv2".format(i)] = block.adain2
+    return groups
+
+def get_conv_weight(conv):
+    if isinstance(conv, SNConv2d):
+        if hasattr(conv.conv, "weight_orig"):
+            return conv.conv.weight_orig
+        return conv.conv.weight
+    return conv.weight
+
+def get_channels(synthesis):
+    # group名 -> チャンネル数
+    channels = {"first_conv": get_conv_weight(synthesis.first_conv).shape[0]}
+    for i, block in enumerate(synthesis.blocks):
+        channels["blocks.{}.conv1".format(i)] = get_conv_weight(block.conv1).shape[0]
+        channels["blocks.{}.conv2".format(i)] = get_conv_weight(block.conv2).shape[0]
+    return channels
+
+def remove_spectral_norm(conv):
+    # nn.utils.remove_spectral_normは，_WrappedHookに包まれて登録されたload_state_dictのpre hookを消さない
+    # 残っていると，weight_orig, weight_uのないstate_dictを読み込めないため，ここで消す
+    nn.utils.remove_spectral_norm(conv)
+    for key, hook in list(conv._load_state_dict_pre_hooks.items()):
+        if isinstance(getattr(hook, "hook", hook), nn.utils.spectral_norm.SpectralNormLoadStateDictPreHook):
+            del conv._load_state_dict_pre_hooks[key]
+    for key, hook in list(conv._state_dict_hooks.items()):
+        if isinstance(getattr(hook, "hook", hook), nn.utils.spectral_norm.SpectralNormStateDictHook):
+            del conv._state_dict_hooks[key]
+
+def remove_spectral_norms(module):
+    # SNConv2dの重みを，現在のu, vで正規化した重み(eval時にforwardで使われる重み)に置き換える
+    for m in module.modules():
+        if isinstance(m, SNConv2d) and hasattr(m.conv, "weight_orig"):
+            remove_spectral_norm(m.conv)
+
+def refresh_spectral_norms(module):
+    # spectral normのweight(forwardの前に計算される属性)を，勾配を追わずに計算し直す
+    # 勾配を計算したforwardの後はweightが計算グラフを持ち，deepcopyできないため
+    with torch.no_grad():
+        for m in module.modules():
+            for hook in list(m._forward_pre_hooks.values()):
+                if isinstance(hook, nn.utils.spectral_norm.SpectralNorm):
+                    hook(m, None)
+
+@contextlib.contextmanager
+def fixed_noise(generator):
+    # 比較のため，NoiseLayerのノイズを固定する
+    noises = [m for m in generator.modules() if isinstance(m, NoiseLayer)]
+    fixed = [m.fixed for m in noises]
+    for m in noises:
+        m.fixed = True
+    try:
+        yield generator
+    finally:
+        for m, f in zip(noises, fixed):
+            m.fixed = f
+
+def get_channel_saliency(generator, inputs, alpha):
+    # inputs ... [(chara_z, style_z)]．Generatorのforwardに渡すもの
+    # group名 -> 各チャンネルの重要度 [C]．今のlevelで使われないgroupは含まない
+    synthesis = generator.synthesis_module
+    groups = get_prune_groups(synthesis)
+    scores = {}
+    activations = {}
+    handles = [module.register_forward_hook(lambda m, i, o, name=name: activations.__setitem__(name, o))
+        for name, module in groups.items()]
+    checkpoint_blocks = synthesis.checkpoint_blocks
+    synthesis.checkpoint_blocks = set() # 再計算でhookが2回呼ばれないようにする
+    training = generator.training
+    generator.eval()
+    try:
+        with fixed_noise(generator):
+            for chara_z, style_z in inputs:
+                activations.clear()
+                with torch.enable_grad():
+                    out = generator(chara_z, style_z, alpha)
+                    names = [name for name in activations if activations[name].requires_grad]
+                    grads = torch.autograd.grad((out * torch.randn_like(out)).sum(), [activations[name] for name in names],
+                        allow_unused=True)
+                for name, grad in zip(names, grads):
+                    if grad is None:
+                        continue
+                    score = ((activations[name] * grad).sum([2, 3]) ** 2).sum(0).detach().float().cpu()
+                    scores[name] = scores[name] + score if name in scores else score
+    finally:
+        for handle in handles:
+            handle.remove()
+        activations.clear()
+        refresh_spectral_norms(generator) # eval()のまま計算し直すため，power iterationは行わない
+        synthesis.checkpoint_blocks = checkpoint_blocks
+        generator.train(training)
+    return scores
+
+def select_channels(scores, channels, ratio, min_channels = 8, multiple = 8):
+    # 各groupのチャンネルを重要度の高い順にround((1 - ratio) * C)個(multipleの倍数に切り上げ)残す
+    # group名 -> 残すチャンネルのインデックス(昇順)．scoresにないgroupはすべて残す
+    keep = {}
+    for name, n in channels.items():
+        if name not in scores:
+            keep[name] = torch.arange(n)
+            continue
+        k = int(round((1 - ratio) * n))
+        k = min(n, max(min_channels, -(-k // multiple) * multiple))
+        keep[name] = scores[name].topk(k).indices.sort().values
+    return keep
+
+def prune_conv(conv, out_index = None, in_index = None):
+    # WSConv2dはscaleをそのまま使うため，残した重みの出力は変わらない
+    if isinstance(conv, ModulatedConv2d) and in_index is not None:
+        prune_conv(conv.affine, out_index=in_index)
+    if isinstance(conv, SNConv2d):
+        if hasattr(conv.conv, "weight_orig"):
+            remove_spectral_norm(conv.conv)
+        conv = conv.conv
+    weight = conv.weight.data
+    bias = conv.bias.data if conv.bias is not None else None
+    if out_index is not None:
+        weight = weight[out_index]
+        if bias is not None:
+            bias = bias[out_index]
+    if in_index is not None:
+        weight = weight[:, in_index]
+    conv.weight = nn.Parameter(weight.clone())
+    if bias is not None:
+        conv.bias = nn.Parameter(bias.clone())
+    if isinstance(conv, nn.Conv2d):
+        conv.out_channels, conv.in_channels = weight.shape[:2]
+
+def prune_bn(bn, index):
+    bn.weight = nn.Parameter(bn.weight.data[index].clone())
+    bn.bias = nn.Parameter(bn.bias.data[index].clone())
+    bn.running_mean = bn.running_mean[index].clone()
+    bn.running_var = bn.running_var[index].clone()
+    bn.num_features = len(index)
+
+def prune_adain(adain, index):
+    prune_conv(adain.scale_transform, out_index=index)
+    prune_conv(adain.bias_transform, out_index=index)
+    if adain.ver >= 3:
+        prune_bn(adain.bn0, index)
+        prune_bn(adain.bn1, index)
+    adain.dim = len(index)
+
+def prune_noise(noise, index):
+    noise.noise_scale = nn.Parameter(noise.noise_scale.data[:, index].clone())
+
+def prune_synthesis(synthesis, keep):
+    # keep ... group名 -> 残すチャンネルのインデックス．synthesisを直接書き換える
+    remove_spectral_norms(synthesis)
+    blocks = synthesis.blocks
+    index = keep["first_conv"]
+    prune_conv(synthesis.first_conv, out_index=index)
+    if synthesis.ver >= 3:
+        prune_bn(synthesis.first_bn, index)
+    prune_conv(blocks[0].conv1, in_index=index)
+    prune_conv(synthesis.to_monos[1], in_index=index)
+    prune_conv(synthesis.chara_training_convs[0], in_index=index)
+    for i, block in enumerate(blocks):
+        index = keep["blocks.{}.conv1".format(i)]
+        modulated = isinstance(block, ModulatedSynthBlock)
+        prune_conv(block.conv1, out_index=index)
+        if not modulated and block.ver >= 3:
+            prune_bn(block.bn1, index)
+        prune_noise(block.noise1, index)
+        if not modulated:
+            prune_adain(block.adain1, index)
+        prune_conv(block.conv2, in_index=index)
+
+        index = keep["blocks.{}.conv2".format(i)]
+        prune_conv(block.conv2, out_index=index)
+        if not modulated and block.ver >= 3:
+            prune_bn(block.bn2, index)
+        prune_noise(block.noise2, index)
+        if not modulated:
+            prune_adain(block.adain2, index)
+        if i + 1 < len(blocks):
+            prune_conv(blocks[i + 1].conv1, in_index=index)
+        prune_conv(synthesis.to_monos[i + 2], in_index=index)
+    return synthesis
+
+def prune_generator(generator, keep):
+    # チャンネルを減らしたGeneratorのコピーを返す
+    assert generator.ver >= 2, "pruning supports only SynthesisModule2"
+    pruned = copy.deepcopy(generator)
+    prune_synthesis(pruned.synthesis_module, keep)
+    return pruned
+
+def resize_generator(generator, channels):
+    # 保存した減らしたGeneratorを読み込むため，generatorをchannelsの形に直接書き換える
+    prune_synthesis(generator.synthesis_module, {name: torch.arange(n) for name, n in channels.items()})
+    return generator
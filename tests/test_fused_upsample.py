@@ -0,0 +1,48 @@
+import copy
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from StyleGAN.network import SynthBlock, ModulatedSynthBlock
+from StyleGAN.pruning import fixed_noise
+
+W_DIM = 16
+
+
+def run(block, fused, x, w1, w2):
+    block = copy.deepcopy(block)
+    block.set_fused_upsample(fused)
+    with torch.no_grad(), fixed_noise(block):
+        return block(x, w1, w2)
+
+
+def get_inputs():
+    torch.manual_seed(1)
+    return torch.randn(2, 8, 8, 8), torch.randn(2, W_DIM, 1, 1), torch.randn(2, W_DIM, 1, 1)
+
+
+@pytest.mark.parametrize("ver", [1, 3])
+@pytest.mark.parametrize("mode", ["nearest", "bilinear"])
+@pytest.mark.parametrize("use_blur", [False, True])
+def test_synth_block_fused_upsample_keeps_outputs(ver, mode, use_blur):
+    # AdaINがあるため，SynthBlockは出力が変わらない場合のみ合成する
+    torch.manual_seed(0)
+    block = SynthBlock(8, 4, 16, W_DIM, mode, use_blur, use_noise=True, ver=ver).eval()
+    x, w1, w2 = get_inputs()
+    assert block.set_fused_upsample(True) == (mode == "nearest" and (not use_blur or ver >= 3))
+    assert torch.allclose(run(block, True, x, w1, w2), run(block, False, x, w1, w2), atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", ["nearest", "bilinear"])
+@pytest.mark.parametrize("use_blur", [False, True])
+def test_modulated_synth_block_fused_upsample(mode, use_blur):
+    # ModulatedSynthBlockは常に合成し，違いは端の数画素のみ(nearestでblurなしなら端も一致)
+    torch.manual_seed(0)
+    block = ModulatedSynthBlock(8, 4, 16, W_DIM, mode, use_blur, use_noise=True).eval()
+    x, w1, w2 = get_inputs()
+    assert block.set_fused_upsample(True)
+    fused, base = run(block, True, x, w1, w2), run(block, False, x, w1, w2)
+    # 誤差はconv1の後の端から3画素．conv2でさらに1画素広がる
+    border = 0 if mode == "nearest" and not use_blur else 4
+    inner = (slice(None), slice(None), slice(border, 16 - border), slice(border, 16 - border))
+    assert torch.allclose(fused[inner], base[inner], atol=1e-5)
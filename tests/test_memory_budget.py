@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("cv2")
+
+from Libs.myTrain import MemoryBudget, getTrainSettings, initTrainState
+
+
+def test_budget_is_split_between_processes():
+    # worldSize個のプロセスの予算を合わせても，1プロセスのときの予算を超えない
+    single = MemoryBudget("cpu")
+    budgets = [MemoryBudget("cpu", processN=2) for _ in range(2)]
+    assert sum(budget.budgetBytes for budget in budgets) <= single.budgetBytes
+    assert all(budget.collectBytes < budget.budgetBytes for budget in budgets)
+
+
+def test_init_train_state_splits_budget_by_world_size():
+    settings = getTrainSettings()
+    single = initTrainState(settings, "cpu")["memoryBudget"]
+    worldSize = 2
+    budgets = [initTrainState(settings, "cpu", worldSize)["memoryBudget"] for _ in range(worldSize)]
+    assert sum(budget.budgetBytes for budget in budgets) <= single.budgetBytes
+    # memoryProcessNを指定すればそちらを使う(launchPretrainingで2つのstageが分け合う場合)
+    shared = initTrainState(getTrainSettings(memoryProcessN=4), "cpu", worldSize)["memoryBudget"]
+    assert 4 * shared.budgetBytes <= single.budgetBytes
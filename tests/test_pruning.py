@@ -0,0 +1,50 @@
+import copy
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from StyleGAN.network import Generator, get_setting_json
+from StyleGAN.pruning import get_channel_saliency, get_channels, select_channels, prune_generator, resize_generator, \
+    fixed_noise
+
+
+def get_inputs(batchN = 2, batchSize = 2):
+    return [(torch.randn(batchSize, 320, 8, 8), torch.randn(batchSize, 512, 1, 1)) for _ in range(batchN)]
+
+
+@pytest.mark.parametrize("ver", [3, 4, 5])
+def test_pruned_generator_round_trip(ver, tmp_path):
+    # prune → 保存 → 同じ形に直したGeneratorに読み込む，で出力が変わらない
+    torch.manual_seed(0)
+    settings = get_setting_json()["network"]
+    generator = Generator(settings, ver=ver)
+    generator.set_level(4)
+    alpha = torch.ones((1, 1))
+    inputs = get_inputs()
+    scores = get_channel_saliency(generator, inputs, alpha)
+    # get_channel_saliencyの直後にdeepcopyできる
+    pruned = prune_generator(generator, select_channels(scores, get_channels(generator.synthesis_module), 0.5))
+    path = tmp_path / "pruned.cpt"
+    torch.save({"channels": get_channels(pruned.synthesis_module), "genStateDict": pruned.state_dict()}, path)
+
+    checkpoint = torch.load(path)
+    loaded = resize_generator(Generator(settings, ver=ver), checkpoint["channels"])
+    loaded.load_state_dict(checkpoint["genStateDict"])
+    loaded.set_level(4)
+    pruned.eval()
+    loaded.eval()
+    assert pruned.state_dict().keys() == loaded.state_dict().keys()
+    # NoiseLayerの固定ノイズはbufferのため，読み込んだGeneratorでも同じになる
+    with torch.no_grad(), fixed_noise(pruned), fixed_noise(loaded):
+        for chara_z, style_z in inputs:
+            assert torch.allclose(pruned(chara_z, style_z, alpha), loaded(chara_z, style_z, alpha), atol=1e-5)
+
+
+def test_prune_generator_after_saliency_keeps_original():
+    torch.manual_seed(0)
+    generator = Generator(get_setting_json()["network"], ver=4)
+    generator.set_level(4)
+    original = copy.deepcopy(generator.state_dict())
+    scores = get_channel_saliency(generator, get_inputs(1), torch.ones((1, 1)))
+    prune_generator(generator, select_channels(scores, get_channels(generator.synthesis_module), 0.25))
+    assert all(torch.equal(original[key], value) for key, value in generator.state_dict().items())
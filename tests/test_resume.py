@@ -0,0 +1,73 @@
+import random
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("cv2")
+
+from Libs.myFontData import MyPSPBatchSampler
+
+
+class IndexDataset:
+    # MyPSPBatchSamplerが使う部分のみを持つデータセット
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def getJapaneseFontIndices(self):
+        return list(range(self.n))
+
+    def resetSampleN(self):
+        pass
+
+
+def take(iterator, n):
+    return [next(iterator) for _ in range(n)]
+
+
+def test_sampler_resume_twice_in_one_epoch():
+    # 保存 → 再開 → 保存 → 再開で，1 epochのバッチを過不足なく出力する
+    # trainModelと同じく，getStateにはepochの最初から数えたiterationを渡す
+    random.seed(0)
+    dataset = IndexDataset(64)
+    sampler = MyPSPBatchSampler(4, dataset, japaneseRate=0.5)
+    iterator = iter(sampler)
+    used = take(iterator, 3)
+    iteration = 3
+    state = sampler.getState(iteration)
+    expected = sampler.batches
+
+    resumed = MyPSPBatchSampler(4, dataset, japaneseRate=0.5)
+    resumed.setState(state)
+    iterator = iter(resumed)
+    used += take(iterator, 5)
+    iteration += 5
+    state = resumed.getState(iteration)
+    assert state["position"] == 8
+
+    resumedAgain = MyPSPBatchSampler(4, dataset, japaneseRate=0.5)
+    resumedAgain.setState(state)
+    used += list(resumedAgain)
+    assert used == expected
+    assert len(used) == len(sampler)
+
+    # 次のepochは最初から新しい列を作る
+    assert len(list(resumedAgain)) == len(sampler)
+
+
+def test_resume_state_sidecar(tmp_path):
+    # resumeStateはcheckpointとは別のファイルから読み込み，epochの終わりに両方消える
+    myTrain = pytest.importorskip("Libs.myTrain")
+    checkpointFormat = str(tmp_path / "output{}.cpt")
+    writer = myTrain.CheckpointWriter(checkpointFormat)
+    resumeState = {"epoch": 3, "sampler": {"batches": [[0, 1]], "position": 1}}
+    myTrain.saveResumeCheckpoint(writer, checkpointFormat, {"epoch": 3}, resumeState)
+    writer.wait()
+    assert myTrain.loadResumeState(checkpointFormat) == resumeState
+    assert "resumeState" not in myTrain.torch.load(myTrain.getResumePath(checkpointFormat))
+
+    myTrain.removeResumeCheckpoint(writer, checkpointFormat)
+    writer.close()
+    assert myTrain.loadResumeState(checkpointFormat) is None